@@ -21,6 +21,7 @@ import default_parser
 import luconfig
 import county
 import gimms
+import pixel_weights
 
 
 
@@ -58,14 +59,13 @@ def get_green():
     obs=county.observations_by_location(luconfig.get('cereal_rust'))
     first_passage = county.first_passage_by_year(obs)
 
-    WHEAT=np.array([int(x) for x in luconfig.get('wheat_codes').split(',')],
-                   dtype=np.uint8)
+    WHEAT=luconfig.wheat_codes()
     gimms_dir=os.path.join(luconfig.get('gimms'),'counties')
     logger.info('Reading gimms in %s' % gimms_dir)
     #county_codes=gimms.build(fileinput.input(glob.glob(
     #            os.path.join(gimms_dir,'*.txt'))), WHEAT)
 
-    county_codes=cPickle.load(open(os.path.join(gimms_dir,'grid.pickle')))
+    county_codes=pixel_weights.weight_index()
 
     county_filename=luconfig.get('county')
     sh=shapefile.Reader(county_filename)
@@ -99,8 +99,7 @@ def green_of_important_pixels(year):
     This finds the greening for a whole year for the pixel
     with the most wheat in each county that has an observation.
     '''
-    gimms_dir=os.path.join(luconfig.get('gimms'),'counties')
-    county_codes=cPickle.load(open(os.path.join(gimms_dir,'grid.pickle')))
+    county_codes=pixel_weights.weight_index()
     logger.debug('read county codes')
 
     (counties, pixel, line)=gimms.pixel_with_max_wheat(county_codes)
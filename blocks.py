@@ -1,6 +1,15 @@
 '''
 This script demonstrates reading a raster dataset with GDAL
-using blocked / rasterline strategies.
+using blocked / rasterline strategies, and times them.
+
+  python blocks.py --bench --strategies liney,multiline,block \\
+      --buffers 1,16,64 --cache 8,256 --json bench.json cdl.img
+  python blocks.py --bench --synthetic 20000,20000 --layout tiled
+
+Each case runs in its own process, so that GDAL's block cache starts
+empty and peak memory belongs to that case alone. A cold run first asks
+the operating system to drop the file from its page cache. A warm run
+reads the file once before timing a second read.
 
 Drew Dolgert
 adolgert@cornell.edu
@@ -9,12 +18,20 @@ Cornell University
 '''
 import os
 import sys
+import json
+import time
+import ctypes
+import ctypes.util
+import resource
+import tempfile
+import argparse
+import subprocess
 import numpy as np
-import struct
 import gdal
-from gdalconst import GA_ReadOnly, GDT_Byte
+from gdalconst import GA_ReadOnly
 import logging
-from argparse import ArgumentParser
+import raster_blocks
+from default_parser import DefaultArgumentParser
 
 
 logger = logging.getLogger('blocks')
@@ -25,13 +42,11 @@ def read_by_line_y(band):
     This example is from the tutorial at
     http://www.gdal.org/gdal_tutorial.html
 
-    Args: band is a RasterBand from GDAL. It stores single bytes.
+    Args: band is a RasterBand from GDAL.
     Yields: (row index, Numpy array of raster lines)
     '''
-    for yidx in range(band.YSize):
-        scanline=band.ReadRaster(0,yidx,band.XSize,1,band.XSize,1,GDT_Byte)
-        arr=np.array(struct.unpack('B'*band.XSize,scanline),dtype=np.uint8)
-        yield ((0,yidx),arr)
+    for corner,arr in raster_blocks.iterate(band,strategy='line'):
+        yield (corner,arr[0])
 
 
 
@@ -40,13 +55,13 @@ def read_by_line_x(band):
     This example is from the tutorial at
     http://www.gdal.org/gdal_tutorial.html
 
-    Args: band is a RasterBand from GDAL. It stores single bytes.
+    Args: band is a RasterBand from GDAL.
     Yields: (row index, Numpy array of raster lines)
     '''
+    buffers=raster_blocks.buffer_pool(raster_blocks.band_dtype(band))
     for xidx in range(band.XSize):
-        scanline=band.ReadRaster(xidx,0,1,band.YSize,1,band.YSize,GDT_Byte)
-        arr=np.array(struct.unpack('B'*band.YSize,scanline),dtype=np.uint8)
-        yield ((xidx,0),arr)
+        arr=raster_blocks.read_window(band,(xidx,0,1,band.YSize),buffers)
+        yield ((xidx,0),arr[:,0])
 
 
 
@@ -55,75 +70,250 @@ def read_by_multiline(band,line_cnt):
     This example is from the tutorial at
     http://www.gdal.org/gdal_tutorial.html
 
-    Args: band is a RasterBand from GDAL. It stores single bytes.
+    Args: band is a RasterBand from GDAL.
     Yields: (row index, Numpy array of raster lines)
     '''
     logger.debug('Reading %d lines at a time' % line_cnt)
+    return raster_blocks.iterate(band,strategy='strip',rows=line_cnt)
 
-    for yidx in range(0, band.YSize, line_cnt):
-        read_cnt=min(line_cnt, band.YSize-yidx)
-        scanline=band.ReadRaster(0, yidx, band.XSize, read_cnt,
-                                 band.XSize, read_cnt, GDT_Byte)
-        arr=np.array(struct.unpack('B'*band.XSize*read_cnt, scanline),
-                     dtype=np.uint8).reshape((band.XSize, read_cnt))
-        yield ((0,yidx),arr)
 
 
-
-def read_by_block(band):
+def read_by_block(band,blocks_per_read=1):
     '''
-    Read whatever blocksize the file uses.
+    Read whatever blocksize the file uses, blocks_per_read blocks
+    side by side at a time.
 
-    Args: band is a gdal.RasterBand of byte values.
+    Args: band is a gdal.RasterBand.
     Yields: ((x,y) of corner, numpy array of values)
     '''
     block=band.GetBlockSize()
     logger.info('block size %d %d' % (block[0],block[1]))
+    return raster_blocks.iterate(band,strategy='block',
+                                 blocks_per_read=blocks_per_read)
 
-    # Note that y and x are switched b/c that's how ReadAsArray works.
-    main_buf=np.zeros((block[1],block[0]),dtype=np.uint8)
 
-    for yidx in range(0, band.YSize, block[1]):
-        for xidx in range(0, band.XSize, block[0]):
-            ysize=min(block[1], band.YSize-yidx)
-            xsize=min(block[0], band.XSize-xidx)
-            if xsize is block[0] and ysize is block[1]:
-                xform_buf=main_buf
-            else:
-                xform_buf=np.zeros((ysize,xsize),dtype=np.uint8)
 
-            band.ReadAsArray(xidx, yidx, xsize, ysize,
-                             xsize, ysize, xform_buf)
-            yield ((xidx,yidx),xform_buf)
+def read_by_prefetch(filename,depth=raster_blocks.PREFETCH_DEPTH,threads=1,
+                     memory=raster_blocks.PREFETCH_BYTES):
+    '''
+    Read the file's blocks while threads read the next depth blocks.
 
+    Args: filename of a raster. Each thread opens its own dataset.
+    Yields: ((x,y) of corner, numpy array of values)
+    '''
+    logger.info('prefetching %d blocks on %d threads' % (depth,threads))
+    return raster_blocks.prefetch(filename,strategy='block',depth=depth,
+                                  threads=threads,memory=memory)
 
 
-class DefaultArgumentParser(ArgumentParser):
-    '''This adds some default behaviors to the argument parsing.'''
 
-    def __init__(self,*args,**kwargs):
-        ArgumentParser.__init__(self,*args,**kwargs)
-        self.add_argument('--verbose','-v',dest='verbose',action='store_true',
-                          default=False,help='print debug messages')
-        self.add_argument('--quiet','-q',dest='quiet',action='store_true',
-                          default=False,help='print only exceptions')
+def read_by_layout(band):
+    '''
+    Read by line, strip or block, whichever suits the file's blocks.
 
+    Yields: ((x,y) of corner, numpy array of values)
+    '''
+    strategy=raster_blocks.choose_strategy(band.GetBlockSize(),band.XSize)
+    logger.info('reading by %s' % strategy)
+    return raster_blocks.iterate(band,strategy=strategy)
 
-    def add_function(self,name,msg):
-        '''A shorthand for created a boolean flag.'''
-        self.add_argument('--%s'%name,dest=name,action='store_true',
-                        default=False,help=msg)
 
 
-    def parse_args(self):
-        args=ArgumentParser.parse_args(self)
-        log_level=logging.INFO
-        if args.verbose:
-            log_level=logging.DEBUG
-        elif args.quiet:
-            log_level=logging.ERROR
-        logging.basicConfig(level=log_level)
-        return args
+# Strategy name to (function of band, filename and buffer size, whether
+# the buffer size changes what it does).
+STRATEGIES={
+    'liney' : (lambda band,f,n: read_by_line_y(band), False),
+    'linex' : (lambda band,f,n: read_by_line_x(band), False),
+    'multiline' : (lambda band,f,n: read_by_multiline(band,n), True),
+    'block' : (lambda band,f,n: read_by_block(band,n), True),
+    'auto' : (lambda band,f,n: read_by_layout(band), False),
+    'prefetch' : (lambda band,f,n: read_by_prefetch(f,n), True),
+    }
+
+
+def evict(filename):
+    '''
+    Ask the operating system to drop filename from its page cache.
+    Returns False where posix_fadvise isn't available.
+    '''
+    name=ctypes.util.find_library('c')
+    if not name or not sys.platform.startswith('linux'):
+        return False
+    libc=ctypes.CDLL(name)
+    POSIX_FADV_DONTNEED=4
+    fd=os.open(filename,os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        result=libc.posix_fadvise(fd,ctypes.c_longlong(0),
+                                  ctypes.c_longlong(0),POSIX_FADV_DONTNEED)
+    except OSError:
+        result=-1
+    finally:
+        os.close(fd)
+    return result==0
+
+
+
+def peak_rss_mb():
+    '''
+    Most memory this process has held, in MB.
+    '''
+    peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform=='darwin':
+        return peak/(1024.0*1024)
+    return peak/1024.0
+
+
+
+def time_read(filename,strategy,buffer_size=None):
+    '''
+    Read filename once with a strategy.
+    Returns: (seconds, bytes read, pixels read)
+    '''
+    reader,buffered=STRATEGIES[strategy]
+    ds=gdal.Open(filename,GA_ReadOnly)
+    band=ds.GetRasterBand(1)
+    byte_cnt=0
+    pixel_cnt=0
+    start=time.time()
+    for corner,arr in reader(band,filename,buffer_size):
+        byte_cnt+=arr.nbytes
+        pixel_cnt+=arr.size
+    elapsed=time.time()-start
+    ds=None
+    return elapsed,byte_cnt,pixel_cnt
+
+
+
+def run_case(case):
+    '''
+    Time one read described by case, a dictionary with filename,
+    strategy, buffer, cache_mb and state, either cold or warm.
+    Meant to run in a fresh process. Returns case with results added.
+    '''
+    result=dict(case)
+    gdal.SetCacheMax(int(case['cache_mb'])*1024*1024)
+    if case['state']=='cold':
+        result['evicted']=evict(case['filename'])
+    else:
+        time_read(case['filename'],case['strategy'],case['buffer'])
+    elapsed,byte_cnt,pixel_cnt=time_read(case['filename'],case['strategy'],
+                                         case['buffer'])
+    result['seconds']=elapsed
+    result['bytes']=byte_cnt
+    result['pixels']=pixel_cnt
+    result['mb_per_s']=byte_cnt/1e6/elapsed if elapsed>0 else 0.0
+    result['pixels_per_s']=pixel_cnt/elapsed if elapsed>0 else 0.0
+    result['peak_rss_mb']=peak_rss_mb()
+    return result
+
+
+
+def run_case_process(case):
+    '''
+    run_case in a child python, so each case has its own GDAL cache
+    and its own peak memory.
+    '''
+    command=[sys.executable,os.path.abspath(__file__),'--quiet',
+             '--case',json.dumps(case)]
+    child=subprocess.Popen(command,stdout=subprocess.PIPE)
+    out=child.communicate()[0]
+    if child.returncode!=0:
+        logger.error('case %s failed with %d' % (str(case),child.returncode))
+        result=dict(case)
+        result['error']=child.returncode
+        return result
+    return json.loads(out.strip().splitlines()[-1])
+
+
+
+def bench_cases(filenames,strategies,buffers,cache_sizes,states):
+    '''
+    Every combination, except that strategies that ignore the buffer
+    size run only once per file, cache and state.
+    '''
+    cases=list()
+    for filename in filenames:
+        for strategy in strategies:
+            if strategy not in STRATEGIES:
+                raise ValueError('Strategy %s is not one of %s' %
+                                 (strategy,', '.join(sorted(STRATEGIES))))
+            sizes=buffers if STRATEGIES[strategy][1] else [None]
+            for size in sizes:
+                for cache_mb in cache_sizes:
+                    for state in states:
+                        cases.append({'filename' : filename,
+                                      'strategy' : strategy,
+                                      'buffer' : size,
+                                      'cache_mb' : cache_mb,
+                                      'state' : state})
+    return cases
+
+
+
+def benchmark(filenames,strategies,buffers,cache_sizes,states=('cold','warm')):
+    results=list()
+    cases=bench_cases(filenames,strategies,buffers,cache_sizes,states)
+    for idx,case in enumerate(cases):
+        logger.info('case %d of %d: %s' % (idx+1,len(cases),str(case)))
+        results.append(run_case_process(case))
+    return results
+
+
+
+def print_table(results):
+    columns=['strategy','buffer','cache_mb','state','seconds','mb_per_s',
+             'pixels_per_s','peak_rss_mb']
+    print '\t'.join(['file']+columns)
+    for r in results:
+        if 'error' in r:
+            print '%s\t%s\t%s\tfailed' % (os.path.basename(r['filename']),
+                                          r['strategy'],r['buffer'])
+            continue
+        values=[os.path.basename(r['filename']),r['strategy'],
+                '' if r['buffer'] is None else str(r['buffer']),
+                str(r['cache_mb']),r['state']]
+        values+=['%.3f' % r['seconds'],'%.1f' % r['mb_per_s'],
+                 '%.0f' % r['pixels_per_s'],'%.1f' % r['peak_rss_mb']]
+        print '\t'.join(values)
+
+
+
+def synthetic_raster(filename,xsize,ysize,layout='tiled',block=256,
+                     compress='DEFLATE'):
+    '''
+    Write a byte GeoTIFF of CDL-like codes, runs of random crop codes,
+    so that it compresses about as well as a real one. layout is
+    tiled, for block by block tiles, or striped, for strips of rows.
+    '''
+    options=['COMPRESS=%s' % compress] if compress else []
+    if layout=='tiled':
+        options+=['TILED=YES','BLOCKXSIZE=%d' % block,
+                  'BLOCKYSIZE=%d' % block]
+    else:
+        options+=['BLOCKYSIZE=%d' % min(block,16)]
+    driver=gdal.GetDriverByName('GTiff')
+    ds=driver.Create(filename,xsize,ysize,1,gdal.GDT_Byte,options)
+    band=ds.GetRasterBand(1)
+    codes=np.array([0,1,5,21,22,23,24,26,36,61,111,121,141,176,225],
+                   dtype=np.uint8)
+    random=np.random.RandomState(0)
+    run=32
+    rows=raster_blocks.strip_height(xsize,block,64*1024*1024)
+    for yidx in range(0,ysize,rows):
+        height=min(rows,ysize-yidx)
+        runs=codes[random.randint(0,len(codes),
+                                  size=(height,(xsize-1)//run+1))]
+        band.WriteArray(np.repeat(runs,run,axis=1)[:,:xsize],0,yidx)
+    ds=None
+    logger.info('wrote %dx%d %s synthetic raster %s' %
+                (xsize,ysize,layout,filename))
+    return filename
+
+
+
+def int_list(text):
+    return [int(x) for x in text.split(',') if x]
 
 
 
@@ -134,15 +324,73 @@ if __name__ == '__main__':
     parser.add_function('multiline','Read file one line at a time, stepping '
                         'y by count')
     parser.add_function('block','Read file one block at a time.')
+    parser.add_function('prefetch','Read file one block at a time while '
+                        'threads read ahead.')
+    parser.add_function('auto','Read file by line, strip or block, '
+                        'whichever suits its blocks.')
+    parser.add_function('bench','Time --strategies for each of --buffers, '
+                        '--cache and --states.')
 
     parser.add_argument('--count',dest='count',type=int,default=32,
                         help='Read n scanlines at a time.')
+    parser.add_argument('--depth',dest='depth',type=int,
+                        default=raster_blocks.PREFETCH_DEPTH,
+                        help='Blocks to read ahead with --prefetch.')
+    parser.add_argument('--threads',dest='threads',type=int,default=1,
+                        help='Threads reading ahead with --prefetch.')
+    parser.add_argument('--strategies',dest='strategies',type=str,
+                        default='liney,multiline,block,auto,prefetch',
+                        help='Comma-separated strategies for --bench, from '
+                        '%s.' % ', '.join(sorted(STRATEGIES)))
+    parser.add_argument('--buffers',dest='buffers',type=str,default='1,16,64',
+                        help='Lines for multiline, blocks per read for '
+                        'block, depth for prefetch.')
+    parser.add_argument('--cache',dest='cache',type=str,default='40',
+                        help='Comma-separated GDAL cache sizes in MB.')
+    parser.add_argument('--states',dest='states',type=str,default='cold,warm',
+                        help='cold, warm or both.')
+    parser.add_argument('--json',dest='json',type=str,default=None,
+                        help='Write --bench results to this file.')
+    parser.add_argument('--synthetic',dest='synthetic',type=str,default=None,
+                        help='x,y size of a synthetic raster to bench.')
+    parser.add_argument('--layout',dest='layout',type=str,default='tiled',
+                        choices=['tiled','striped'],
+                        help='Block layout of the synthetic raster.')
+    parser.add_argument('--case',dest='case',type=str,default=None,
+                        help=argparse.SUPPRESS)
 
     parser.add_argument('filenames', metavar='filenames', type=str,
-                        nargs='+', help='The file to read.')
+                        nargs='*', help='The file to read.')
 
     args=parser.parse_args()
 
+    if args.case:
+        print json.dumps(run_case(json.loads(args.case)))
+        sys.exit(0)
+
+    if args.bench:
+        filenames=list(args.filenames)
+        scratch=None
+        if args.synthetic:
+            scratch=tempfile.mkdtemp()
+            xsize,ysize=int_list(args.synthetic)
+            filenames.append(synthetic_raster(
+                os.path.join(scratch,'synthetic_%s.tif' % args.layout),
+                xsize,ysize,args.layout))
+        try:
+            results=benchmark(filenames,args.strategies.split(','),
+                              int_list(args.buffers),int_list(args.cache),
+                              args.states.split(','))
+        finally:
+            if scratch:
+                for f in os.listdir(scratch):
+                    os.remove(os.path.join(scratch,f))
+                os.rmdir(scratch)
+        print_table(results)
+        if args.json:
+            json.dump(results,open(args.json,'w'),indent=2)
+        sys.exit(0)
+
     if not args.filenames:
         print 'Is there a file you would like to read? I don\'t see it.'
         parser.print_help()
@@ -165,13 +413,19 @@ if __name__ == '__main__':
     if args.block:
         reader=read_by_block
 
+    if args.auto:
+        reader=read_by_layout
+
+    if args.prefetch:
+        reader=lambda x: read_by_prefetch(args.filenames[0],args.depth,
+                                          args.threads)
+
     if reader:
         byte_cnt=0
         for (x,y), line in reader(band):
-            byte_cnt+=line.size
+            byte_cnt+=line.nbytes
         logger.info('Read %d bytes' % byte_cnt)
     else:
-        print 'Give one option of line, multiline, block.%s' % os.linesep
+        print 'Give one option of line, multiline, block, auto, bench.%s' % \
+            os.linesep
         parser.print_help()
-
-
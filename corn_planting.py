@@ -10,7 +10,7 @@ import state_fips
 import emerge_fitter
 import state as state_dat
 import luconfig
-from memoize import memoized
+from memoize import memoized_with
 from default_parser import DefaultArgumentParser
 
 logger=logging.getLogger("corn_planting")
@@ -45,7 +45,7 @@ def typical_corn():
 
 
 
-@memoized
+@memoized_with(depends=lambda: [luconfig.get('corn_planted')])
 def planted_yearly_records():
     reader=csv.reader(open(luconfig.get('corn_planted'), "rU"))
     headers=reader.next()
@@ -96,18 +96,38 @@ def planted_year(year):
 
 
 
+def all_yearly_fits():
+    '''
+    Logistic fits to percent planted for every year and state with
+    more than two observations, all fit together. Returns a dictionary
+    from (year, state fips) to (mid, spread).
+    '''
+    days=collections.defaultdict(list)
+    percent=collections.defaultdict(list)
+    for r in planted_yearly_records():
+        days[(r['year'],r['fips'])].append(r['day'])
+        percent[(r['year'],r['fips'])].append(r['percent'])
+    keys=sorted([k for k in days if len(days[k])>2])
+    mids,spreads=emerge_fitter.fit_batch([(days[k],percent[k]) for k in keys])
+    return dict(zip(keys,zip(mids.tolist(),spreads.tolist())))
+
+
+
 def yearly_fit(year):
     '''
     This writes in a format suitable for R.
     '''
     state_info=state_dat.state_basics()
     by_state=planted_year(year)
-    fitter=emerge_fitter.emerge_fitter()
+    fit_states=[state for state in by_state if len(by_state[state][1])>2]
+    mids,spreads=emerge_fitter.fit_batch(
+        [(by_state[state][1],by_state[state][0]) for state in fit_states])
+    fits=dict(zip(fit_states,zip(mids.tolist(),spreads.tolist())))
 
     print 'year, fips, lat, long, minx, maxx, miny, maxy, mid, spread'
     for state, (percent, days) in by_state.iteritems():
         if len(days)>2:
-          mid, spread = fitter(days, percent)
+          mid, spread = fits[state]
           lat=state_info[state]['INTPTLAT10']
           lon=state_info[state]['INTPTLON10']
           b=state_info[state]['bounds']
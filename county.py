@@ -4,11 +4,13 @@ import itertools
 import csv
 import datetime
 import json
-import difflib
+import ConfigParser
 import shapefile
 import state_fips as statefips
+import county_match
 import logging
-from memoize import memoized
+import numpy as np
+from memoize import memoized, memoized_with
 import luconfig
 from default_parser import DefaultArgumentParser
 
@@ -30,52 +32,56 @@ def shift_comp(str0,str1):
 
 
 
-def find_county_in_state(county_name, state, possibles,all_matches):
-    for (code,names) in possibles:
-        if county_name==names[0] or county_name==names[1]:
-            return code
-    logger.warn('Did not find',county_name, state, difflib.get_close_matches(county_name,all_matches))
-    return 0
+def county_override_file():
+    try:
+        return luconfig.get('county_overrides')
+    except ConfigParser.NoOptionError:
+        return None
 
 
-def find_counties(names,shapefile_records):
+@memoized
+def county_resolver():
+    '''
+    Matches names of counties in states to geoids. See county_match.
+    '''
+    sh=shapefile.Reader(luconfig.get('county'))
+    columns=sh.columns(['STATEFP10','GEOID10','NAME10','NAMELSAD10'])
+    rows=zip(columns['STATEFP10'].astype(int).tolist(),
+             columns['GEOID10'].astype(int).tolist(),
+             zip(columns['NAME10'].tolist(),columns['NAMELSAD10'].tolist()))
+    return county_match.county_resolver(rows,county_override_file())
+
+
+def find_counties(names,shapefile_records=None):
+    '''
+    Geoids for a list of (two-letter state, county name), with 0 for
+    those not found. Without shapefile records, this uses the county
+    shapefile.
+    '''
     state_to_code=statefips.state_fips()
-    counties_in_state=counties_by_state(shapefile_records)
-    all_matches=dict()
-    for state,records in counties_in_state.items():
-        all_names=[x[1] for x in records]
-        flattened=itertools.chain.from_iterable(all_names)
-        together=list()
-        for f in flattened:
-                together.append(f)
-        all_matches[state]=together
-        logger.debug('state %d %d' % (state,len(together)))
+    if shapefile_records is None:
+        resolver=county_resolver()
+    else:
+        rows=[(r[0],r[3],[r[4],r[5]]) for r in shapefile_records]
+        resolver=county_match.county_resolver(rows,county_override_file())
 
     codes=list()
     for (state,county) in names:
-        state_fips=None
-        possibles=None
         code=0
         try:
-            state_fips=state_to_code[state]
+            code=resolver.resolve(state_to_code[state],county)
         except KeyError, e:
-            logger.warn('Could not find state', state,'for county',county)
-        if state_fips:
-            try:
-                possibles=counties_in_state[state_fips]
-            except KeyError, e:
-                logger.warn('Missing state_fips',state,'fips',state_fips)
-        if possibles:
-            code=find_county_in_state(county,state,possibles,
-                                      all_matches[state_fips])
+            logger.warn('Could not find state %s for county %s' %
+                        (state,county))
         codes.append(code)
+    resolver.save()
 
     assert(len(names)==len(codes))
     return codes
 
 
 def ccounty(county):
-    return county.replace('.','').strip().upper()
+    return county_match.clean_name(county)
 
 
 def counties_by_state(shapefile_records):
@@ -90,7 +96,15 @@ def counties_by_state(shapefile_records):
     return by_state
 
 
-@memoized
+def county_files():
+    '''
+    The parts of the county shapefile that county_basics reads.
+    '''
+    base=os.path.splitext(luconfig.get('county'))[0]
+    return ['%s.shp' % base, '%s.shx' % base, '%s.dbf' % base]
+
+
+@memoized_with(depends=county_files)
 def county_basics():
     '''
     Fields are:
@@ -104,9 +118,15 @@ def county_basics():
     fields=[x[0] for x in reader.fields]
     fields.remove('DeletionFlag')
 
-    for idx in range(reader.numRecords):
-        record=dict(zip(fields,reader.record(idx)))
-        record['bounds']=reader.shape(idx).bbox
+    # Decoding every polygon one point at a time just for its
+    # bounding box was most of the time spent here.
+    # columns() leaves out deleted records, so take their shapes out, too.
+    bounds=reader.shapes_array().bbox[reader.undeleted()].tolist()
+    columns=reader.columns(fields)
+    values=zip(*[columns[f].tolist() for f in fields])
+    for idx,row in enumerate(values):
+        record=dict(zip(fields,row))
+        record['bounds']=bounds[idx]
         counties[int(record['GEOID10'])]=record
     return counties
 
@@ -123,7 +143,7 @@ def county_coords(filename):
     out.close()
 
 
-def observation_counties(datafile,shape_records):
+def observation_counties(datafile,shape_records=None):
     logger.debug('reading datafile %s' % datafile)
     incidence=csv.reader(open(datafile,'rU'))
     observation_locations=list()
@@ -158,35 +178,25 @@ def lat_long_by_county(shape_record):
 
 def get_lat_long_by_county():
     sh=shapefile.Reader(luconfig.get('county'))
-    shape_records=sh.records()
-    lat_longs=lat_long_by_county(shape_records)
-    return lat_longs
+    columns=sh.columns(['GEOID10','INTPTLAT10','INTPTLON10'])
+    geoids=columns['GEOID10'].astype(int).tolist()
+    lats=columns['INTPTLAT10'].astype(float).tolist()
+    longs=columns['INTPTLON10'].astype(float).tolist()
+    return dict(zip(geoids,zip(lats,longs)))
 
 
 def observations_by_location(obs_file):
-    sh=shapefile.Reader(luconfig.get('county'))
-    shape_records=sh.records()
-    logger.debug('There are %d records in shapefile.' % len(shape_records))
-    county_code=observation_counties(obs_file,shape_records)
-    lat_longs=lat_long_by_county(shape_records)
-    idx=0
-
-    obs_by_location=list()
-    for line in csv.reader(open(obs_file,'rU')):
-        if line[0].isdigit():
-            if county_code[idx] is not 0:
-                try:
-                    obs_year=int(line[0].strip())
-                    obs_date=get_date(obs_year,line[3].strip())
-                except ValueError, e:
-                    logger.warn("%s %s" % (line,str(e)))
-                try:
-                    loc=lat_longs[county_code[idx]]
-                except KeyError, e:
-                    logger.warn("%s %s" % (line,e))
-                obs_by_location.append([obs_date,loc,county_code[idx]])
-            idx+=1
-    return obs_by_location
+    '''
+    List of [date, (lat, long), geoid] for each observation whose
+    date and county are known, from the cleaned observations in
+    rust_obs.
+    '''
+    import rust_obs
+    obs=rust_obs.observations(obs_file)
+    obs=obs[(obs['fips']>0) & ~np.isnat(obs['date'])]
+    dates=obs['date'].astype(object)
+    lat_longs=zip(obs['lat'].tolist(),obs['lon'].tolist())
+    return [list(x) for x in zip(dates,lat_longs,obs['fips'].tolist())]
 
 
 
@@ -253,14 +263,9 @@ def first_passage_by_year(obs):
 
 
 def get_first_passage():
-    obs_file=luconfig.get('cereal_rust')
-    obs=observations_by_location(obs_file)
-
-    # This writes the shapefile.
-    #write_obs_points(obs)
-
-    first_passage=first_passage_by_year(obs)
-    return first_passage
+    import rust_obs
+    table=rust_obs.load_table(luconfig.get('cereal_rust'))
+    return table.located().first_passage_by_year()
 
 
 def first_passage_to_R(filename):
@@ -332,13 +337,7 @@ if __name__ == '__main__':
         county_type = 'LSAD10' # city, borough, county, district, ... as a code.
 
     if args.showfirst:
-        obs_file=luconfig.get('cereal_rust')
-        obs=observations_by_location(obs_file)
-
-        # This writes the shapefile.
-        #write_obs_points(obs)
-
-        first_passage=first_passage_by_year(obs)
+        first_passage=get_first_passage()
         show_first_passage(first_passage)
         
     if args.showcounties:
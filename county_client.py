@@ -1,4 +1,112 @@
+'''
+Talks to county_server.py. fly.sh calls it once per county:
+
+  geoid=`python county_client.py --next`
+  python county_client.py --heartbeat --geoid $geoid
+  python county_client.py --done --geoid $geoid --seconds 312
+  python county_client.py --failed --geoid $geoid --message "exit 1"
+  python county_client.py --stats
+'''
+import os
+import socket
+import logging
 import xmlrpclib
+from default_parser import DefaultArgumentParser
+
+logger=logging.getLogger('county_client')
+
+DEFAULT_URL='http://localhost:8000/RPC2'
+
+
+def default_worker():
+    '''
+    The host name and the process id. A script that calls more than
+    once, like fly.sh, must pass its own --worker so the calls agree.
+    '''
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+
+class county_client(object):
+    '''
+    A worker's connection to the county server.
+    '''
+    def __init__(self, url=None, worker=None):
+        self.url=url or os.environ.get('COUNTY_SERVER',DEFAULT_URL)
+        self.worker=worker or default_worker()
+        self.server=xmlrpclib.ServerProxy(self.url, allow_none=True)
+
+    def next(self):
+        '''
+        The geoid of the next county to run, or 0 when there are none.
+        '''
+        return self.server.next_county(self.worker)
+
+    def heartbeat(self, geoid):
+        return self.server.heartbeat(geoid, self.worker)
+
+    def done(self, geoid, seconds=None):
+        return self.server.done(geoid, self.worker, seconds)
+
+    def failed(self, geoid, message=''):
+        return self.server.failed(geoid, self.worker, message)
+
+    def stats(self):
+        return self.server.stats()
+
+    def __iter__(self):
+        '''
+        Leases counties until the server has none left.
+        '''
+        geoid=self.next()
+        while geoid:
+            yield geoid
+            geoid=self.next()
+
+
+
+def print_stats(stats):
+    for name in ['total', 'done', 'pending', 'leased', 'given_up',
+                 'done_this_run', 'per_hour', 'mean_seconds', 'eta_seconds']:
+        print '%-15s %g' % (name, stats[name])
+
+
+
+if __name__ == '__main__':
+    parser=DefaultArgumentParser(description='client for county_server.py')
+    parser.add_function('next','print the next county to run, 0 if none')
+    parser.add_function('heartbeat','extend the lease on --geoid')
+    parser.add_function('done','report --geoid finished')
+    parser.add_function('failed','report --geoid failed')
+    parser.add_function('stats','print progress of the whole run')
+    parser.add_argument('--url',type=str,default=None,
+                        help='server address, else $COUNTY_SERVER or %s' %
+                        DEFAULT_URL)
+    parser.add_argument('--worker',type=str,default=None,
+                        help='name of this worker, else host:parent pid')
+    parser.add_argument('--geoid',type=int,help='the county')
+    parser.add_argument('--seconds',type=float,default=None,
+                        help='how long the county took')
+    parser.add_argument('--message',type=str,default='',
+                        help='why the county failed')
+    args=parser.parse_args()
+
+    client=county_client(args.url, args.worker)
+
+    if args.next:
+        print client.next()
+
+    if args.heartbeat:
+        client.heartbeat(args.geoid)
+
+    if args.done:
+        client.done(args.geoid, args.seconds)
+
+    if args.failed:
+        client.failed(args.geoid, args.message)
+
+    if args.stats:
+        print_stats(client.stats())
 
-s = xmlrpclib.ServerProxy('http://128.84.31.84:8000')
-print s.next_county(),
+    if not parser.any_function():
+        parser.print_help()
@@ -0,0 +1,192 @@
+'''
+Finds the geoid of a county from the state and county names written
+in the cereal rust observations.
+
+Exact names are looked up in a dictionary keyed by state fips and
+cleaned county name. When that fails, the names of the counties in
+the same state that share trigrams with the misspelling are ranked
+with difflib, so a miss compares against a few names instead of every
+county in the country. Suggestions for a misspelling are remembered,
+and each one is saved to the override table, a csv file with columns
+
+  state_fips,county,geoid,suggestions
+
+A row with a geoid of 0 is a name that was not found. Edit its geoid
+to say which county it means, and the next run will use it.
+'''
+import os
+import csv
+import difflib
+import tempfile
+import collections
+import logging
+import unittest
+import luconfig
+from default_parser import DefaultArgumentParser
+
+logger=logging.getLogger('county_match')
+
+_override_fields=['state_fips','county','geoid','suggestions']
+
+
+def clean_name(name):
+    return name.replace('.','').strip().upper()
+
+
+
+def trigrams(name):
+    '''
+    Overlapping triples of letters, with the name padded so that its
+    beginning and end count too.
+    '''
+    padded='  %s ' % name
+    return set(padded[i:i+3] for i in range(len(padded)-2))
+
+
+
+class county_resolver(object):
+    '''
+    rows is a list of (state_fips, geoid, names). overrides is the
+    path to an override table, which need not exist yet.
+    '''
+    def __init__(self,rows,overrides=None):
+        self.exact=dict()
+        self.names=collections.defaultdict(list)
+        # state fips -> trigram -> index of each name in self.names
+        self.grams=collections.defaultdict(
+            lambda: collections.defaultdict(list))
+        for state_fips,geoid,names in rows:
+            for name in names:
+                key=(int(state_fips),clean_name(name))
+                if key in self.exact:
+                    continue
+                self.exact[key]=int(geoid)
+                state_names=self.names[key[0]]
+                for gram in trigrams(key[1]):
+                    self.grams[key[0]][gram].append(len(state_names))
+                state_names.append(key[1])
+
+        self.suggested=dict()
+        self.overrides=dict()
+        self.override_file=overrides
+        self.changed=False
+        if overrides and os.path.exists(overrides):
+            for row in csv.DictReader(open(overrides,'rb')):
+                key=(int(row['state_fips']),row['county'])
+                self.overrides[key]=int(row['geoid'])
+                self.suggested[key]=[x for x in row['suggestions'].split(';')
+                                     if x]
+            logger.debug('read %d overrides from %s' %
+                         (len(self.overrides),overrides))
+
+
+    def suggest(self,state_fips,name,n=3,cutoff=0.6,candidates=20):
+        '''
+        The n closest names in the state, best first. Only the names
+        that share the most trigrams with this one are compared.
+        '''
+        key=(state_fips,clean_name(name))
+        if key in self.suggested:
+            return self.suggested[key]
+        shared=collections.defaultdict(int)
+        state_grams=self.grams.get(state_fips,dict())
+        for gram in trigrams(key[1]):
+            for idx in state_grams.get(gram,[]):
+                shared[idx]+=1
+        likely=sorted(shared,key=lambda idx: -shared[idx])[:candidates]
+        matcher=difflib.SequenceMatcher()
+        matcher.set_seq2(key[1])
+        scored=list()
+        for idx in likely:
+            matcher.set_seq1(self.names[state_fips][idx])
+            if (matcher.real_quick_ratio()>=cutoff and
+                    matcher.quick_ratio()>=cutoff):
+                ratio=matcher.ratio()
+                if ratio>=cutoff:
+                    scored.append((ratio,self.names[state_fips][idx]))
+        scored.sort(reverse=True)
+        self.suggested[key]=[x[1] for x in scored[:n]]
+        return self.suggested[key]
+
+
+    def resolve(self,state_fips,name):
+        '''
+        The geoid of the county, or 0 if it isn't known. A name that
+        isn't known is logged and added to the override table.
+        '''
+        key=(state_fips,clean_name(name))
+        if key in self.exact:
+            return self.exact[key]
+        if key in self.overrides:
+            return self.overrides[key]
+        suggestions=self.suggest(state_fips,name)
+        logger.warning('Did not find county %s in state %d, close to %s' %
+                       (key[1],state_fips,str(suggestions)))
+        self.overrides[key]=0
+        self.changed=True
+        return 0
+
+
+    def save(self):
+        '''
+        Write the override table, if anything was added to it.
+        '''
+        if not self.changed or not self.override_file:
+            return
+        directory=os.path.dirname(os.path.abspath(self.override_file))
+        handle,tmp_path=tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle,'wb') as out:
+            writer=csv.writer(out)
+            writer.writerow(_override_fields)
+            for key in sorted(self.overrides):
+                writer.writerow([key[0],key[1],self.overrides[key],
+                                 ';'.join(self.suggested.get(key,[]))])
+        os.rename(tmp_path,self.override_file)
+        self.changed=False
+        logger.info('wrote %d overrides to %s' %
+                    (len(self.overrides),self.override_file))
+
+
+
+def test_resolver():
+    rows=[(39,39049,['Franklin','Franklin County']),
+          (39,39035,['Cuyahoga','Cuyahoga County']),
+          (17,17163,['St. Clair','St. Clair County'])]
+    resolver=county_resolver(rows)
+    assert(resolver.resolve(39,'franklin')==39049)
+    assert(resolver.resolve(17,'ST CLAIR')==17163)
+    assert(resolver.resolve(17,'Franklin')==0)
+    assert(resolver.suggest(39,'CUYAHOGO')[0]=='CUYAHOGA')
+    assert(resolver.suggest(39,'XYZZY')==[])
+
+    table=os.path.join(tempfile.mkdtemp(),'overrides.csv')
+    resolver=county_resolver(rows,table)
+    resolver.resolve(39,'CUYAHOGO')
+    resolver.save()
+    lines=open(table).read().splitlines()
+    assert(lines[1].startswith('39,CUYAHOGO,0,CUYAHOGA'))
+    open(table,'w').write(lines[0]+os.linesep+
+                          lines[1].replace(',0,',',39035,')+os.linesep)
+    assert(county_resolver(rows,table).resolve(39,'Cuyahogo')==39035)
+
+
+
+def suite():
+    suite=unittest.TestSuite()
+    suite.addTest(unittest.FunctionTestCase(test_resolver))
+    return suite
+
+
+
+if __name__ == '__main__':
+    parser=DefaultArgumentParser(description='match county names',
+                                 suite=suite)
+    parser.add_function('show','show the override table')
+    args=parser.parse_args()
+
+    if args.show:
+        for line in open(luconfig.get('county_overrides')):
+            print line.rstrip()
+
+    if not parser.any_function():
+        parser.print_help()
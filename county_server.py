@@ -1,46 +1,494 @@
-import Queue
+'''
+Hands out counties to fly.sh workers over XMLRPC.
+
+Each county handed out is leased to a worker. A worker that finishes
+reports done or failed. A county whose lease runs out, because its
+worker crashed or was killed at the end of a PBS job, goes back on the
+queue. Every lease, completion and failure is appended to a journal,
+so a restarted server skips counties that are already done.
+
+  python county_server.py --serve --journal county_journal.csv
+
+Counties are handed out longest first. Their cost is estimated from
+the county shapefile and from how long counties took in earlier runs,
+as recorded in the journal. --schedule prints that order.
+'''
+import os
+import csv
+import time
+import socket
+import logging
+import threading
+import collections
+import SocketServer
+import numpy as np
 from SimpleXMLRPCServer import SimpleXMLRPCServer
 from SimpleXMLRPCServer import SimpleXMLRPCRequestHandler
+from default_parser import DefaultArgumentParser
+
+logger=logging.getLogger('county_server')
 
 
 counties=[1003, 1053, 1067, 1093, 5001, 5017, 5031, 5033, 5035, 5041, 5075, 5077, 5079, 5081, 5089, 5093, 5095, 5111, 5117, 5143, 6049, 6093, 6097, 8069, 8077, 12039, 13087, 13195, 13231, 13261, 13269, 13277, 16011, 16021, 16027, 16057, 16061, 17019, 17045, 17055, 17059, 17065, 17077, 17095, 17121, 17139, 17145, 17157, 17163, 17177, 17189, 17193, 17201, 18017, 18023, 18027, 18033, 18047, 18051, 18083, 18121, 18129, 18153, 18157, 18159, 18179, 19033, 19069, 19149, 19167, 20001, 20023, 20027, 20033, 20035, 20039, 20041, 20051, 20053, 20055, 20057, 20061, 20065, 20077, 20079, 20089, 20099, 20103, 20109, 20113, 20115, 20123, 20125, 20133, 20137, 20143, 20147, 20151, 20153, 20155, 20157, 20159, 20161, 20167, 20169, 20175, 20179, 20181, 20183, 20185, 20191, 20193, 20201, 20207, 20209, 21075, 21225, 22001, 22009, 22015, 22033, 22041, 22045, 22055, 22079, 22083, 22107, 22121, 22125, 26011, 26015, 26049, 26065, 26099, 26105, 26155, 27005, 27011, 27015, 27019, 27027, 27037, 27039, 27045, 27047, 27049, 27051, 27055, 27061, 27069, 27083, 27087, 27089, 27093, 27099, 27103, 27107, 27109, 27111, 27113, 27119, 27121, 27123, 27125, 27127, 27129, 27135, 27137, 27139, 27143, 27145, 27149, 27151, 27153, 27155, 27157, 27159, 27161, 27163, 27167, 27169, 28049, 28081, 28083, 28097, 28125, 28151, 29019, 29083, 29101, 29103, 29133, 29139, 29143, 29217, 30019, 30031, 30073, 30083, 30111, 31001, 31033, 31035, 31057, 31059, 31063, 31087, 31101, 31109, 31111, 31129, 31145, 31155, 31157, 31159, 31169, 31185, 36109, 37155, 38001, 38003, 38007, 38009, 38013, 38015, 38017, 38019, 38021, 38023, 38027, 38029, 38031, 38035, 38039, 38041, 38045, 38047, 38049, 38051, 38055, 38057, 38061, 38063, 38067, 38069, 38071, 38073, 38075, 38077, 38079, 38081, 38083, 38091, 38093, 38095, 38097, 38099, 38101, 38103, 38105, 39129, 39173, 40015, 40031, 40033, 40039, 40043, 40047, 40053, 40055, 40059, 40065, 40075, 40093, 40119, 40141, 40149, 40153, 41003, 41045, 41049, 41059, 41061, 41063, 41065, 45011, 46003, 46005, 46011, 46013, 46021, 46025, 46029, 46031, 46037, 46045, 46049, 46051, 46059, 46065, 46067, 46069, 46075, 46077, 46083, 46087, 46091, 46097, 46099, 46103, 46107, 46109, 46111, 46115, 46119, 46123, 46125, 46127, 46129, 46135, 47131, 48013, 48025, 48027, 48041, 48049, 48059, 48083, 48085, 48095, 48099, 48113, 48121, 48139, 48181, 48209, 48249, 48253, 48275, 48287, 48297, 48307, 48309, 48325, 48331, 48333, 48381, 48399, 48401, 48411, 48463, 48469, 48481, 48485, 48487, 48491, 48493, 48503, 49003, 51121, 51159, 53001, 53013, 53057, 53071, 53075, 54025, 54063, 54089, 55009, 55013, 55015, 55021, 55025, 55027, 55029, 55039, 55045, 55047, 55055, 55059, 55071, 55087, 55089, 55101, 55105, 55111, 55117, 55127, 55131, 55133, 55139]
 
+
+LEASE_SECONDS=30*60
+MAX_ATTEMPTS=3
+
+
 # Restrict to a particular path.
 class RequestHandler(SimpleXMLRPCRequestHandler):
     rpc_paths = ('/RPC2',)
 
-def next_county():
-    global county_queue
-    if not county_queue.empty():
-        geoid=county_queue.get()
-        print geoid
-        return geoid
+
+
+class threaded_server(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
+    '''
+    Answers each request on its own thread, so a slow client does not
+    hold up the others.
+    '''
+    daemon_threads=True
+    allow_reuse_address=True
+
+
+
+class work_queue(object):
+    '''
+    A queue of integer work items with leases. next() leases an item
+    to a worker for lease_seconds. done() and failed() end the lease.
+    A failed item, or one whose lease expires, is queued again until it
+    has been tried max_attempts times. All methods hold a lock, so the
+    threaded server can call them at once.
+
+    If journal names a file, events are appended to it as
+    time,event,item,worker,seconds,message and replayed on startup.
+    '''
+    def __init__(self, items, journal=None, lease_seconds=LEASE_SECONDS,
+                 max_attempts=MAX_ATTEMPTS, clock=time.time):
+        self.lock=threading.Lock()
+        self.clock=clock
+        self.lease_seconds=lease_seconds
+        self.max_attempts=max_attempts
+        self.items=list(items)
+        self.attempts=collections.defaultdict(int)
+        self.finished=dict()
+        self.given_up=dict()
+        self.leases=dict()
+        self.started=clock()
+        self.done_this_run=0
+        self.seconds_this_run=0.0
+        self.journal_name=journal
+        if journal and os.path.exists(journal):
+            self.replay(journal)
+        self.pending=collections.deque([x for x in self.items
+            if x not in self.finished and x not in self.given_up])
+        self.journal=None
+        if journal:
+            self.journal=open(journal,'ab')
+            self.writer=csv.writer(self.journal)
+        logger.info('%d items, %d done, %d given up, %d to do' %
+                    (len(self.items), len(self.finished),
+                     len(self.given_up), len(self.pending)))
+
+
+    def replay(self, journal):
+        for row in csv.reader(open(journal,'rb')):
+            if len(row)<6: continue
+            event=row[1]
+            item=int(row[2])
+            if event=='done':
+                self.finished[item]=float(row[4] or 0)
+                self.given_up.pop(item,None)
+            elif event=='failed':
+                self.attempts[item]+=1
+            elif event=='gave_up':
+                self.given_up[item]=row[5]
+            elif event=='expired':
+                self.attempts[item]+=1
+
+
+    def record(self, event, item, worker='', seconds='', message=''):
+        if self.journal:
+            self.writer.writerow(['%.3f' % self.clock(), event, item,
+                                  worker, seconds, message])
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+
+    def requeue_expired(self):
+        now=self.clock()
+        for item, (worker, start, expires) in self.leases.items():
+            if expires<now:
+                del self.leases[item]
+                logger.warning('lease on %d by %s expired' % (item, worker))
+                self.record('expired', item, worker)
+                self.retry(item, 'lease expired')
+
+
+    def retry(self, item, message):
+        self.attempts[item]+=1
+        if self.attempts[item]>=self.max_attempts:
+            self.given_up[item]=message
+            self.record('gave_up', item, message=message)
+            logger.error('giving up on %d after %d attempts: %s' %
+                         (item, self.attempts[item], message))
+        else:
+            self.pending.append(item)
+
+
+    def next(self, worker=''):
+        '''
+        The next item, leased to worker, or 0 if there is none now.
+        '''
+        with self.lock:
+            self.requeue_expired()
+            if not self.pending:
+                return 0
+            item=self.pending.popleft()
+            now=self.clock()
+            self.leases[item]=(worker, now, now+self.lease_seconds)
+            self.record('leased', item, worker)
+            logger.info('%d to %s' % (item, worker))
+            return item
+
+
+    def holds(self, item, worker):
+        '''
+        Whether worker may report on item, which it can if it holds
+        the lease or nobody does. Call with the lock held.
+        '''
+        return item not in self.leases or self.leases[item][0]==worker
+
+
+    def heartbeat(self, item, worker=''):
+        '''
+        Extend the lease on item. False if worker no longer holds it.
+        '''
+        with self.lock:
+            if item not in self.leases or self.leases[item][0]!=worker:
+                return False
+            start=self.leases[item][1]
+            self.leases[item]=(worker, start, self.clock()+self.lease_seconds)
+            return True
+
+
+    def done(self, item, worker='', seconds=None):
+        '''
+        Record item as finished, taking seconds as its run time or
+        else the time since it was leased. False if another worker
+        holds the lease, because that one is running it now.
+        '''
+        with self.lock:
+            if not self.holds(item, worker):
+                logger.warning('%s finished %d leased to %s' %
+                               (worker, item, self.leases[item][0]))
+                return False
+            lease=self.leases.pop(item,None)
+            if seconds is None:
+                seconds=self.clock()-lease[1] if lease else 0.0
+            seconds=float(seconds)
+            if item in self.pending:
+                self.pending.remove(item)
+            self.given_up.pop(item,None)
+            self.finished[item]=seconds
+            self.done_this_run+=1
+            self.seconds_this_run+=seconds
+            self.record('done', item, worker, '%.3f' % seconds)
+            logger.info('%d done by %s in %g s' % (item, worker, seconds))
+            return True
+
+
+    def failed(self, item, worker='', message=''):
+        '''
+        Record a failure of item, which is tried again unless it has
+        failed too often. False if worker doesn't hold the lease, as
+        when it expired and item went back on the queue, or is done,
+        in which case the report is kept but item isn't tried again.
+        '''
+        with self.lock:
+            if item not in self.leases or self.leases[item][0]!=worker:
+                logger.warning('late failure of %d from %s' % (item, worker))
+                self.record('late_failure', item, worker, message=message)
+                return False
+            del self.leases[item]
+            self.record('failed', item, worker, message=message)
+            self.retry(item, message)
+            return True
+
+
+    def stats(self):
+        '''
+        Counts, throughput in items per hour this run, and estimated
+        seconds to finish given the workers now holding leases.
+        '''
+        with self.lock:
+            self.requeue_expired()
+            elapsed=self.clock()-self.started
+            remaining=len(self.pending)+len(self.leases)
+            rate=self.done_this_run/elapsed if elapsed>0 else 0.0
+            eta=remaining/rate if rate>0 else -1.0
+            mean=(self.seconds_this_run/self.done_this_run
+                  if self.done_this_run else 0.0)
+            return {'total' : len(self.items), 'pending' : len(self.pending),
+                    'leased' : len(self.leases), 'done' : len(self.finished),
+                    'given_up' : len(self.given_up),
+                    'done_this_run' : self.done_this_run,
+                    'elapsed' : elapsed, 'per_hour' : 3600*rate,
+                    'mean_seconds' : mean, 'eta_seconds' : eta}
+
+
+    def count(self):
+        with self.lock:
+            return len(self.pending)
+
+
+    def close(self):
+        if self.journal:
+            self.journal.close()
+            self.journal=None
+
+
+
+def county_features(geoids, shapefile_name=None):
+    '''
+    Land area, bounding box area in square degrees and vertex count
+    of each county in geoids, as arrays in the same order.
+    '''
+    import shapefile
+    import luconfig
+    reader=shapefile.Reader(shapefile_name or luconfig.get('county'))
+    columns=reader.columns(['GEOID10','ALAND10'])
+    shapes=reader.shapes_array()
+    row=dict(zip(columns['GEOID10'].astype(np.int64).tolist(),
+                 range(len(columns['GEOID10']))))
+    missing=[g for g in geoids if g not in row]
+    if missing:
+        raise KeyError('Counties not in shapefile: %s' % str(missing))
+    rows=np.array([row[g] for g in geoids],dtype=np.int64)
+    # Rows count undeleted records, and the shapes include deleted ones.
+    shape_rows=reader.undeleted()[rows]
+    bbox=shapes.bbox[shape_rows]
+    vertices=np.diff(shapes.pointOffsets)[shape_rows]
+    return {'aland' : columns['ALAND10'][rows].astype(np.float64),
+            'bbox_area' : (bbox[:,2]-bbox[:,0])*(bbox[:,3]-bbox[:,1]),
+            'vertices' : vertices.astype(np.float64)}
+
+
+
+def journal_timings(journal):
+    '''
+    Seconds each county took, from done events in a journal, keeping
+    the latest run of each.
+    '''
+    timings=dict()
+    if journal and os.path.exists(journal):
+        for row in csv.reader(open(journal,'rb')):
+            if len(row)>=6 and row[1]=='done' and row[4]:
+                timings[int(row[2])]=float(row[4])
+    return timings
+
+
+
+def estimate_costs(features, measured):
+    '''
+    Estimated seconds for each county. log(seconds) is fit as a
+    linear function of the logs of the features, over counties whose
+    time was measured. With too few measurements to fit, the cost is
+    the geometric mean of the features, each relative to its median,
+    scaled by the typical ratio of measured time to that mean.
+    Measured counties keep their measured time.
+    '''
+    names=['aland','bbox_area','vertices']
+    logs=np.column_stack([np.log(np.maximum(features[n],1e-12))
+                          for n in names])
+    seen=~np.isnan(measured)
+    if seen.sum()>2*(len(names)+1):
+        import ols
+        model=ols.ols(np.log(np.maximum(measured[seen],1e-3)),logs[seen],
+                      'log_seconds',names)
+        logger.info('cost model coefficients %s, R2 %g' %
+                    (str(model.b), model.R2))
+        cost=np.exp(model.b[0]+np.dot(logs,model.b[1:]))
     else:
-        return 0
+        logger.info('%d measured counties, too few to fit costs' %
+                    seen.sum())
+        cost=np.exp((logs-np.median(logs,axis=0)).mean(axis=1))
+        if seen.any():
+            # Put them in seconds so they compare with measured counties.
+            cost*=np.median(measured[seen]/cost[seen])
+    return np.where(seen,measured,cost)
+
+
+
+def makespan(costs, workers):
+    '''
+    When the last worker finishes if each of workers takes the next
+    item in costs as soon as it is free.
+    '''
+    free=np.zeros(workers)
+    for c in costs:
+        idx=free.argmin()
+        free[idx]+=c
+    return free.max()
+
+
+
+def schedule(geoids, journal=None, shapefile_name=None):
+    '''
+    geoids sorted longest first, with the estimated cost of each.
+    '''
+    geoids=list(geoids)
+    timings=journal_timings(journal)
+    measured=np.array([timings.get(g,np.nan) for g in geoids])
+    costs=estimate_costs(county_features(geoids,shapefile_name),measured)
+    order=np.argsort(-costs,kind='mergesort')
+    return [geoids[i] for i in order], costs[order]
+
 
-def count():
-    global county_queue
-    return county_queue.qsize()
 
+def print_schedule(geoids, journal=None, workers=8):
+    ordered, costs=schedule(geoids, journal)
+    by_geoid=dict(zip(ordered,costs.tolist()))
+    timings=journal_timings(journal)
+    print 'rank\tgeoid\tcost\tmeasured\tfips rank'
+    fips_rank=dict([(g,idx) for idx,g in enumerate(geoids)])
+    for rank,(g,c) in enumerate(zip(ordered,costs.tolist())):
+        print '%d\t%d\t%.1f\t%s\t%d' % (rank, g, c,
+            timings.get(g,''), fips_rank[g])
+    as_given=makespan([by_geoid[g] for g in geoids],workers)
+    longest=makespan(costs,workers)
+    print 'estimated makespan on %d workers: %.0f s in given order, '\
+          '%.0f s longest first' % (workers, as_given, longest)
 
-def serve():
-    global county_queue
-    county_queue=Queue.Queue()
-    for c in counties:
-        county_queue.put(c)
 
-    # Create server
-    server = SimpleXMLRPCServer(("128.84.31.84", 8000),
-                                requestHandler=RequestHandler)
+
+def serve(items=counties, host='localhost', port=8000, journal=None,
+          lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+    queue=work_queue(items, journal, lease_seconds, max_attempts)
+    server=threaded_server((host, port), requestHandler=RequestHandler,
+                           logRequests=False, allow_none=True)
     server.register_introspection_functions()
-    
-    # Register pow() function; this will use the value of
-    # pow.__name__ as the name, which is just 'pow'.
-    server.register_function(next_county)
-    server.register_function(count)
-    
-    # Run the server's main loop
-    server.serve_forever()
+    server.register_function(queue.next, 'next_county')
+    server.register_function(queue.heartbeat, 'heartbeat')
+    server.register_function(queue.done, 'done')
+    server.register_function(queue.failed, 'failed')
+    server.register_function(queue.stats, 'stats')
+    server.register_function(queue.count, 'count')
+    logger.info('serving on %s:%d' % (host, port))
+    try:
+        server.serve_forever()
+    finally:
+        queue.close()
+
+
+
+def test_work_queue():
+    import tempfile
+    now=[0.0]
+    clock=lambda: now[0]
+    directory=tempfile.mkdtemp()
+    journal=os.path.join(directory,'journal.csv')
+    queue=work_queue([1,2,3], journal, lease_seconds=10, max_attempts=2,
+                     clock=clock)
+    assert(queue.next('a')==1)
+    assert(queue.next('b')==2)
+    assert(queue.done(1,'a'))
+    assert(queue.failed(2,'b','bad'))
+    now[0]=5.0
+    assert(queue.next('a')==3)
+    now[0]=20.0
+    # 3's lease has expired, so it comes back after 2.
+    assert(queue.next('c')==2)
+    assert(queue.next('c')==3)
+    assert(queue.heartbeat(3,'c'))
+    assert(not queue.heartbeat(3,'a'))
+    # a lost 3 when its lease expired, so its reports don't count.
+    assert(not queue.done(3,'a'))
+    assert(not queue.failed(3,'a','late'))
+    assert(queue.stats()['leased']==2)
+    assert(queue.done(3,'c',4.0))
+    queue.failed(2,'c','bad again')
+    stats=queue.stats()
+    assert(stats['done']==2 and stats['given_up']==1 and stats['pending']==0)
+    queue.close()
+
+    restarted=work_queue([1,2,3,4], journal, clock=clock)
+    assert(restarted.next('d')==4)
+    assert(restarted.next('d')==0)
+    restarted.close()
+
+    # Failures reported after a lease expired, or after the item was
+    # done, don't put it back on the queue or count as an attempt.
+    late=work_queue([1,2], lease_seconds=10, max_attempts=3, clock=clock)
+    now[0]=100.0
+    assert(late.next('w1')==1)
+    now[0]=120.0
+    late.requeue_expired()
+    assert(list(late.pending)==[2,1])
+    assert(not late.failed(1,'w1','late'))
+    assert(list(late.pending)==[2,1] and late.attempts[1]==1)
+    assert(late.next('w2')==2)
+    assert(late.done(2,'w2'))
+    assert(not late.failed(2,'w1','stale'))
+    assert(list(late.pending)==[1] and 2 in late.finished)
+    late.close()
+    os.remove(journal)
+    os.rmdir(directory)
+
+
+
+def test_schedule():
+    features={'aland' : np.array([1.0,100.0,10.0]),
+              'bbox_area' : np.array([1.0,100.0,10.0]),
+              'vertices' : np.array([10.0,1000.0,100.0])}
+    measured=np.array([np.nan,np.nan,50.0])
+    costs=estimate_costs(features,measured)
+    assert(costs[1]>costs[0] and costs[2]==50.0)
+    assert(makespan([5,1,1,1,1,1],2)==5)
+    assert(makespan([1,1,1,1,1,5],2)==7)
+
+
+
+def suite():
+    import unittest
+    suite=unittest.TestSuite()
+    suite.addTest(unittest.FunctionTestCase(test_work_queue))
+    suite.addTest(unittest.FunctionTestCase(test_schedule))
+    return suite
+
+
 
 if __name__ == '__main__':
-    serve()
+    parser=DefaultArgumentParser(description='hand out counties to workers',
+                                 suite=suite)
+    parser.add_function('serve','run the county server')
+    parser.add_function('schedule','print the order counties will go out')
+    parser.add_argument('--host',type=str,default='localhost',
+                        help='address to listen on')
+    parser.add_argument('--port',type=int,default=8000,
+                        help='port to listen on')
+    parser.add_argument('--journal',type=str,default='county_journal.csv',
+                        help='file recording what finished')
+    parser.add_argument('--lease',type=float,default=LEASE_SECONDS,
+                        help='seconds before an unfinished county is requeued')
+    parser.add_argument('--attempts',type=int,default=MAX_ATTEMPTS,
+                        help='times to try a county before giving up')
+    parser.add_argument('--order',type=str,default='cost',
+                        choices=['cost','fips'],
+                        help='hand out longest first or in fips order')
+    parser.add_argument('--workers',type=int,default=8,
+                        help='workers assumed when printing the schedule')
+    args=parser.parse_args()
+
+    if args.schedule:
+        print_schedule(counties, args.journal, args.workers)
+
+    if args.serve:
+        items=counties
+        if args.order=='cost':
+            items=schedule(counties, args.journal)[0]
+        serve(items, args.host, args.port, args.journal, args.lease,
+              args.attempts)
+
+    if not parser.any_function():
+        parser.print_help()
@@ -1,26 +1,175 @@
+'''
+Fits a logistic curve to percent emergence, or percent planted, by
+day of the year,
+
+  percent = 100 / (1 + exp(-(day - avg) / spread))
+
+and returns (avg, spread). This used to call emergence_fit.R through
+rpy2. Now fit_batch() fits many curves at once with Levenberg-Marquardt
+steps on padded arrays, one row per curve, so a whole dataset of
+(state, year) curves is one numpy computation.
+'''
 import logging
-import rpy2
-import rpy2.robjects as robjects
+import numpy as np
 
 logger=logging.getLogger('emerge_fitter')
 
 
-class emerge_fitter(object):
+def logistic(days,avg,spread):
+    days=np.asarray(days,dtype=np.float64)
+    return 100.0/(1.0+np.exp(-(days-avg)/spread))
+
+
+
+def pad_curves(curves):
+    '''
+    curves is a list of (days, percent). Returns days, percent and a
+    mask of which entries are data, each of shape (len(curves), most
+    observations in any curve).
+    '''
+    width=max([len(days) for (days,percent) in curves]+[1])
+    days=np.zeros((len(curves),width))
+    percent=np.zeros((len(curves),width))
+    mask=np.zeros((len(curves),width),dtype=np.bool)
+    for idx,(d,p) in enumerate(curves):
+        if len(d)!=len(p):
+            raise ValueError('Curve %d has %d days but %d percents.' %
+                             (idx,len(d),len(p)))
+        days[idx,:len(d)]=d
+        percent[idx,:len(p)]=p
+        mask[idx,:len(d)]=True
+    return days,percent,mask
+
+
+
+def initial_guess(days,percent,mask):
+    '''
+    A straight line fit of the logit of the points strictly between
+    0 and 100 percent gives 1/spread as slope and -avg/spread as
+    intercept.
+    '''
+    use=mask & (percent>0) & (percent<100)
+    logit=np.zeros_like(percent)
+    logit[use]=np.log(percent[use]/(100.0-percent[use]))
+    n=use.sum(axis=1).astype(np.float64)
+    safe_n=np.maximum(n,1)
+    mean_x=np.where(use,days,0).sum(axis=1)/safe_n
+    mean_y=np.where(use,logit,0).sum(axis=1)/safe_n
+    dx=np.where(use,days-mean_x[:,np.newaxis],0)
+    dy=np.where(use,logit-mean_y[:,np.newaxis],0)
+    sxx=(dx*dx).sum(axis=1)
+    slope=(dx*dy).sum(axis=1)/np.where(sxx>0,sxx,1)
+
+    # Without two interior points, start from the spread of the days.
+    count=np.maximum(mask.sum(axis=1),1)
+    all_mean=np.where(mask,days,0).sum(axis=1)/count
+    all_std=np.sqrt(np.where(mask,(days-all_mean[:,np.newaxis])**2,0).sum(
+        axis=1)/count)
+    good=(n>=2) & (slope>0)
+    spread=np.where(good,1.0/np.where(good,slope,1),
+                    np.maximum(all_std/2,1.0))
+    avg=np.where(good,mean_x-mean_y*spread,all_mean)
+    return avg,spread
+
+
+
+def fit_batch(curves,iterations=200,tolerance=1e-10):
     '''
-    This calls an R routine to do a logistic fit to the 
-    wheat emergence data. It starts an R process."
+    Fit every (days, percent) in curves. Returns arrays avg and
+    spread, with nan for curves that can't be fit, which are those
+    with fewer than two points or with no change in percent.
     '''
-    def __init__(self):
-        robjects.r.source("emergence_fit.R")
-        self._ecf=robjects.globalenv['emergence.coeffs']
-        self._iv=robjects.IntVector
+    if not curves:
+        return np.zeros(0),np.zeros(0)
+    days,percent,mask=pad_curves(curves)
+    avg,spread=initial_guess(days,percent,mask)
+    damping=np.ones(len(curves))*1e-3
+
+    def cost(avg,spread):
+        err=np.where(mask,logistic(days,avg[:,np.newaxis],
+                                   spread[:,np.newaxis])-percent,0)
+        return err,(err*err).sum(axis=1)
+
+    err,sse=cost(avg,spread)
+    active=np.ones(len(curves),dtype=np.bool)
+    for iteration in range(iterations):
+        z=(days-avg[:,np.newaxis])/spread[:,np.newaxis]
+        # The derivative of the logistic, 100 s(z) s(-z), without overflow.
+        slope=np.where(mask,
+                       100.0*np.exp(-np.logaddexp(0,z)-np.logaddexp(0,-z)),0)
+        jac_avg=-slope/spread[:,np.newaxis]
+        jac_spread=jac_avg*z
+        # Normal equations for each curve, with Marquardt's damping.
+        a=(jac_avg*jac_avg).sum(axis=1)
+        b=(jac_avg*jac_spread).sum(axis=1)
+        c=(jac_spread*jac_spread).sum(axis=1)
+        ga=(jac_avg*err).sum(axis=1)
+        gc=(jac_spread*err).sum(axis=1)
+        a_d=a*(1+damping)+1e-12
+        c_d=c*(1+damping)+1e-12
+        det=a_d*c_d-b*b
+        det=np.where(np.abs(det)>0,det,1e-12)
+        step_avg=-(c_d*ga-b*gc)/det
+        step_spread=-(a_d*gc-b*ga)/det
+
+        new_avg=np.where(active,avg+step_avg,avg)
+        new_spread=np.where(active,spread+step_spread,spread)
+        new_spread=np.where(new_spread>0,new_spread,spread/2)
+        new_err,new_sse=cost(new_avg,new_spread)
+        better=active & (new_sse<=sse)
+        converged=better & (sse-new_sse<=tolerance*(1+sse))
+        avg=np.where(better,new_avg,avg)
+        spread=np.where(better,new_spread,spread)
+        err=np.where(better[:,np.newaxis],new_err,err)
+        sse=np.where(better,new_sse,sse)
+        damping=np.where(better,damping/10,damping*10)
+        active&=~converged & (damping<1e10)
+        if not np.any(active):
+            break
+    logger.debug('fit %d curves in %d iterations' % (len(curves),iteration+1))
 
+    points=mask.sum(axis=1)
+    flat=np.array([len(p)==0 or np.ptp(p)==0 for (d,p) in curves])
+    failed=(points<2) | flat | ~np.isfinite(avg) | ~np.isfinite(spread)
+    if np.any(failed):
+        logger.warning('Could not fit %d of %d curves' %
+                       (failed.sum(),len(curves)))
+    avg=np.where(failed,np.nan,avg)
+    spread=np.where(failed,np.nan,spread)
+    return avg,spread
+
+
+
+class emerge_fitter(object):
+    '''
+    Fits one curve at a time, as the R version did.
+    fitter(days, percent) returns (avg, spread).
+    '''
     def __call__(self,days,percent):
-        try:
-            avg, spread=self._ecf(self._iv(days),self._iv(percent))
-        except rpy2.rinterface.RRuntimeError, e:
-            logger.exception(e)
+        avg,spread=fit_batch([(days,percent)])
+        if not np.isfinite(avg[0]):
             logger.info('input days %s' % str(days))
             logger.info('input percent %s' % str(percent))
-            raise
+            raise ValueError('Cannot fit a logistic curve to these data.')
         return float(avg[0]), float(spread[0])
+
+
+
+def test_fit_batch():
+    days=np.arange(100,200,7)
+    curves=list()
+    for avg,spread in [(140,5),(150,10),(170,3),(130,20)]:
+        curves.append((days,np.round(logistic(days,avg,spread))))
+    avg,spread=fit_batch(curves)
+    assert(np.all(np.abs(avg-[140,150,170,130])<1))
+    assert(np.all(np.abs(spread-[5,10,3,20])/[5,10,3,20]<0.1))
+    avg,spread=fit_batch([(days[:1],[50]),(days[:3],[20,20,20])])
+    assert(np.all(np.isnan(avg)))
+
+
+
+def suite():
+    import unittest
+    suite=unittest.TestSuite()
+    suite.addTest(unittest.FunctionTestCase(test_fit_batch))
+    return suite
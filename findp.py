@@ -19,18 +19,22 @@ import os.path
 import subprocess
 import traceback
 import collections
+import multiprocessing
 import numpy as np
 try:
     import qgis.core as qcore
     import qgis.utils
 except ImportError,e:
     print 'Could not load qgis. That may be OK.'
-import struct
 import gdal
 from gdalconst import *
+import time
+import tempfile
 import logging
 import logging.handlers
 from argparse import ArgumentParser
+import luconfig
+import raster_blocks
 try:
     import PyQt4.QtGui
     import PyQt4.QtCore
@@ -142,11 +146,8 @@ def crop_data(filename):
     
     print 'xsize:',band.XSize, 'ysize:',band.YSize
 
-    for yidx in range(band.YSize):
-        scanline=band.ReadRaster(0,yidx,band.XSize,1,band.YSize,1,GDT_Byte)
-        print len(scanline)
-        tb=struct.unpack('B'*band.YSize,scanline)
-        if not all([x is 0 for x in tb]):
+    for (xidx,yidx),line in raster_blocks.iterate(band,strategy='line'):
+        if line.any():
             print "Found something nonzero", yidx
             return ds
 
@@ -463,106 +464,225 @@ def wheat_codes_gdalinfo(pattern='Wheat|Wht',filename='2011_30m_cdls.img'):
 
 
 
+def block_sum(values,factor,dtype=np.int32):
+    '''
+    Sum values over factor by factor windows with a reshape, so each
+    output is one cell of an image factor times smaller. Windows that
+    hang over the right or bottom edge sum the part that is there.
+    '''
+    rows,cols=values.shape
+    full_r=rows-rows%factor
+    full_c=cols-cols%factor
+    out=np.zeros(((rows-1)//factor+1,(cols-1)//factor+1),dtype=dtype)
+    out_r=full_r//factor
+    out_c=full_c//factor
+    out[:out_r,:out_c]=values[:full_r,:full_c].reshape(
+        out_r,factor,out_c,factor).sum(axis=(1,3),dtype=dtype)
+    if full_c<cols:
+        out[:out_r,-1]=values[:full_r,full_c:].reshape(
+            out_r,factor,cols-full_c).sum(axis=(1,2),dtype=dtype)
+    if full_r<rows:
+        out[-1,:out_c]=values[full_r:,:full_c].reshape(
+            rows-full_r,out_c,factor).sum(axis=(0,2),dtype=dtype)
+        if full_c<cols:
+            out[-1,-1]=values[full_r:,full_c:].sum(dtype=dtype)
+    return out
+
+
+
+def density_byte(counts,subset):
+    '''
+    Wheat pixel counts in subset by subset windows as bytes, where
+    255 is a window that is all wheat.
+    '''
+    area=subset*subset
+    return ((counts.astype(np.int64)*255+area//2)//area).astype(np.uint8)
+
+
+
+def pyramid_files(outfile,levels):
+    '''
+    One output name per level. outfile may contain %d for the level,
+    or else the level is put before its extension.
+    '''
+    if not outfile: outfile=luconfig.get('just_wheat')
+    if '%d' not in outfile:
+        if len(levels)==1:
+            return {levels[0] : outfile}
+        base,ext=os.path.splitext(outfile)
+        outfile=base+'_%d'+ext
+    return dict([(level,outfile % level) for level in levels])
+
+
+
+def wheat_pyramid(filename,outfile=None,levels=(16,32,64,128),
+                  codes=wheatish):
+    '''
+    Take the cdl and make rasters of wheat density at several
+    resolutions, each pixel the density of wheat in a level by level
+    window, in one pass over the cdl. Reads strips as tall as the
+    largest level, turns codes into 0 or 1 with a lookup table, sums
+    the finest windows by reshaping, and sums those for coarser levels.
+    Every level must be a multiple of the smallest.
+    '''
+    levels=sorted(levels)
+    finest=levels[0]
+    if [l for l in levels if l%finest]:
+        raise ValueError('Levels %s must be multiples of %d' %
+                         (str(levels),finest))
+    strip_rows=levels[-1]
+    if [l for l in levels if strip_rows%l]:
+        raise ValueError('Levels %s must divide %d' % (str(levels),strip_rows))
+
+    ds=gdal.Open(filename,GA_ReadOnly)
+    logger.debug('opened %s' % filename)
+    band=ds.GetRasterBand(1)
+    logger.info('xsize: %d ysize: %d' % (band.XSize,band.YSize))
+
+    names=pyramid_files(outfile,levels)
+    outputs=dict()
+    for level in levels:
+        ds2,x,y=create_copy(ds,level,names[level])
+        logger.debug('created %s dim %d %d for level %d' %
+                     (names[level],x,y,level))
+        outputs[level]=ds2
+
+    lut=(wheat_lut(codes)>0).astype(np.uint8)
+    for (xidx,yidx),strip in raster_blocks.iterate(band,strategy='strip',
+                                                   rows=strip_rows):
+        apply_lut(lut,strip)
+
+        counts=block_sum(strip,finest)
+        for level in levels:
+            if level>finest:
+                level_counts=block_sum(counts,level//finest)
+            else:
+                level_counts=counts
+            outputs[level].GetRasterBand(1).WriteArray(
+                density_byte(level_counts,level),0,yidx//level)
+
+        if (yidx//strip_rows)%10==0:
+            logger.debug('at y %d out of %d' % (yidx,band.YSize))
+
+    # Recommended way to close the file.
+    for level in levels:
+        outputs[level]=None
+    return names
+
+
+
 def condense_crop(filename,subset=16):
     '''
     Take the nlcd and pull out just the density of wheat.
     Make a smaller image with a grayscale byte value.
     '''
+    wheat_pyramid(filename,None,[subset])
+
+
+
+
+
+def wheat_from_cdl(filename,outfile,inset=None,
+                   max_bytes=raster_blocks.STRIP_BYTES,
+                   codes=wheatish):
+    '''
+    Pull wheat values out of crop dataland layer, but just pixel
+    for pixel, not subsetting. Reads and writes strips of rows, as
+    many as fit in max_bytes, writing each strip as soon as it is
+    masked, so memory does not grow with the size of the image.
+    '''
     ds=gdal.Open(filename,GA_ReadOnly)
     logger.debug('opened %s' % filename)
-    ds2,x,y=create_copy(ds,subset)
+    ds2,x,y=create_copy(ds,1,outfile,inset)
     logger.debug('created copy %s dim %d %d' % (str(ds2),x,y))
-
-    raster = np.zeros( (y,x), dtype=np.uint8 )
+    ds2.SetGeoTransform(ds.GetGeoTransform())
+    ds2.SetProjection(ds.GetProjection())
 
     band=ds.GetRasterBand(1)
-    
-    logger.info('xsize: %d ysize: %d' % (band.XSize,band.YSize))
-    bins=np.arange(256)
-    inhist=np.zeros(len(bins)-1)
+    write_band=ds2.GetRasterBand(1)
+    rows=raster_blocks.strip_height(x,band.GetBlockSize()[1],max_bytes)
 
+    logger.info('incoming xsize: %d ysize: %d' % (band.XSize,band.YSize))
+    logger.info('outgoing xsize: %d ysize: %d in strips of %d rows' %
+                (x,y,rows))
 
-    maxwheat=0
-    # Don't worry about not being divisible by 32 on last pixels.
-    # Mostly water.
-    for yidx in range(0,band.YSize-(band.YSize%subset),subset):
-        #logger.debug('reading band %d scanline len %d' % (yidx,len(scanline)))
-
-        dat=np.zeros((subset,band.XSize),dtype=np.uint8)
-        for lineidx in range(subset):
-            scanline=band.ReadRaster(0,yidx+lineidx,band.XSize,1,
-                                 band.XSize,1,GDT_Byte)
-            ar=np.array(struct.unpack('B'*band.XSize,scanline),
-                        dtype=np.uint8)
-            dat[lineidx,:]=ar
-            inhist+=np.histogram(ar,bins)[0]
-
-        for xidx in range(0,band.XSize-(band.XSize%subset),subset):
-            subarray=dat[0:subset,xidx:(xidx+subset)]
-            flat=subarray.flatten()
-            if flat is None or len(flat)<subset*subset:
-                logger.debug('xidx: %d yidx: %d len(sub): %d' % (xidx,yidx,
-                                                                 len(flat)))
-            counts=np.bincount(flat) # np version 1.6 has a minlength option
-            val=np.sum(np.append(counts,np.zeros(255-len(counts)))[wheatish])
-            if val>maxwheat:
-                maxwheat=val
-                logger.debug('max wheat value %d' % maxwheat)
-            raster[yidx/subset,xidx/subset]=val
-                         
-
-        if yidx%(10*subset) is 0:
-            logger.debug('at y %d out of %d' % (yidx,band.YSize))
-            #logger.debug('hist %s' % str(inhist))
+    lut=wheat_lut(codes)
+    for (xidx,yidx),strip in raster_blocks.iterate(band,inset=(x,y),
+                                                   strategy='strip',rows=rows):
+        # Where the data value is one of the wheat values, keep it, else 0.
+        apply_lut(lut,strip)
+        write_band.WriteArray(strip,0,yidx)
+
+        if (yidx//rows)%10==0:
+            logger.debug('at y %d out of %d' % (yidx,y))
 
-    ds2.GetRasterBand(1).WriteArray( raster )
     # Recommended way to close the file.
     ds2=None
 
 
 
 
-def wheat_from_cdl(filename,outfile,inset=None):
+
+def copy_band_style(band,write_band):
+    '''
+    Give the output band the same color table, attribute table, and
+    no-data value as the CDL band, so that it displays the same way.
+    '''
+    write_band.SetColorInterpretation(band.GetColorInterpretation())
+    write_band.SetColorTable(band.GetColorTable())
+    #write_band.SetDefaultHistogram(band.GetDefaultHistogram())
+    write_band.SetDefaultRAT(band.GetDefaultRAT())
+    write_band.SetNoDataValue(band.GetNoDataValue())
+    #write_band.SetRasterCategoryNames(band.GetRasterCategoryNames())
+    write_band.SetRasterColorInterpretation(
+        band.GetRasterColorInterpretation())
+    write_band.SetRasterColorTable(band.GetRasterColorTable())
+
+
+
+def wheat_from_cdl_blocked(filename,outfile,inset=None,depth=0,threads=1):
     '''
     Pull wheat values out of crop dataland layer, but just pixel
     for pixel, not subsetting.
+    Work in blocks, specified as block=[x block, y block].
+    With depth, threads read that many blocks ahead.
     '''
     ds=gdal.Open(filename,GA_ReadOnly)
     logger.debug('opened %s' % filename)
     ds2,x,y=create_copy(ds,1,outfile,inset)
     logger.debug('created copy %s dim %d %d' % (str(ds2),x,y))
 
-    raster = np.zeros( (y,x), dtype=np.uint8 )
-    logger.debug('allocated large raster')
-
     band=ds.GetRasterBand(1)
+    block=band.GetBlockSize()
+    logger.info('block size %d %d' % (block[0],block[1]))
+
+    write_band=ds2.GetRasterBand(1)
+    copy_band_style(band,write_band)
+    #write_band=ds2.AddBand(gdal.GDT_Byte,['BLOCKSIZE=512','COMPRESSED=YES'])
     
     logger.info('incoming xsize: %d ysize: %d' % (band.XSize,band.YSize))
     logger.info('outgoing xsize: %d ysize: %d' % (x,y))
 
     maxwheat=0
-    for yidx in range(0,y):
-        #logger.debug('reading band %d scanline len %d' % (yidx,len(scanline)))
-
-        scanline=band.ReadRaster(0,yidx,band.XSize,1,
-                                 band.XSize,1,GDT_Byte)
-        ar=np.array(struct.unpack('B'*band.XSize,scanline),
-                    dtype=np.uint8)[0:x]
-
-        # Where the data value is one of the wheat values, put a 1, else a 0.
-        ar2=np.where(np.in1d(ar,wheatish),ar,0)
-        nonzero=len(ar2.nonzero()[0])
+    for block_idx,((xidx,yidx),xform_buf) in enumerate(
+            read_cdl(filename,band,(x,y),'block',1,depth,threads)):
+        # Where the data value is a wheat value, put a 1, else a 0.
+        xform_buf=np.where(
+            np.in1d(xform_buf,wheatish).reshape(xform_buf.shape),xform_buf,0)
+        # It is here that the buffer size determines how many entries
+        # are written. There is no option to write a subarray.
+        write_band.WriteArray(xform_buf,xidx,yidx)
+
+        nonzero=len(xform_buf.nonzero()[0])
         if nonzero>maxwheat: maxwheat=nonzero
-        raster[yidx,:]=ar2
 
-        if yidx%50 is 0:
-            logger.debug('at y %d out of %d nonzero %d' % (yidx,y,
-                                                           maxwheat))
+        if block_idx%1000 is 0:
+            logger.debug('at (%d,%d) nonzero %d' % (xidx,yidx,
+                                                       maxwheat))
             maxwheat=0
 
     ds2.SetGeoTransform(ds.GetGeoTransform())
     ds2.SetProjection(ds.GetProjection())
-    ds2.GetRasterBand(1).WriteArray( raster )
     # Recommended way to close the file.
     ds2=None
 
@@ -570,11 +690,52 @@ def wheat_from_cdl(filename,outfile,inset=None):
 
 
 
-def wheat_from_cdl_blocked(filename,outfile,inset=None):
+def read_cdl(filename,band,inset,strategy,blocks_per_read=1,depth=0,
+             threads=1):
     '''
-    Pull wheat values out of crop dataland layer, but just pixel
-    for pixel, not subsetting.
-    Work in blocks, specified as block=[x block, y block].
+    Pieces of band, the first band of filename, read in this thread,
+    or, if depth is more than 0, read ahead by threads.
+    '''
+    if depth>0:
+        return raster_blocks.prefetch(filename,inset=inset,strategy=strategy,
+            blocks_per_read=blocks_per_read,depth=depth,threads=threads)
+    return raster_blocks.iterate(band,inset=inset,strategy=strategy,
+                                 blocks_per_read=blocks_per_read)
+
+
+
+def wheat_lut(codes=wheatish):
+    '''
+    Make a 256-entry lookup table for byte CDL codes. Wheat codes
+    map to themselves and everything else maps to 0, so lut[block]
+    is the same as np.where(np.in1d(block,codes),block,0).
+    '''
+    codes=np.asarray(codes,dtype=np.int)
+    lut=np.zeros(256,dtype=np.uint8)
+    lut[codes]=codes
+    return lut
+
+
+
+def apply_lut(lut,buf):
+    '''
+    Replace each value in the byte array buf with lut[value], in place.
+    Each output depends only on the input at the same index, so
+    mode='clip' lets numpy skip the extra buffered copy it makes
+    for out= arguments in the default mode.
+    '''
+    np.take(lut,buf,out=buf,mode='clip')
+    return buf
+
+
+
+def wheat_from_cdl_lut(filename,outfile,inset=None,blocks_per_read=16,
+                       codes=wheatish,depth=0,threads=1):
+    '''
+    Pull wheat values out of crop dataland layer, pixel for pixel,
+    like wheat_from_cdl_blocked, but mask with a lookup table applied
+    in place and read several blocks for each call to GDAL.
+    With depth, threads read that many windows ahead.
     '''
     ds=gdal.Open(filename,GA_ReadOnly)
     logger.debug('opened %s' % filename)
@@ -583,53 +744,113 @@ def wheat_from_cdl_blocked(filename,outfile,inset=None):
 
     band=ds.GetRasterBand(1)
     block=band.GetBlockSize()
-    logger.info('block size %d %d' % (block[0],block[1]))
+    logger.info('block size %d %d reading %d blocks at a time' %
+                (block[0],block[1],blocks_per_read))
 
     write_band=ds2.GetRasterBand(1)
-    write_band.SetColorInterpretation(band.GetColorInterpretation())
-    write_band.SetColorTable(band.GetColorTable())
-    #write_band.SetDefaultHistogram(band.GetDefaultHistogram())
-    write_band.SetDefaultRAT(band.GetDefaultRAT())
-    write_band.SetNoDataValue(band.GetNoDataValue())
-    #write_band.SetRasterCategoryNames(band.GetRasterCategoryNames())
-    write_band.SetRasterColorInterpretation(band.GetRasterColorInterpretation())
-    write_band.SetRasterColorTable(band.GetRasterColorTable())
-    #write_band=ds2.AddBand(gdal.GDT_Byte,['BLOCKSIZE=512','COMPRESSED=YES'])
-    
+    copy_band_style(band,write_band)
+
     logger.info('incoming xsize: %d ysize: %d' % (band.XSize,band.YSize))
     logger.info('outgoing xsize: %d ysize: %d' % (x,y))
 
-    maxwheat=0
-    block_idx=0
-    # Note that y and x are switched b/c that's how ReadAsArray works.
-    main_buf=np.zeros((block[1],block[0]),dtype=np.uint8)
+    lut=wheat_lut(codes)
+    for read_idx,((xidx,yidx),xform_buf) in enumerate(
+            read_cdl(filename,band,(x,y),'block',blocks_per_read,depth,
+                     threads)):
+        apply_lut(lut,xform_buf)
+        write_band.WriteArray(xform_buf,xidx,yidx)
 
-    for xidx in range(0,x,block[0]):
-        for yidx in range(0,y,block[1]):
-            ysize=min(block[1],y-yidx)
-            xsize=min(block[0],x-xidx)
-            if xsize is block[0] and ysize is block[1]:
-                xform_buf=main_buf
-            else:
-                xform_buf=np.zeros((ysize,xsize),dtype=np.uint8)
+        if read_idx%1000 is 0:
+            logger.debug('at (%d,%d) of (%d,%d)' % (xidx,yidx,x,y))
 
-            band.ReadAsArray(xidx,yidx,xsize,ysize,
-                                 xsize,ysize,xform_buf)
-            # Where the data value is a wheat value, put a 1, else a 0.
-            xform_buf=np.where(
-                np.in1d(xform_buf,wheatish).reshape((ysize,xsize)),xform_buf,0)
-            # It is here that the buffer size determines how many entries
-            # are written. There is no option to write a subarray.
-            write_band.WriteArray(xform_buf,xidx,yidx)
+    ds2.SetGeoTransform(ds.GetGeoTransform())
+    ds2.SetProjection(ds.GetProjection())
+    # Recommended way to close the file.
+    ds2=None
+
+
+
+# Each worker process opens its own dataset because GDAL handles
+# cannot be shared across a fork.
+_pick_worker=dict()
 
-            nonzero=len(xform_buf.nonzero()[0])
-            if nonzero>maxwheat: maxwheat=nonzero
+def _pick_worker_init(filename,codes):
+    ds=gdal.Open(filename,GA_ReadOnly)
+    _pick_worker['ds']=ds
+    _pick_worker['band']=ds.GetRasterBand(1)
+    _pick_worker['lut']=wheat_lut(codes)
+    _pick_worker['buffers']=raster_blocks.buffer_pool(np.uint8)
+
+
+
+def _pick_worker_band(window):
+    '''
+    Read and mask one row band. Returns the window and its array.
+    '''
+    buf=raster_blocks.read_window(_pick_worker['band'],window,
+                                  _pick_worker['buffers'])
+    apply_lut(_pick_worker['lut'],buf)
+    return window,buf
+
+
+
+def row_bands(xsize,ysize,block,band_blocks):
+    '''
+    Split an image into full-width bands of rows, each band_blocks
+    blocks tall, so that bands start on the block grid.
+
+    Yields: (x offset, y offset, x size, y size)
+    '''
+    rows=block[1]*band_blocks
+    for yidx in range(0,ysize,rows):
+        yield (0,yidx,xsize,min(rows,ysize-yidx))
 
-            if block_idx%1000 is 0:
-                logger.debug('at (%d,%d) nonzero %d' % (xidx,yidx,
-                                                           maxwheat))
-                maxwheat=0
-            block_idx+=1
+
+
+def wheat_from_cdl_parallel(filename,outfile,inset=None,workers=2,
+                            blocks_per_read=16,band_blocks=4,codes=wheatish):
+    '''
+    This is wheat_from_cdl_lut spread over a pool of processes.
+    Workers read and mask bands of rows aligned to the block grid.
+    This process is the only writer. It writes each band in the same
+    windows, in the same order, as the serial method, so the output
+    file is byte for byte the same. At most two bands per worker are
+    in flight, which bounds memory when writing is slower than reading.
+    '''
+    ds=gdal.Open(filename,GA_ReadOnly)
+    logger.debug('opened %s' % filename)
+    ds2,x,y=create_copy(ds,1,outfile,inset)
+    logger.debug('created copy %s dim %d %d' % (str(ds2),x,y))
+
+    band=ds.GetRasterBand(1)
+    block=band.GetBlockSize()
+    logger.info('block size %d %d with %d workers on bands of %d rows' %
+                (block[0],block[1],workers,block[1]*band_blocks))
+
+    write_band=ds2.GetRasterBand(1)
+    copy_band_style(band,write_band)
+
+    logger.info('incoming xsize: %d ysize: %d' % (band.XSize,band.YSize))
+    logger.info('outgoing xsize: %d ysize: %d' % (x,y))
+
+    pool=multiprocessing.Pool(workers,_pick_worker_init,(filename,codes))
+    try:
+        bands=row_bands(x,y,block,band_blocks)
+        pending=collections.deque()
+        for window in bands:
+            pending.append(pool.apply_async(_pick_worker_band,(window,)))
+            if len(pending)>=2*workers:
+                _write_band_windows(write_band,pending.popleft().get(),
+                                    block,blocks_per_read)
+        while pending:
+            _write_band_windows(write_band,pending.popleft().get(),
+                                block,blocks_per_read)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
     ds2.SetGeoTransform(ds.GetGeoTransform())
     ds2.SetProjection(ds.GetProjection())
@@ -638,6 +859,58 @@ def wheat_from_cdl_blocked(filename,outfile,inset=None):
 
 
 
+def _write_band_windows(write_band,result,block,blocks_per_read):
+    (band_x,band_y,xsize,ysize),buf=result
+    for (xidx,yidx,wx,wy) in raster_blocks.read_windows(xsize,ysize,block,
+                                                        blocks_per_read):
+        write_band.WriteArray(buf[yidx:yidx+wy,xidx:xidx+wx],
+                              band_x+xidx,band_y+yidx)
+    logger.debug('wrote rows %d to %d' % (band_y,band_y+ysize))
+
+
+
+def benchmark_pick(filename,inset=None,blocks_per_read=16,outdir=None):
+    '''
+    Time wheat_from_cdl_blocked against wheat_from_cdl_lut, with and
+    without reading ahead, on the same input. Outputs go to a scratch
+    directory and are deleted. Use an inset to time a corner of the
+    national CDL.
+
+    Returns: dictionary from method name to pixels per second.
+    '''
+    if not inset:
+        ds=gdal.Open(filename,GA_ReadOnly)
+        inset=(ds.RasterXSize,ds.RasterYSize)
+        ds=None
+    pixel_cnt=float(inset[0])*inset[1]
+    extension=os.path.splitext(filename)[1]
+
+    methods=[('blocked',wheat_from_cdl_blocked),
+             ('lut',lambda f,o,i: wheat_from_cdl_lut(f,o,i,blocks_per_read)),
+             ('lut_prefetch',lambda f,o,i: wheat_from_cdl_lut(f,o,i,
+                blocks_per_read,depth=raster_blocks.PREFETCH_DEPTH))]
+    scratch=tempfile.mkdtemp(dir=outdir)
+    rates=dict()
+    try:
+        for name,method in methods:
+            outfile=os.path.join(scratch,'bench_%s%s' % (name,extension))
+            start=time.time()
+            method(filename,outfile,inset)
+            elapsed=time.time()-start
+            rates[name]=pixel_cnt/elapsed
+            logger.info('%s: %d pixels in %g s, %g pixels/s' %
+                        (name,pixel_cnt,elapsed,rates[name]))
+    finally:
+        for f in os.listdir(scratch):
+            os.remove(os.path.join(scratch,f))
+        os.rmdir(scratch)
+
+    logger.info('lut is %g times faster than blocked' %
+                (rates['lut']/rates['blocked']))
+    return rates
+
+
+
 
 
 def compare_all_and_wheat(filename1,filename2,inset=None):
@@ -655,29 +928,23 @@ def compare_all_and_wheat(filename1,filename2,inset=None):
     
     logger.info('incoming xsize: %d ysize: %d' % (band1.XSize,band1.YSize))
 
-    for yidx in range(0,band1.YSize):
-        #logger.debug('reading band %d scanline len %d' % (yidx,len(scanline)))
-
-        scanline=band1.ReadRaster(0,yidx,band1.XSize,1,
-                                 band1.XSize,1,GDT_Byte)
-        ar1=np.array(struct.unpack('B'*band1.XSize,scanline),
-                    dtype=np.uint8)[0:band1.XSize]
-
-        scanline=band2.ReadRaster(0,yidx,band1.XSize,1,
-                                 band1.XSize,1,GDT_Byte)
-        ar2=np.array(struct.unpack('B'*band1.XSize,scanline),
-                    dtype=np.uint8)[0:band1.XSize]
-
-        for idx in range(band1.XSize):
-            if ar1[idx] in wheatish:
-                if ar1[idx]!=ar2[idx]:
-                    print('unequal at %d,%d' % (idx,yidx))
-                    logger.warning('unequal at %d,%d' % (idx,yidx))
-            else:
-                if ar2[idx]!=0:
-                    logger.warning('should be zero at %d,%d' % (idx,yidx))
-                    print('should be zero at %d,%d' % (idx,yidx))
-        print 'one line', yidx
+    window=(0,0,band1.XSize,band1.YSize)
+    # Both files must be cut into the same strips to compare them.
+    itemsize=max([np.dtype(raster_blocks.band_dtype(b)).itemsize
+                  for b in (band1,band2)])
+    rows=raster_blocks.strip_height(band1.XSize,band1.GetBlockSize()[1],
+                                    pixel_bytes=itemsize)
+    for ((xidx,yidx),ar1),(corner,ar2) in zip(
+            raster_blocks.iterate(band1,window,strategy='strip',rows=rows),
+            raster_blocks.iterate(band2,window,strategy='strip',rows=rows)):
+        is_wheat=np.in1d(ar1,wheatish).reshape(ar1.shape)
+        for row,col in zip(*np.nonzero(is_wheat & (ar1!=ar2))):
+            print('unequal at %d,%d' % (col,yidx+row))
+            logger.warning('unequal at %d,%d' % (col,yidx+row))
+        for row,col in zip(*np.nonzero(~is_wheat & (ar2!=0))):
+            logger.warning('should be zero at %d,%d' % (col,yidx+row))
+            print('should be zero at %d,%d' % (col,yidx+row))
+        logger.debug('through line %d' % (yidx+ar1.shape[0]))
 
     ds1=None
     ds2=None
@@ -686,11 +953,12 @@ def compare_all_and_wheat(filename1,filename2,inset=None):
 
 
 
-def blocked_read(filename):
+def blocked_read(filename,depth=0,threads=1):
     '''
     Pull wheat values out of crop dataland layer, but just pixel
     for pixel, not subsetting.
     Work in blocks, specified as block=[x block, y block].
+    With depth, threads read that many blocks ahead.
     '''
     ds=gdal.Open(filename,GA_ReadOnly)
     logger.debug('opened %s' % filename)
@@ -700,23 +968,9 @@ def blocked_read(filename):
     logger.info('block size %d %d' % (block[0],block[1]))
 
     logger.info('incoming xsize: %d ysize: %d' % (band.XSize,band.YSize))
-    x=band.XSize
-    y=band.YSize
-
-    # Note that y and x are switched b/c that's how ReadAsArray works.
-    main_buf=np.zeros((block[1],block[0]),dtype=np.uint8)
-
-    for xidx in range(0,x,block[0]):
-        for yidx in range(0,y,block[1]):
-            ysize=min(block[1],y-yidx)
-            xsize=min(block[0],x-xidx)
-            if xsize is block[0] and ysize is block[1]:
-                xform_buf=main_buf
-            else:
-                xform_buf=np.zeros((ysize,xsize),dtype=np.uint8)
-
-            band.ReadAsArray(xidx,yidx,xsize,ysize,
-                                 xsize,ysize,xform_buf)
+    for corner,xform_buf in read_cdl(filename,band,None,'block',1,depth,
+                                     threads):
+        pass
 
     ds=None
 
@@ -797,6 +1051,9 @@ if __name__ == '__main__':
         parser.add_argument('--%s'%name,dest=name,action='store_true',
                         default=False,help=msg)
     add_function('pick','Make a file with only wheat in it.')
+    add_function('bench','Time the wheat masking methods with --cdls.')
+    add_function('stream','Make a file with only wheat, --memory at a time.')
+    add_function('pyramid','Make wheat density images at --levels.')
     add_function('crop_check','Check NCDL metadata crop lists')
     add_function('wheat_codes','Check which codes are wheat')
 
@@ -811,6 +1068,19 @@ if __name__ == '__main__':
                         help='the path to the 30m cdls file ending in .img')
     parser.add_argument('--outfile',dest='outfile',type=str,default='',
                         help='a path to an output file to create')
+    parser.add_argument('--batch',dest='batch',type=int,default=16,
+                        help='number of blocks to read at a time for --pick')
+    parser.add_argument('--workers',dest='workers',type=int,default=1,
+                        help='number of processes to use for --pick')
+    parser.add_argument('--prefetch',dest='prefetch',type=int,default=0,
+                        help='blocks to read ahead for --pick with one worker')
+    parser.add_argument('--threads',dest='threads',type=int,default=1,
+                        help='threads reading ahead for --prefetch')
+    parser.add_argument('--memory',dest='memory',type=int,default=256,
+                        help='megabytes of image to hold at once for --stream')
+    parser.add_argument('--levels',dest='levels',type=str,
+                        default='16,32,64,128',
+                        help='window sizes for --pyramid, like 16,32,64,128')
 
 
     args=parser.parse_args()
@@ -837,7 +1107,35 @@ if __name__ == '__main__':
             if args.inset:
                 inset=[int(x) for x in args.inset.split(',')]
                 logger.info('using an inset of (%d,%d)' % tuple(inset))
-            wheat_from_cdl_blocked(args.cdls,args.outfile,inset)
+            if args.workers>1:
+                wheat_from_cdl_parallel(args.cdls,args.outfile,inset,
+                                        args.workers,args.batch)
+            else:
+                wheat_from_cdl_lut(args.cdls,args.outfile,inset,args.batch,
+                                   depth=args.prefetch,threads=args.threads)
+
+        if args.stream:
+            did_something=True
+            inset=None
+            if args.inset:
+                inset=[int(x) for x in args.inset.split(',')]
+            wheat_from_cdl(args.cdls,args.outfile,inset,args.memory*1024*1024)
+
+        if args.pyramid:
+            did_something=True
+            levels=[int(x) for x in args.levels.split(',')]
+            names=wheat_pyramid(args.cdls,args.outfile,levels)
+            for level in sorted(names):
+                logger.info('level %d in %s' % (level,names[level]))
+
+        if args.bench:
+            did_something=True
+            inset=None
+            if args.inset:
+                inset=[int(x) for x in args.inset.split(',')]
+            rates=benchmark_pick(args.cdls,inset,args.batch)
+            for name in sorted(rates):
+                print('%s: %g pixels/s' % (name,rates[name]))
 
         if args.crop_check:
             did_something=True
@@ -11,23 +11,41 @@ tdiff () {
 }
 
 TMPDIR=/media/data0/counties
+# The server leases counties to this name, so every call must use it.
+WORKER="$(hostname):$$"
 
 while [[ $(tdiff "$(date -u '+%F %T.%N %Z')" "$script_start") -lt "${NEAR_END}" ]]
 do
-  geoid=`python county_client.py`
+  geoid=`python county_client.py --next --worker "${WORKER}"`
+  if [ "${geoid}" == "0" ]
+  then
+      echo No counties left.
+      exit
+  fi
 
   echo Starting county ${geoid}.
   echo ./triple --cdls "${CDLS}" --ndvi "${NDVI}" --counties "${COUNTY}"
   echo    --feature "${geoid}" --point > "${TMPDIR}/${geoid}.txt"
 
+  # Keep the lease while triple runs.
+  ( while sleep 600; do python county_client.py --heartbeat \
+      --worker "${WORKER}" --geoid "${geoid}"; done ) &
+  heartbeat=$!
+
+  county_start=$(date -u '+%F %T.%N %Z')
   time ./triple --cdls "${CDLS}" --ndvi "${NDVI}" --counties "${COUNTY}" \
       --feature "${geoid}" --point > "${TMPDIR}/${geoid}.txt"
+  status=$?
+  kill ${heartbeat}
 
-  if [ $? -ne 0 ]
+  if [ ${status} -ne 0 ]
   then
       echo "XXX Failed." >> "${TMPDIR}/${geoid}.txt"
       echo Failed on $geoid `date`
+      python county_client.py --failed --worker "${WORKER}" --geoid "${geoid}" \
+          --message "triple exited ${status}"
       exit
   fi
+  python county_client.py --done --worker "${WORKER}" --geoid "${geoid}" \
+      --seconds $(tdiff "$(date -u '+%F %T.%N %Z')" "${county_start}")
 done
-
@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 from datetime import date
 import logging
@@ -6,14 +7,17 @@ import datetime
 import fileinput
 import glob
 import itertools
+import json
 from collections import defaultdict
 import numpy as np
-import cPickle
 import gdal
 import osr
 from gdalconst import GA_ReadOnly, GDT_Float32
 import default_parser
 import luconfig
+import pixel_weights
+import ndvi_cube
+import raster_blocks
 
 logger=logging.getLogger('gimms')
 
@@ -21,23 +25,124 @@ logger=logging.getLogger('gimms')
 GIMMS_PROJ4 = ("+proj=aea +lat_1=20 +lat_2=60 +lat_0=45 " +
     "+lon_0=-103 +x_0=0 +y_0=0 +ellps=NAD27 +units=m +no_defs ")
 
-def date_to_gimms_filename(when):
-    if when.day<16: day_key='a'
-    else: day_key='b'
+_months=['jan','feb','mar','apr','may','jun','jul','aug','sep','oct',
+         'nov','dec']
+_composite_name=re.compile('NA([0-9][0-9])([a-z]{3})15([ab])\\.n[0-9][0-9]-VIg$')
 
-    month=when.strftime('%b')[0:3].lower()
-    filekey='NA%s%s15%s.n[0-9][0-9]-VIg' % (when.strftime('%y'), month, day_key)
+def scan_composites(gimms_dir):
+    '''
+    Look in every directory for GIMMS composites.
+    Returns: dictionary from ndvi_cube.composite_key to .tif.gz path.
+    '''
+    files=dict()
+    for name in glob.glob('%s/NA*-VIg/NA*-VIg.tif.gz' % gimms_dir):
+        found=_composite_name.match(os.path.basename(os.path.dirname(name)))
+        if not found or found.group(2) not in _months:
+            continue
+        year=int(found.group(1))
+        year+=1900 if year>=50 else 2000
+        month=_months.index(found.group(2))+1
+        half='ab'.index(found.group(3))
+        files[ndvi_cube.composite_key(year,month,half)]=name
+    logger.debug('found %d composites in %s' % (len(files),gimms_dir))
+    return files
+
+
+
+CATALOG_NAME='gimms_catalog.json'
+
+def composite_listing(gimms_dir):
+    '''
+    Names and modification times of the composite directories, which
+    change when a composite is added to or removed from any of them.
+    '''
+    return [[os.path.basename(name),os.path.getmtime(name)] for name
+            in sorted(glob.glob('%s/NA*-VIg' % gimms_dir))]
+
+
+
+def read_catalog(gimms_dir):
+    '''
+    Scanning the data disk for composites is slow, so the scan is saved
+    in the GIMMS directory and used again until a composite directory
+    is added, removed, or changed.
+    '''
+    catalog_file=os.path.join(gimms_dir,CATALOG_NAME)
+    listing=composite_listing(gimms_dir)
+    try:
+        saved=json.load(open(catalog_file))
+        if saved['listing']==listing:
+            return dict([(int(k),str(v))
+                         for (k,v) in saved['files'].iteritems()])
+        logger.info('%s changed, so scanning it again' % gimms_dir)
+    except (IOError,ValueError,KeyError):
+        logger.info('No catalog of composites in %s, so scanning' % gimms_dir)
+
+    files=scan_composites(gimms_dir)
+    try:
+        with open(catalog_file,'w') as catalog:
+            json.dump({'listing' : listing, 'files' : files},catalog)
+    except (IOError,OSError),e:
+        logger.warning('Could not save catalog of composites: %s' % e)
+    return files
+
+
+
+_catalogs=dict()
+
+def composite_files(gimms_dir=None):
+    '''
+    Every GIMMS composite, read once per process.
+    Returns: dictionary from ndvi_cube.composite_key to .tif.gz path.
+    '''
+    if not gimms_dir:
+        if None not in _catalogs:
+            _catalogs[None]=composite_files(luconfig.get('gimms'))
+        return _catalogs[None]
+    if gimms_dir not in _catalogs:
+        _catalogs[gimms_dir]=read_catalog(gimms_dir)
+    return _catalogs[gimms_dir]
+
+
+
+def date_to_gimms_filename(when, gimms_dir=None):
+    '''
+    The GDAL name of the composite that contains the date.
+    '''
+    key=ndvi_cube.date_key(when)
+    files=composite_files(gimms_dir)
+    if key not in files:
+        raise IOError('There is no GIMMS composite for %s in %s' %
+                      (when.isoformat(), gimms_dir or luconfig.get('gimms')))
     # vsigzip is a magic prepend that unzips gzipped files.
-    gimms_dir=luconfig.get('gimms')
-    name = '%s/%s/%s.tif.gz' % (gimms_dir, filekey, filekey)
-    files=glob.glob(name)
-    logger.debug('glob found %s' % str(files))
-    if not files:
-        logger.error('Cannot find file %s' % name)
-    name = '/vsigzip/%s' % files[0]
+    name='/vsigzip/%s' % files[key]
     logger.debug('reading file %s' % name)
     return name
-    
+
+
+
+def cube_directory():
+    return os.path.join(luconfig.get('gimms'),'cube')
+
+
+
+_cube=list()
+
+def get_cube():
+    '''
+    The NDVI cube, if python gimms.py --cube has made one, else None.
+    '''
+    if not _cube:
+        try:
+            _cube.append(ndvi_cube.ndvi_cube(cube_directory()))
+            logger.debug('reading NDVI from the cube in %s' % cube_directory())
+        except IOError:
+            logger.info('No NDVI cube in %s, so reading GIMMS files.' %
+                        cube_directory())
+            _cube.append(None)
+    return _cube[0]
+
+
 
 class pixel_to_xy(object):
     '''
@@ -73,6 +178,10 @@ def get_greens(when, x, y):
     The where_array is a list of (pixel,line) coordinates in the gimms file.
     where array is shape (n,2).
     '''
+    cube=get_cube()
+    if cube:
+        return cube.greens(when,x,y)
+
     minx=min(x)
     xsize=1+max(x)-minx
     miny=min(y)
@@ -82,7 +191,9 @@ def get_greens(when, x, y):
     ds=gdal.Open(date_to_gimms_filename(when), GA_ReadOnly)
     band=ds.GetRasterBand(1)
 
-    arr = ds.ReadAsArray(int(minx), int(miny), int(xsize), int(ysize))
+    buffers=raster_blocks.buffer_pool(raster_blocks.band_dtype(band))
+    arr=raster_blocks.read_window(band,
+        (int(minx), int(miny), int(xsize), int(ysize)), buffers)
 
     # Switch x and y because ReadAsArray returnes an array such that
     # you access numpy with arr[y,x]. Yes.
@@ -101,11 +212,18 @@ def year_trace(year, x, y):
 
     data=np.zeros((12*2,len(x)), dtype=np.int16)
     days=np.zeros(12*2, dtype=np.int)
+    keys=np.zeros(12*2, dtype=np.int)
 
+    cube=get_cube()
     for i, (mon,day) in enumerate(itertools.product(range(1,13),[1,16])):
         when=datetime.date(year,mon,day)
-        data[i,:]=get_greens(when,x,y)
         days[i]=(when-datetime.date(year,1,1)).days
+        keys[i]=ndvi_cube.date_key(when)
+        if not cube:
+            data[i,:]=get_greens(when,x,y)
+
+    if cube:
+        data[:,:]=cube.traces(keys,x,y)
 
     return days, data.transpose()
 
@@ -130,7 +248,8 @@ def pixel_with_max_wheat(weighted_counties):
 
 
 '''
-Tab-delimited list of county geoid, x, y, cover code, square meters
+Tab-delimited list of county geoid, x, y, cover code, square meters,
+as written by triple --point or by zonal.py.
 '''
 file_sample='''
 28104	784	663	112	11163.5
@@ -226,7 +345,7 @@ def county_array(weighted):
         yield cur_geoid, np.array(xl), np.array(yl), weights
 
 
-WHEAT=np.array(luconfig.get('wheat_codes').split(','))
+WHEAT=luconfig.wheat_codes()
 
 def build(lines,wheat):
     typed=read_code_stream(lines)
@@ -265,7 +384,10 @@ if __name__ == '__main__':
         description='reading gimms for observations')
     parser.add_function('test','run tests')
     parser.add_function('weights','precalculate the weights')
-    parser.add_argument('files',metavar='files', type=str, nargs='+',
+    parser.add_function('cube','decompress all composites into an NDVI cube')
+    parser.add_argument('--out',dest='out',type=str,
+                        help='output directory for --weights or --cube')
+    parser.add_argument('files',metavar='files', type=str, nargs='*',
                         help='files to search for county code data')
     args=parser.parse_args()
     
@@ -276,7 +398,12 @@ if __name__ == '__main__':
 
     if args.weights:
         counties=build(fileinput.input(args.files), WHEAT)
-        cPickle.dump(counties,open('/media/data0/counties/grid.pickle','w'))
+        pixel_weights.write_index(counties,args.out)
+
+    if args.cube:
+        files=dict([(k,'/vsigzip/%s' % v) for (k,v)
+                    in composite_files().iteritems()])
+        ndvi_cube.build_cube(files,args.out or cube_directory())
         #for county in sorted(counties):
         #    x, y, weight = counties[county]
         #    print county, x, y, weight
@@ -1,15 +1,135 @@
+'''
+Where the scripts find their data. Settings are in the General section
+of project.cfg, in the current directory, and project_local.cfg
+overrides them. The files are parsed once per process and parsed
+again only if one of them changes on disk.
+
+An environment variable LUCONFIG_NAME overrides the setting called
+name, which lets a cluster node point at its own scratch copy:
+
+  LUCONFIG_CDLS=/tmp/2011_30m_cdls.img python findp.py --pick ...
+'''
 import ConfigParser
 import logging
 import os
+import numpy as np
 
 logger=logging.getLogger('luconfig')
 
-def get(name):
+suggested_files=['project.cfg', 'project_local.cfg']
+ENVIRONMENT_PREFIX='LUCONFIG_'
+
+
+class frozen_settings(object):
+    '''
+    A read-only dictionary of settings.
+    '''
+    def __init__(self,items):
+        self._items=dict(items)
+
+    def __getitem__(self,name):
+        return self._items[name]
+
+    def __contains__(self,name):
+        return name in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def keys(self):
+        return self._items.keys()
+
+
+
+def _stamp():
+    '''
+    What the settings depend on: which files exist, where, and when
+    they last changed.
+    '''
+    stamp=list()
+    for name in suggested_files:
+        path=os.path.abspath(name)
+        try:
+            stamp.append((path,os.path.getmtime(path)))
+        except OSError:
+            stamp.append((path,None))
+    return tuple(stamp)
+
+
+
+def _parse():
     config=ConfigParser.ConfigParser()
-    suggested_files=['project.cfg', 'project_local.cfg']
     parsed_files=config.read(suggested_files)
     if len(parsed_files) is not len(suggested_files):
         unused=list(set(suggested_files)-set(parsed_files))
         logger.info('Using directory locations from %s, not %s.' %
                     (', '.join(parsed_files), ', '.join(unused)))
-    return config.get('General',name)
+    if not config.has_section('General'):
+        return frozen_settings(dict())
+    return frozen_settings(config.items('General'))
+
+
+
+_cache={'stamp' : None, 'settings' : None, 'typed' : dict()}
+
+def settings():
+    '''
+    All settings from the configuration files, without environment
+    overrides, as a read-only dictionary.
+    '''
+    stamp=_stamp()
+    if stamp!=_cache['stamp']:
+        if _cache['stamp']:
+            logger.info('Configuration files changed, so reading them again.')
+        _cache['settings']=_parse()
+        _cache['typed']=dict()
+        _cache['stamp']=stamp
+    return _cache['settings']
+
+
+
+def get(name):
+    '''
+    The string value of a setting.
+    '''
+    override=os.environ.get(ENVIRONMENT_PREFIX+name.upper())
+    if override is not None:
+        return override
+    values=settings()
+    if name not in values:
+        raise ConfigParser.NoOptionError(name,'General')
+    return values[name]
+
+
+
+def get_list(name,convert=str):
+    '''
+    A comma-separated setting as a list, with each entry converted.
+    '''
+    return [convert(x.strip()) for x in get(name).split(',') if x.strip()]
+
+
+
+def get_array(name,dtype):
+    '''
+    A comma-separated setting of numbers as a numpy array. The array
+    is shared between callers, so it is read-only.
+    '''
+    settings()
+    key=(name,np.dtype(dtype).str,get(name))
+    if key not in _cache['typed']:
+        arr=np.array(get_list(name,int),dtype=dtype)
+        arr.flags.writeable=False
+        _cache['typed'][key]=arr
+    return _cache['typed'][key]
+
+
+
+def wheat_codes():
+    '''
+    CDL cover codes counted as wheat, as a uint8 array.
+    '''
+    return get_array('wheat_codes',np.uint8)
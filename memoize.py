@@ -1,7 +1,7 @@
 '''
 memoized is a decorator for functions that remembers what the
 return value was given a particular set of arguments. If it is
-called again with the same arguments, it will get the same 
+called again with the same arguments, it will get the same
 return value.
 
 @memoized
@@ -9,24 +9,126 @@ def get_data():
     # read file
     # get bounding boxes of US States.
 
-This code is copied from the Python wiki.
+memoized_with adds options. maxsize keeps only that many of the most
+recently used results. depends is a function that returns the files
+from which the result is computed. With it, results are also saved to
+disk, so the next run of a script starts with them, until the
+modification time of any of those files changes.
+
+@memoized_with(depends=lambda: [luconfig.get('corn_planted')])
+def planted_yearly_records():
+    # read the csv file
+
+This code started as a copy from the Python wiki.
 '''
+import os
 import functools
+import collections
+import hashlib
+import logging
+import tempfile
+import cPickle
+
+logger=logging.getLogger('memoize')
+
+# Separates positional from keyword arguments in a cache key.
+_kwargs_mark=object()
+
+
+def cache_directory():
+    '''
+    Where results of functions with dependencies are saved. This is
+    the cache setting in project.cfg or else ~/.land_use_cache.
+    '''
+    try:
+        import luconfig
+        return luconfig.get('cache')
+    except Exception:
+        return os.path.join(os.path.expanduser('~'),'.land_use_cache')
+
+
 
 class memoized(object):
-    def __init__(self,func):
+    def __init__(self,func,maxsize=None,depends=None,cache_dir=None):
         self.func=func
-        self.cache={}
+        self.cache=collections.OrderedDict()
+        self.maxsize=maxsize
+        self.depends=depends
+        self.cache_dir=cache_dir
+
     def __call__(self,*args,**kwargs):
+        if kwargs:
+            key=args+(_kwargs_mark,)+tuple(sorted(kwargs.items()))
+        else:
+            key=args
         try:
-            return self.cache[args]
+            value=self.cache.pop(key)
         except KeyError:
-            value=self.func(*args)
-            self.cache[args]=value
-            return value
+            value=self._compute(key,args,kwargs)
         except TypeError:
-            return self.func(*args)
+            # Unhashable arguments can't be remembered.
+            return self.func(*args,**kwargs)
+        self.cache[key]=value
+        if self.maxsize and len(self.cache)>self.maxsize:
+            self.cache.popitem(last=False)
+        return value
+
+    def _compute(self,key,args,kwargs):
+        if not self.depends:
+            return self.func(*args,**kwargs)
+
+        stamp=[(f,os.path.getmtime(f) if os.path.exists(f) else None)
+               for f in self.depends()]
+        path=self._disk_path(key)
+        try:
+            saved_stamp,value=cPickle.load(open(path,'rb'))
+            if saved_stamp==stamp:
+                logger.debug('read %s from %s' % (self.func.__name__,path))
+                return value
+        except Exception:
+            pass
+
+        value=self.func(*args,**kwargs)
+        try:
+            directory=os.path.dirname(path)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            # Write then rename so that a reader never sees half a file.
+            handle,tmp_path=tempfile.mkstemp(dir=directory)
+            with os.fdopen(handle,'wb') as out:
+                cPickle.dump((stamp,value),out,cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path,path)
+        except (IOError,OSError,cPickle.PicklingError),e:
+            logger.warning('Could not save %s to disk: %s' %
+                           (self.func.__name__,e))
+        return value
+
+    def _disk_path(self,key):
+        name='%s.%s' % (self.func.__module__,self.func.__name__)
+        try:
+            digest=hashlib.sha1(cPickle.dumps(key,2)).hexdigest()
+        except cPickle.PicklingError:
+            digest=hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(self.cache_dir or cache_directory(),
+                            '%s-%s.pickle' % (name,digest))
+
+    def clear(self):
+        '''
+        Forget results in memory. Results on disk stay.
+        '''
+        self.cache.clear()
+
     def __repr__(self):
         return self.func.__doc__
     def __get__(self,obj,objtype):
         return functools.partial(self.__call__,obj)
+
+
+
+def memoized_with(maxsize=None,depends=None,cache_dir=None):
+    '''
+    A memoized decorator with options. See the top of this file.
+    '''
+    def decorator(func):
+        return memoized(func,maxsize,depends,cache_dir)
+    return decorator
@@ -74,18 +74,34 @@ def get_spring_year_state():
 
 
 
+@memoized
+def match_all_rates():
+    '''
+    Returns: dictionary from year to state fips to (midpoint, spread)
+             of logistic match to wheat emergence curve. All years
+             and states are fit together.
+    '''
+    by_year=get_spring_year_state()
+    keys=[(yr,st) for yr in sorted(by_year) for st in sorted(by_year[yr])]
+    curves=[(by_year[yr][st][1],by_year[yr][st][0]) for (yr,st) in keys]
+    mids,spreads=emerge_fitter.fit_batch(curves)
+
+    rates=dict()
+    for (yr,st),mid,spread in zip(keys,mids.tolist(),spreads.tolist()):
+        rates.setdefault(yr,dict())[st]=(mid,spread)
+    return rates
+
+
+
 def match_rates(year):
     '''
     Returns: dictionary from state fips to (midpoint, spread)
              of logistic match to wheat emergence curve.
     '''
     by_state=get_spring_year_state()[year]
-    fitter=emerge_fitter.emerge_fitter()
-    
-    data=dict()
+    data=match_all_rates()[year]
     for st, (pct,days) in by_state.iteritems():
-        mid,spread=fitter(days,pct)
-        data[st]=(mid,spread)
+        mid,spread=data[st]
         print "fips", st
         print "   ", pct
         print "   ", mid, mid-2*spread, mid+2*spread
@@ -0,0 +1,107 @@
+'''
+GIMMS composites come as one gzipped GeoTIFF for each half of each
+month. Reading a few pixels from one means decompressing all of it,
+so a year of traces decompresses 24 files. This converts every
+composite, once, into one int16 array of shape (time, line, pixel),
+stored as .npy so it can be memory-mapped:
+
+  cube.npy  the NDVI values, one 1024x1280 slice per composite
+  keys.npy  sorted composite key of each slice, from composite_key()
+
+Then any set of pixels on any set of dates is one fancy-index gather.
+'''
+import os
+import logging
+import numpy as np
+import gdal
+from gdalconst import GA_ReadOnly
+import raster_blocks
+
+logger=logging.getLogger('ndvi_cube')
+
+
+def composite_key(year,month,half):
+    '''
+    Half is 0 for the composite of the 1st-15th, 1 for the 16th on.
+    Keys are consecutive integers in time order.
+    '''
+    return year*24+(month-1)*2+half
+
+
+
+def date_key(when):
+    '''
+    The key of the composite that contains a datetime.date.
+    '''
+    return composite_key(when.year,when.month,int(when.day>=16))
+
+
+
+def build_cube(files,directory):
+    '''
+    Decompress composites into a cube. files is a dictionary from
+    composite_key to a GDAL filename, such as a /vsigzip/ path.
+    This reads one composite at a time, so memory stays small.
+    '''
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    keys=np.array(sorted(files),dtype=np.int32)
+    first=gdal.Open(files[keys[0]],GA_ReadOnly)
+    shape=(len(keys),first.RasterYSize,first.RasterXSize)
+    first=None
+    logger.info('writing cube of shape %s to %s' % (str(shape),directory))
+
+    cube=np.lib.format.open_memmap(os.path.join(directory,'cube.npy'),
+                                   mode='w+',dtype=np.int16,shape=shape)
+    for idx,key in enumerate(keys):
+        ds=gdal.Open(files[key],GA_ReadOnly)
+        if (ds.RasterYSize,ds.RasterXSize)!=shape[1:]:
+            raise ValueError('Composite %s is %dx%d, not %dx%d' %
+                             (files[key],ds.RasterXSize,ds.RasterYSize,
+                              shape[2],shape[1]))
+        for (xidx,yidx),strip in raster_blocks.iterate(ds.GetRasterBand(1),
+                                                       strategy='strip'):
+            cube[idx,yidx:yidx+strip.shape[0],:]=strip
+        ds=None
+        logger.debug('added %s' % files[key])
+    cube.flush()
+    del cube
+    np.save(os.path.join(directory,'keys.npy'),keys)
+
+
+
+class ndvi_cube(object):
+    '''
+    Read-only access to a cube written by build_cube().
+    '''
+    def __init__(self,directory):
+        self.cube=np.load(os.path.join(directory,'cube.npy'),mmap_mode='r')
+        self.keys=np.load(os.path.join(directory,'keys.npy'))
+
+    def time_index(self,keys):
+        '''
+        Position in the cube of each composite key.
+        '''
+        keys=np.asarray(keys)
+        where=np.searchsorted(self.keys,keys)
+        where=np.minimum(where,len(self.keys)-1)
+        missing=self.keys[where]!=keys
+        if np.any(missing):
+            key=int(np.atleast_1d(keys)[np.atleast_1d(missing)][0])
+            raise KeyError('No composite for year %d month %d half %d '
+                           'in the NDVI cube' % (key//24,(key%24)//2+1,key%2))
+        return where
+
+    def greens(self,when,x,y):
+        '''
+        NDVI at pixels x and lines y on the datetime.date.
+        '''
+        return self.cube[self.time_index(date_key(when)),y,x]
+
+    def traces(self,keys,x,y):
+        '''
+        NDVI at pixels x and lines y for each composite key.
+        Returns an array of shape (len(keys), len(x)).
+        '''
+        tidx=self.time_index(keys)
+        return self.cube[tidx[:,np.newaxis],y[np.newaxis,:],x[np.newaxis,:]]
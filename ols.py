@@ -3,6 +3,7 @@ from scipy import c_, ones, dot, stats, diff
 from scipy.linalg import inv, solve, det
 from numpy import log, pi, sqrt, square, diagonal
 from numpy.random import randn, seed
+import numpy as np
 import time
 
 class ols:
@@ -44,9 +45,11 @@ class ols:
     
     """
 
-    def __init__(self,y,x,y_varnm = 'y',x_varnm = ''):
+    def __init__(self,y,x,y_varnm = 'y',x_varnm = '',b = None,inv_xx = None):
         """
-        Initializing the ols class. 
+        Initializing the ols class. If b and inv_xx are given, as
+        ols_groups does after solving every group at once, they are
+        used instead of estimating them again.
         """
         self.y = y
         self.x = c_[ones(x.shape[0]),x]
@@ -57,7 +60,12 @@ class ols:
             self.x_varnm = ['const'] + x_varnm
 
         # Estimate model using OLS
-        self.estimate()
+        if b is None:
+            self.estimate()
+        else:
+            self.inv_xx = inv_xx
+            self.b = b
+            self.statistics()
 
     def estimate(self):
 
@@ -65,7 +73,12 @@ class ols:
         self.inv_xx = inv(dot(self.x.T,self.x))
         xy = dot(self.x.T,self.y)
         self.b = dot(self.inv_xx,xy)                    # estimate coefficients
+        self.statistics()
 
+    def statistics(self):
+        """
+        Statistics that follow from the coefficients and inv(X'X)
+        """
         self.nobs = self.y.shape[0]                     # number of observations
         self.ncoef = self.x.shape[1]                    # number of coef.
         self.df_e = self.nobs - self.ncoef              # degrees of freedom, error 
@@ -163,6 +176,231 @@ class ols:
         print 'BIC criterion        % -5.6f         Kurtosis            % -5.6f' % tuple([bic, kurtosis])
         print '=============================================================================='
 
+
+
+class ols_estimates:
+    """
+    The statistics of ols for many models at once, computed from the
+    sufficient statistics X'X, X'y, y'y, sum(y) and the count of each
+    model. Every attribute has one entry per model, along the first
+    axis, and models with no more observations than coefficients, or
+    whose X'X is singular, as when x is constant in a group, are nan.
+    The residual tests, dw(), omni() and JB(), need the residuals
+    themselves, so they are only on the ols models from ols_groups.
+    """
+
+    def __init__(self,xx,xy,yy,sum_y,nobs,ssr = None):
+        self.nobs = np.asarray(nobs,dtype=np.float64)
+        self.ncoef = xy.shape[1]
+        self.df_e = self.nobs - self.ncoef
+        self.df_r = self.ncoef - 1
+
+        fit = self.df_e > 0
+        if fit.any():
+            fit[fit] = np.linalg.matrix_rank(xx[fit]) == self.ncoef
+        self.inv_xx = np.empty_like(xx)
+        self.inv_xx.fill(np.nan)
+        if fit.any():
+            self.inv_xx[fit] = np.linalg.inv(xx[fit])   # one stacked solve
+        self.b = np.einsum('gij,gj->gi',self.inv_xx,xy)
+
+        if ssr is None:
+            ssr = yy - np.einsum('gi,gi->g',self.b,xy)
+        self.ssr = np.maximum(ssr,0)                     # sum of squared residuals
+        with np.errstate(divide='ignore',invalid='ignore'):
+            self.sse = self.ssr/self.df_e
+            self.se = sqrt(np.diagonal(self.inv_xx,axis1=1,axis2=2)*
+                           self.sse[:,np.newaxis])
+            self.t = self.b / self.se
+            self.p = (1-stats.t.cdf(abs(self.t),self.df_e[:,np.newaxis])) * 2
+
+            syy = yy - sum_y*sum_y/self.nobs
+            self.R2 = 1 - self.ssr/syy
+            self.R2adj = 1-(1-self.R2)*((self.nobs-1)/(self.nobs-self.ncoef))
+            self.F = (self.R2/self.df_r) / ((1-self.R2)/self.df_e)
+            self.Fpv = 1-stats.f.cdf(self.F,self.df_r,self.df_e)
+
+    def ll(self):
+        """
+        Model log-likelihood, AIC and BIC for every model
+        """
+        with np.errstate(divide='ignore',invalid='ignore'):
+            ll = -(self.nobs*1/2)*(1+log(2*pi)) - (self.nobs/2)*log(self.ssr/self.nobs)
+            aic = -2*ll/self.nobs + (2*self.ncoef/self.nobs)
+            bic = -2*ll/self.nobs + (self.ncoef*log(self.nobs))/self.nobs
+        return ll, aic, bic
+
+
+
+class ols_sums:
+    """
+    Sufficient statistics for ols for any number of groups, which
+    add() and remove() update a batch of rows at a time, so that a fit
+    over a growing set of observations, or a sliding window, never
+    looks at a row twice.
+
+        s = ols_sums(1)
+        s.add(y,x,groups=year)
+        s.remove(y_old,x_old,groups=year_old)
+        estimates = s.estimate()
+        print estimates.b[s.index[1999]]
+
+    x has ncoef-1 columns, and the constant is added as in ols.
+    Without groups, every row goes to the single group None.
+    """
+
+    def __init__(self,nvar):
+        k = nvar+1
+        self.keys = []
+        self.index = {}
+        self.xx = np.zeros((0,k,k))
+        self.xy = np.zeros((0,k))
+        self.yy = np.zeros(0)
+        self.sum_y = np.zeros(0)
+        self.nobs = np.zeros(0,dtype=np.int64)
+
+    def group_index(self,groups,cnt):
+        """
+        Index of each row's group, adding groups not seen before
+        """
+        if groups is None:
+            groups = np.zeros(cnt,dtype=object)
+            groups.fill(None)
+        uniq, inverse = np.unique(np.asarray(groups),return_inverse=True)
+        new = [key for key in uniq.tolist() if key not in self.index]
+        if new:
+            for key in new:
+                self.index[key] = len(self.keys)
+                self.keys.append(key)
+            extra = len(new)
+            self.xx = np.concatenate([self.xx,np.zeros((extra,)+self.xx.shape[1:])])
+            self.xy = np.concatenate([self.xy,np.zeros((extra,self.xy.shape[1]))])
+            self.yy = np.concatenate([self.yy,np.zeros(extra)])
+            self.sum_y = np.concatenate([self.sum_y,np.zeros(extra)])
+            self.nobs = np.concatenate([self.nobs,np.zeros(extra,dtype=np.int64)])
+        where = np.array([self.index[key] for key in uniq.tolist()],dtype=np.int64)
+        return where[inverse]
+
+    def update(self,y,x,groups,sign):
+        y = np.asarray(y,dtype=np.float64)
+        x = c_[ones(y.shape[0]),x]
+        idx = self.group_index(groups,y.shape[0])
+        cnt = len(self.keys)
+        k = x.shape[1]
+        for i in range(k):
+            for j in range(i,k):
+                total = np.bincount(idx,weights=x[:,i]*x[:,j],minlength=cnt)
+                self.xx[:,i,j] += sign*total
+                if j != i:
+                    self.xx[:,j,i] += sign*total
+            self.xy[:,i] += sign*np.bincount(idx,weights=x[:,i]*y,minlength=cnt)
+        self.yy += sign*np.bincount(idx,weights=y*y,minlength=cnt)
+        self.sum_y += sign*np.bincount(idx,weights=y,minlength=cnt)
+        self.nobs += sign*np.bincount(idx,minlength=cnt)
+
+    def add(self,y,x,groups = None):
+        self.update(y,x,groups,1)
+
+    def remove(self,y,x,groups = None):
+        """
+        Take out rows that were added before
+        """
+        self.update(y,x,groups,-1)
+
+    def estimate(self,ssr = None):
+        return ols_estimates(self.xx,self.xy,self.yy,self.sum_y,self.nobs,ssr)
+
+
+
+class ols_groups:
+    """
+    Fits a separate ols model to the rows of each group, all groups
+    solved together. The statistics for every group are arrays on
+    estimates, and model(key) is the full ols model for one group,
+    with its residuals, tests and summary().
+
+        g = ols_groups(days,lats,years,'day',['lat'])
+        g.model(1999).summary()
+    """
+
+    def __init__(self,y,x,groups,y_varnm = 'y',x_varnm = ''):
+        self.y = np.asarray(y,dtype=np.float64)
+        self.x = np.asarray(x,dtype=np.float64)
+        if self.x.ndim == 1:
+            self.x = self.x[:,np.newaxis]
+        self.y_varnm = y_varnm
+        self.x_varnm = x_varnm
+        self.sums = ols_sums(self.x.shape[1])
+        self.sums.add(self.y,self.x,groups)
+        self.keys = self.sums.keys
+        self.row_group = self.sums.group_index(groups,self.y.shape[0])
+
+        # Residuals are exact where y'y - b'X'y would lose precision.
+        rough = self.sums.estimate()
+        fitted = rough.b[self.row_group,0] + np.einsum('ni,ni->n',
+                    self.x,rough.b[self.row_group,1:])
+        self.e = self.y - fitted
+        ssr = np.bincount(self.row_group,weights=self.e*self.e,
+                          minlength=len(self.keys))
+        self.estimates = self.sums.estimate(ssr)
+
+    def model(self,key):
+        g = self.sums.index[key]
+        rows = self.row_group == g
+        return ols(self.y[rows],self.x[rows],self.y_varnm,self.x_varnm,
+                   b = self.estimates.b[g],inv_xx = self.estimates.inv_xx[g])
+
+    def models(self):
+        return dict([(key,self.model(key)) for key in self.keys])
+
+
+
+def test_groups():
+    seed(2)
+    data = randn(300,3)
+    groups = np.repeat([3,1,2],100)
+    g = ols_groups(data[:,0],data[:,1:],groups)
+    assert(g.keys == [1,2,3])
+    for key in g.keys:
+        rows = groups == key
+        single = ols(data[rows,0],data[rows,1:])
+        estimate = g.estimates
+        idx = g.sums.index[key]
+        for name in ['b','se','t','p','R2','R2adj','F','Fpv']:
+            assert(np.allclose(getattr(estimate,name)[idx],getattr(single,name)))
+        assert(np.allclose([v[idx] for v in estimate.ll()],single.ll()))
+        assert(np.allclose(g.model(key).JB(),single.JB()))
+
+    # A group with constant x can't be fit, but the others still are.
+    x = data[:,1:].copy()
+    x[groups == 2,0] = 1.5
+    g = ols_groups(data[:,0],x,groups)
+    bad = g.sums.index[2]
+    assert(np.isnan(g.estimates.b[bad]).all())
+    assert(np.isnan(g.estimates.R2[bad]))
+    rows = groups == 1
+    single = ols(data[rows,0],x[rows])
+    assert(np.allclose(g.estimates.b[g.sums.index[1]],single.b))
+
+    # A sliding window from sums matches fitting the window alone.
+    s = ols_sums(2)
+    s.add(data[:200,0],data[:200,1:])
+    s.remove(data[:50,0],data[:50,1:])
+    s.add(data[200:,0],data[200:,1:])
+    single = ols(data[50:,0],data[50:,1:])
+    assert(np.allclose(s.estimate().b[0],single.b))
+    assert(np.allclose(s.estimate().R2[0],single.R2))
+
+
+
+def suite():
+    import unittest
+    suite=unittest.TestSuite()
+    suite.addTest(unittest.FunctionTestCase(test_groups))
+    return suite
+
+
+
 if __name__ == '__main__':
 
 	##########################
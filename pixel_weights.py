@@ -0,0 +1,147 @@
+'''
+For each county, which GIMMS pixels cover its wheat, and with what
+weight. gimms.build computes these as a dictionary from geoid to
+(x, y, weights) arrays. Loading that dictionary from a pickle means
+reading all of it for every run, so this stores it as flat arrays,
+the way a sparse matrix stores rows:
+
+  geoids.npy   sorted geoids of counties with wheat
+  offsets.npy  county i owns entries offsets[i] to offsets[i+1]
+  x.npy        GIMMS pixel of each entry
+  y.npy        GIMMS line of each entry
+  weight.npy   weight of each entry, summing to one for each county
+  row.npy      row[geoid] is i for that county, or -1
+
+All of them are opened with np.load(mmap_mode='r'), so opening the
+index reads only what a lookup touches.
+'''
+import os
+import logging
+import numpy as np
+import luconfig
+
+logger=logging.getLogger('pixel_weights')
+
+_columns=['geoids','offsets','x','y','weight','row']
+
+
+def default_directory():
+    return os.path.join(luconfig.get('gimms'),'counties','weights')
+
+
+
+def write_index(counties,directory=None):
+    '''
+    Write the dictionary from gimms.build, geoid -> (x, y, weights),
+    as an index in the given directory.
+    '''
+    if not directory:
+        directory=default_directory()
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    geoids=np.array(sorted(counties),dtype=np.int32)
+    sizes=np.array([len(counties[g][0]) for g in geoids],dtype=np.int64)
+    offsets=np.zeros(len(geoids)+1,dtype=np.int64)
+    np.cumsum(sizes,out=offsets[1:])
+    columns=dict()
+    columns['geoids']=geoids
+    columns['offsets']=offsets
+    for name,col_idx,dtype in [('x',0,np.int32),('y',1,np.int32),
+                               ('weight',2,np.float64)]:
+        columns[name]=np.concatenate(
+            [np.asarray(counties[g][col_idx],dtype=dtype) for g in geoids]+
+            [np.zeros(0,dtype=dtype)])
+    row=-np.ones(geoids.max()+1 if len(geoids) else 0,dtype=np.int32)
+    row[geoids]=np.arange(len(geoids),dtype=np.int32)
+    columns['row']=row
+
+    for name in _columns:
+        np.save(os.path.join(directory,'%s.npy' % name),columns[name])
+    logger.info('wrote weights for %d counties, %d pixels to %s' %
+                (len(geoids),offsets[-1],directory))
+
+
+
+class weight_index(object):
+    '''
+    Read-only, dictionary-like view of the index. index[geoid] returns
+    (x, y, weights) the way the dictionary from gimms.build does,
+    except that the arrays are memory-mapped slices.
+    '''
+    def __init__(self,directory=None):
+        if not directory:
+            directory=default_directory()
+        for name in _columns:
+            path=os.path.join(directory,'%s.npy' % name)
+            if not os.path.exists(path):
+                raise IOError('No pixel weight index at %s. Make it with '
+                              'python gimms.py --weights.' % directory)
+            setattr(self,name,np.load(path,mmap_mode='r'))
+
+    def _row(self,geoid):
+        if geoid<0 or geoid>=len(self.row):
+            return -1
+        return self.row[geoid]
+
+    def __contains__(self,geoid):
+        return self._row(geoid)>=0
+
+    def __getitem__(self,geoid):
+        idx=self._row(geoid)
+        if idx<0:
+            raise KeyError(geoid)
+        begin,end=self.offsets[idx],self.offsets[idx+1]
+        return (self.x[begin:end],self.y[begin:end],self.weight[begin:end])
+
+    def __len__(self):
+        return len(self.geoids)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [int(g) for g in self.geoids]
+
+    def iteritems(self):
+        for geoid in self.keys():
+            yield geoid,self[geoid]
+
+
+
+def test_index():
+    import shutil
+    import tempfile
+    counties={20161 : ([3,4,5],[10,10,11],[0.5,0.25,0.25]),
+              1001 : ([7],[2],[1.0]),
+              30001 : ([],[],[]),
+              40119 : ([8,9],[1,1],[0.75,0.25])}
+    directory=tempfile.mkdtemp()
+    try:
+        write_index(counties,directory)
+        index=weight_index(directory)
+        assert(len(index)==4 and index.keys()==[1001,20161,30001,40119])
+        for geoid,(x,y,weights) in counties.iteritems():
+            assert(geoid in index)
+            got=index[geoid]
+            assert(got[0].tolist()==x and got[1].tolist()==y)
+            assert(got[2].tolist()==weights)
+        assert(len(index[30001][0])==0)
+        assert(sorted(dict(index.iteritems()))==index.keys())
+        for missing in [0,20160,99999,-1]:
+            assert(missing not in index)
+            try:
+                index[missing]
+                assert(False)
+            except KeyError:
+                pass
+    finally:
+        shutil.rmtree(directory)
+
+
+
+def suite():
+    import unittest
+    suite=unittest.TestSuite()
+    suite.addTest(unittest.FunctionTestCase(test_index))
+    return suite
@@ -10,6 +10,7 @@ from matplotlib.colors import colorConverter
 import logging
 import ols
 import county
+import rust_obs
 import state
 import aylor_corn
 import luconfig
@@ -61,32 +62,33 @@ def northward():
     return model
 
 
+def northward_by_year():
+    '''
+    Fit day of observation against latitude separately for each year,
+    all years at once, and print each year's rate of northward progress.
+    '''
+    table=rust_obs.load_table().located()
+    days=table['day'].astype(np.float64)
+    groups=ols.ols_groups(days,table['lat'],table['year'],'day',['lat'])
+    fits=groups.estimates
+    print 'year\tnobs\tintercept\tdays per degree\tstd err\tR2'
+    for idx,year in enumerate(groups.keys):
+        print '%d\t%d\t%g\t%g\t%g\t%g' % (year, fits.nobs[idx],
+            fits.b[idx,0], fits.b[idx,1], fits.se[idx,1], fits.R2[idx])
+    return groups
+
+
+
 def by_year():
-    f=luconfig.get('cereal_rust')
-    # This gets an array of [date,[lat,long]]
-    vals=county.observations_by_location(f)
-    default_year=datetime.date.today().year
-    dates=list()
+    table=rust_obs.load_table().located()
     years=list()
-    last_year=None
     all_dates=list()
-    dates=None
     all_lats=list()
-    lats=None
-    for r in vals:
-        d=r[0]
-        if d.year!=last_year:
-            if lats:
-                all_lats.append(lats)
-                all_dates.append(dates)
-            lats=list()
-            dates=list()
-            years.append(d.year)
-            last_year=d.year
-        dates.append(datetime.date(d.year,d.month,d.day))
-        lats.append(r[1][0])
-    all_lats.append(lats)
-    all_dates.append(dates)
+    for year in np.unique(table['year']).tolist():
+        this_year=table.where(year=year)
+        years.append(year)
+        all_dates.append(list(this_year['date'].astype(object)))
+        all_lats.append(this_year['lat'].tolist())
 
     colors=('b', 'g', 'r', 'c', 'm', 'y', 'k')*5
 
@@ -110,6 +112,18 @@ def by_year():
 
 
 
+def first_passage_by_day(year):
+    '''
+    (geoid, day of year, latitude) of the first observation in each
+    county in the year, ordered by day.
+    '''
+    table=rust_obs.load_table().located().where(year=year).first_passage()
+    order=np.argsort(table['day'],kind='mergesort')
+    return zip(table['fips'][order].tolist(),table['day'][order].tolist(),
+               table['lat'][order].tolist())
+
+
+
 def show_sos(year):
     '''
     SOS is the start of growing season. It's roughly 10% of total
@@ -117,24 +131,16 @@ def show_sos(year):
     '''
     year=int(year)
 
-    lat_longs=county.get_lat_long_by_county()
-
     green_start=dict()
     for line in csv.reader(open("sos%d.csv" % year)):
         idx, geoid, day_of_year = line
         if idx:
             green_start[int(geoid)]=int(math.floor(float(day_of_year)))
     
-    first_passage=county.get_first_passage()
-    this_passage=first_passage[year]
-
     build_data=list()
-    for day in sorted(this_passage):
-        counties=this_passage[day]
-        for geoid in counties:
-            lat=lat_longs[geoid][0]
-            sos=green_start[geoid]
-            build_data.append([geoid,day,sos,lat])
+    for geoid,day,lat in first_passage_by_day(year):
+        sos=green_start[geoid]
+        build_data.append([geoid,day,sos,lat])
 
     logger.debug('build_data len %d %s %s' % (len(build_data),
                                            str(type(build_data)),
@@ -190,18 +196,9 @@ def several_together(year):
     '''
     year=int(year)
 
-    lat_longs=county.get_lat_long_by_county()
-
-    
-    first_passage=county.get_first_passage()
-    this_passage=first_passage[year]
-
     build_data=list()
-    for day in sorted(this_passage):
-        counties=this_passage[day]
-        for geoid in counties:
-            lat=lat_longs[geoid][0]
-            build_data.append([geoid,day,lat])
+    for geoid,day,lat in first_passage_by_day(year):
+        build_data.append([geoid,day,lat])
 
     logger.debug('build_data len %d %s %s' % (len(build_data),
                                            str(type(build_data)),
@@ -269,6 +266,7 @@ if __name__ == '__main__':
     parser=DefaultArgumentParser(description='plots cereal rust')
     parser.add_function('together','print all observations together')
     parser.add_function('multiples','print years separately in small multiples')
+    parser.add_function('yearly','fit northward progress for each year')
     parser.add_function('several','corn, first_passage, wheat ground truth')
     parser.add_function('sos','Show the start of season graph.')
     parser.add_function('ground','show a ground truth graph of corn and emergence')
@@ -284,6 +282,9 @@ if __name__ == '__main__':
     if args.together:
         northward()
 
+    if args.yearly:
+        northward_by_year()
+
     if args.several:
         several_together(args.year)
 
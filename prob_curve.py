@@ -14,65 +14,188 @@ def logistic(t,t0,s=5):
     return 1/(1+np.exp(-(t-t0)/s))
 
 
-def gen_sim(day_cnt, sim_cnt):
+POPULATION=963
+MAX_BYTES=64*1024*1024
+
+
+def infection_prob(sim_days):
+    return 0.04*logistic(sim_days,100,7)
+
+
+
+def chunk_streams(seed, chunk_cnt):
+    '''
+    One random number generator for each chunk of simulations, each an
+    independent stream derived from seed, so that results depend only
+    on the seed and chunk size. Uses numpy's SeedSequence when this
+    numpy has it, or else seeds a RandomState for each chunk from a
+    master RandomState.
+    '''
+    if hasattr(np.random,'SeedSequence'):
+        children=np.random.SeedSequence(seed).spawn(chunk_cnt)
+        return [np.random.default_rng(child) for child in children]
+    master=np.random.RandomState(seed)
+    seeds=master.randint(0,2**31-1,size=chunk_cnt)
+    return [np.random.RandomState(s) for s in seeds]
+
+
+
+def chunk_size(day_cnt, max_bytes=MAX_BYTES):
+    '''
+    How many simulations fit in max_bytes of results.
+    '''
+    return max(1,int(max_bytes//(day_cnt*np.dtype(np.int).itemsize)))
+
+
+
+def simulate_chunk(prob, sim_cnt, stream, population=POPULATION):
+    '''
+    Infections by day for sim_cnt simulations, drawing one day of
+    every simulation at once. A simulation whose population runs out
+    draws binomial(0, p), which is 0.
+    '''
+    res=np.zeros((sim_cnt,len(prob)),np.int)
+    remaining=np.empty(sim_cnt,np.int)
+    remaining.fill(population)
+    for d in range(len(prob)):
+        infected=stream.binomial(remaining,prob[d])
+        res[:,d]=infected
+        remaining-=infected
+        if not remaining.any(): break
+    return res
+
+
+
+def simulate(day_cnt, sim_cnt, seed=None, max_bytes=MAX_BYTES):
+    '''
+    Generates (sim_days, chunk) for chunks of the simulations, each
+    chunk no larger than max_bytes.
+    '''
+    sim_days=np.arange(day_cnt,dtype=np.float)
+    prob=infection_prob(sim_days)
+    size=chunk_size(day_cnt,max_bytes)
+    chunk_cnt=int(math.ceil(sim_cnt/float(size)))
+    for idx,stream in enumerate(chunk_streams(seed,chunk_cnt)):
+        this_cnt=min(size,sim_cnt-idx*size)
+        logger.debug('chunk %d of %d, %d sims' % (idx+1,chunk_cnt,this_cnt))
+        yield sim_days, simulate_chunk(prob,this_cnt,stream)
+
+
+
+class moment_summary(object):
+    '''
+    Mean and standard deviation for each day, accumulated a chunk of
+    simulations at a time.
+    '''
+    def __init__(self, day_cnt):
+        self.count=0
+        self.total=np.zeros(day_cnt)
+        self.total_sq=np.zeros(day_cnt)
+
+    def add(self, chunk):
+        self.count+=chunk.shape[0]
+        self.total+=chunk.sum(axis=0)
+        self.total_sq+=(chunk.astype(np.float)**2).sum(axis=0)
+
+    def mean(self):
+        return self.total/self.count
+
+    def std(self):
+        mean=self.mean()
+        return np.sqrt(np.maximum(self.total_sq/self.count-mean*mean,0))
+
+
+
+def run_sim(day_cnt, sim_cnt, summaries, seed=None, max_bytes=MAX_BYTES):
+    '''
+    Run the simulations a chunk at a time, giving each chunk to the
+    add() method of each summary, so that the full matrix of results
+    is never in memory. Returns sim_days.
+    '''
+    sim_days=np.arange(day_cnt,dtype=np.float)
+    for sim_days,chunk in simulate(day_cnt,sim_cnt,seed,max_bytes):
+        for summary in summaries:
+            summary.add(chunk)
+    return sim_days
+
+
+
+def gen_sim(day_cnt, sim_cnt, seed=None, max_bytes=MAX_BYTES):
+    '''
+    All simulations as one (sim_cnt, day_cnt) matrix.
+    '''
     res=np.zeros((sim_cnt,day_cnt),np.int)
-    base_prob=lambda d: 0.04*logistic(d,100,7)
-    #base_prob=lambda d: 0.05
-    
     sim_days=np.arange(day_cnt,dtype=np.float)
-    prob=base_prob(sim_days)
-    for sim_idx in range(sim_cnt):
-        population=963
-        for d in sim_days:
-            infected=int(np.random.binomial(population,prob[d]))
-            res[sim_idx,d]=infected
-            population -= infected
-            if population<=0: break;
+    begin=0
+    for sim_days,chunk in simulate(day_cnt,sim_cnt,seed,max_bytes):
+        res[begin:begin+chunk.shape[0]]=chunk
+        begin+=chunk.shape[0]
     return(res, sim_days)
 
 
+
+class histogram_summary(object):
+    '''
+    For each day, how many simulations had each infection count,
+    accumulated a chunk of simulations at a time, so memory depends
+    only on the number of days and the largest count.
+    '''
+    def __init__(self, day_cnt, max_value=POPULATION):
+        self.day_cnt=day_cnt
+        self.width=max_value+1
+        self.counts=np.zeros((day_cnt,self.width),np.int64)
+
+    def add(self, chunk):
+        if chunk.min()<0 or chunk.max()>=self.width:
+            raise ValueError('Counts must be between 0 and %d.' %
+                             (self.width-1))
+        # Give each day its own range of bins so one bincount does all.
+        keys=chunk+np.arange(self.day_cnt)*self.width
+        self.counts+=np.bincount(keys.ravel(),
+            minlength=self.day_cnt*self.width).reshape(self.counts.shape)
+
+    def mode(self):
+        '''
+        The most common count each day, the smallest if there is a tie.
+        '''
+        return self.counts.argmax(axis=1)
+
+    def quantile(self, q):
+        '''
+        The smallest count each day that at least a fraction q of
+        simulations are at or below, and that some simulation had,
+        so q=0 gives the smallest count seen, not 0.
+        '''
+        cumulative=self.counts.cumsum(axis=1)
+        target=q*cumulative[:,-1]
+        reached=(cumulative>=target[:,np.newaxis]) & (cumulative>0)
+        return reached.argmax(axis=1)
+
+    def bounds(self, low=0.05, high=0.95):
+        '''
+        The mode and the low and high quantiles, as bounds() returns them.
+        '''
+        low_high=np.vstack([self.quantile(low),self.quantile(high)])
+        return self.mode(), low_high
+
+
+
 def bounds(res, sim_days):
-    sim_cnt=res.shape[0]
-    day_cnt=res.shape[1]
-
-    most=np.zeros(day_cnt,np.int)
-    low_high=np.zeros((2,day_cnt),np.int)
-    for ds in sim_days:
-        one=res[:,ds]
-        omin=np.min(one)
-        omax=np.max(one)
-        if omin!=omax:
-            hist=np.histogram(one, bins=np.arange(np.min(one),np.max(one)+2))
-            most[ds]=hist[1][hist[0].argmax()]
-            sum_one=np.sum(one)
-            low=None
-            high=None
-            for sim_idx in range(len(hist[0])):
-                if not low and hist[0][sim_idx]>0.05*sum_one:
-                    low=hist[1][sim_idx]
-                if not high and hist[0][sim_idx]>0.95*sum_one:
-                    high=hist[1][sim_idx]
-            if low:
-                low_high[0,ds]=low
-            else:
-                low_high[0,ds]=hist[1][0]
-            if high:
-                low_high[1,ds]=high
-            else:
-                low_high[1,ds]=hist[1][-1]
-        else:
-            most[ds]=one[0]
-            low_high[0,ds]=one[0]
-            low_high[0,ds]=one[0]
-
-    return most, low_high
+    '''
+    The mode and the 5% and 95% quantiles of each day of simulations.
+    '''
+    summary=histogram_summary(res.shape[1],max(0,int(res.max())))
+    summary.add(res)
+    return summary.bounds()
+
 
 
 def bounded_curve():
     sim_cnt=100000
     day_cnt=250
-    (res, sim_days)=gen_sim(day_cnt, sim_cnt)
-    most, low_high = bounds(res,sim_days)
+    histogram=histogram_summary(day_cnt)
+    sim_days=run_sim(day_cnt, sim_cnt, [histogram])
+    most, low_high = histogram.bounds()
 
     fig = plt.figure()
     ax = fig.add_subplot(111)
@@ -89,10 +212,10 @@ def bounded_curve():
 def curve():
     sim_cnt=1000
     day_cnt=250
-    (res, sim_days)=gen_sim(day_cnt, sim_cnt)
-    days=np.arange(0,day_cnt,dtype=np.float)
-    to_plot=np.average(res,0)
-    std_dev=np.std(res,0)
+    moments=moment_summary(day_cnt)
+    days=run_sim(day_cnt, sim_cnt, [moments])
+    to_plot=moments.mean()
+    std_dev=moments.std()
     logger.debug('days %d to_plot %s' % (len(days), str(to_plot.shape)))
 
     fig = plt.figure()
@@ -108,6 +231,55 @@ def curve():
 
 
 
+def test_simulate():
+    # The same seed gives the same simulations, for any chunk count.
+    first,days=gen_sim(30, 50, seed=7, max_bytes=30*8*16)
+    second,days=gen_sim(30, 50, seed=7, max_bytes=30*8*16)
+    assert((first==second).all())
+    assert(first.shape==(50,30) and (first.sum(axis=1)<=POPULATION).all())
+    other,days=gen_sim(30, 50, seed=8, max_bytes=30*8*16)
+    assert((first!=other).any())
+
+    # Summaries built a chunk at a time match the whole matrix.
+    moments=moment_summary(30)
+    run_sim(30, 50, [moments], seed=7, max_bytes=30*8*16)
+    assert(moments.count==50)
+    assert(np.allclose(moments.mean(),first.mean(axis=0)))
+    assert(np.allclose(moments.std()**2,first.var(axis=0)))
+
+
+
+def test_histogram():
+    # Twenty values a day, so these quantiles fall on whole ranks,
+    # where the lower percentile is the same definition.
+    values=np.array([[3,3,3,5,5,7,7,7,7,9,9,9,10,11,12,12,12,12,12,14],
+                     [2,2,4,4,4,4,4,6,6,6,8,8,8,8,8,8,9,9,9,9]]).T
+    summary=histogram_summary(2,20)
+    summary.add(values[:7])
+    summary.add(values[7:])
+    assert(summary.mode().tolist()==[12,8])
+    for q in [0,0.05,0.25,0.5,0.75,0.95,1]:
+        expected=np.percentile(values,100*q,axis=0,interpolation='lower')
+        assert(summary.quantile(q).tolist()==expected.tolist())
+    most,low_high=bounds(values,np.arange(2))
+    assert(most.tolist()==[12,8] and low_high.shape==(2,2))
+    try:
+        summary.add(values+20)
+        assert(False)
+    except ValueError:
+        pass
+
+
+
+def suite():
+    import unittest
+    suite=unittest.TestSuite()
+    suite.addTest(unittest.FunctionTestCase(test_simulate))
+    suite.addTest(unittest.FunctionTestCase(test_histogram))
+    return suite
+
+
+
 if __name__ == '__main__':
     parser=DefaultArgumentParser(description="county data")
     parser.add_function('curve','plot probability curve')
@@ -0,0 +1,329 @@
+'''
+Reads a GDAL raster band a piece at a time into numpy buffers that
+are made once and reused, including the smaller pieces at the right
+and bottom edges.
+
+  for (x,y),buf in raster_blocks.iterate(band):
+      total+=buf.sum()
+
+There are three ways to cut up the image.
+
+  line    one row at a time
+  strip   full-width bands of rows, as tall as fit in max_bytes
+  block   the file's own blocks, blocks_per_read of them side by side
+
+choose_strategy() picks one from the file's block layout. A window,
+(x offset, y offset, x size, y size), or an inset, (x size, y size)
+from the corner, restricts reading to part of the image. The buffer
+type follows the band, so byte CDL and int16 NDVI both work.
+
+prefetch() yields the same pieces, but threads read the next few
+while the caller works on the current one.
+'''
+import sys
+import Queue
+import logging
+import threading
+import collections
+import numpy as np
+import gdal
+from gdalconst import GA_ReadOnly
+
+logger=logging.getLogger('raster_blocks')
+
+
+STRIP_BYTES=256*1024*1024
+PREFETCH_DEPTH=4
+PREFETCH_BYTES=512*1024*1024
+STRATEGIES=['line','strip','block']
+
+
+def band_dtype(band):
+    '''
+    The numpy type that holds values of a band.
+    '''
+    types={gdal.GDT_Byte : np.uint8, gdal.GDT_UInt16 : np.uint16,
+           gdal.GDT_Int16 : np.int16, gdal.GDT_UInt32 : np.uint32,
+           gdal.GDT_Int32 : np.int32, gdal.GDT_Float32 : np.float32,
+           gdal.GDT_Float64 : np.float64}
+    if band.DataType not in types:
+        raise ValueError('No numpy type for GDAL type %d' % band.DataType)
+    return types[band.DataType]
+
+
+
+class buffer_pool(object):
+    '''
+    Hands out arrays by shape, making each shape only once, so
+    that the edge windows of an image reuse their buffers, too.
+    '''
+    def __init__(self,dtype=np.uint8):
+        self._dtype=dtype
+        self._buffers=dict()
+
+    def __call__(self,ysize,xsize):
+        key=(ysize,xsize)
+        if key not in self._buffers:
+            self._buffers[key]=np.zeros(key,dtype=self._dtype)
+        return self._buffers[key]
+
+
+
+def as_window(band,window=None,inset=None):
+    '''
+    The (x offset, y offset, x size, y size) to read, from a window,
+    an inset of (x size, y size) from the corner, or the whole band.
+    '''
+    if window is None:
+        if inset:
+            window=(0,0,inset[0],inset[1])
+        else:
+            window=(0,0,band.XSize,band.YSize)
+    (xoff,yoff,xsize,ysize)=[int(v) for v in window]
+    if (xoff<0 or yoff<0 or xsize<1 or ysize<1 or
+        xoff+xsize>band.XSize or yoff+ysize>band.YSize):
+        raise ValueError('Window %s is not within the %dx%d band' %
+                         (str(window),band.XSize,band.YSize))
+    return (xoff,yoff,xsize,ysize)
+
+
+
+def choose_strategy(block,xsize):
+    '''
+    Files whose blocks are rows read by line, files whose blocks span
+    the image read by strip, and tiled files read by block.
+    '''
+    if block[0]>=xsize:
+        if block[1]==1:
+            return 'line'
+        return 'strip'
+    return 'block'
+
+
+
+def strip_height(xsize,block_rows,max_bytes=STRIP_BYTES,pixel_bytes=1):
+    '''
+    How many rows of xsize pixels fit in max_bytes, rounded down to
+    whole blocks of block_rows when there is room for at least one,
+    so that no block of the file is read twice.
+    '''
+    rows=max(1,int(max_bytes//(xsize*pixel_bytes)))
+    if block_rows>1 and rows>=block_rows:
+        rows-=rows%block_rows
+    return rows
+
+
+
+def read_windows(xsize,ysize,block,blocks_per_read=1,xoff=0,yoff=0):
+    '''
+    Cover the window of xsize by ysize at (xoff,yoff) with windows
+    aligned to the block grid of the file, each of them blocks_per_read
+    blocks wide.
+
+    Yields: (x offset, y offset, x size, y size)
+    '''
+    step=block[0]*blocks_per_read
+    yidx=yoff
+    while yidx<yoff+ysize:
+        yend=min(yoff+ysize,(yidx//block[1]+1)*block[1])
+        xidx=xoff
+        while xidx<xoff+xsize:
+            xend=min(xoff+xsize,(xidx//step+1)*step)
+            yield (xidx,yidx,xend-xidx,yend-yidx)
+            xidx=xend
+        yidx=yend
+
+
+
+def strip_windows(xsize,ysize,rows,xoff=0,yoff=0):
+    '''
+    Full-width bands of rows rows each.
+
+    Yields: (x offset, y offset, x size, y size)
+    '''
+    for yidx in range(yoff,yoff+ysize,rows):
+        yield (xoff,yidx,xsize,min(rows,yoff+ysize-yidx))
+
+
+
+def windows(band,window=None,inset=None,strategy=None,blocks_per_read=1,
+            max_bytes=STRIP_BYTES,rows=None):
+    '''
+    The windows iterate() would read, for a band.
+    rows sets the height of a strip instead of max_bytes.
+    '''
+    (xoff,yoff,xsize,ysize)=as_window(band,window,inset)
+    block=band.GetBlockSize()
+    if not strategy:
+        strategy=choose_strategy(block,xsize)
+    if strategy=='line':
+        return strip_windows(xsize,ysize,1,xoff,yoff)
+    elif strategy=='strip':
+        if not rows:
+            itemsize=np.dtype(band_dtype(band)).itemsize
+            rows=strip_height(xsize,block[1],max_bytes,itemsize)
+        return strip_windows(xsize,ysize,rows,xoff,yoff)
+    elif strategy=='block':
+        return read_windows(xsize,ysize,block,blocks_per_read,xoff,yoff)
+    raise ValueError('Strategy %s is not one of %s' %
+                     (strategy,', '.join(STRATEGIES)))
+
+
+
+def read_window(band,window,buffers):
+    '''
+    Read (x offset, y offset, x size, y size) of band into a buffer
+    from the pool, which is returned.
+    '''
+    (xidx,yidx,xsize,ysize)=window
+    # Note that y and x are switched b/c that's how ReadAsArray works.
+    buf=buffers(ysize,xsize)
+    band.ReadAsArray(xidx,yidx,xsize,ysize,xsize,ysize,buf)
+    return buf
+
+
+
+def iterate(band,window=None,inset=None,strategy=None,blocks_per_read=1,
+            max_bytes=STRIP_BYTES,rows=None,buffers=None):
+    '''
+    Read a band piece by piece. The array yielded is overwritten by
+    the next read of the same shape, so copy it to keep it.
+
+    Yields: ((x,y) of corner in the band, numpy array of values)
+    '''
+    if buffers is None:
+        buffers=buffer_pool(band_dtype(band))
+    for read in windows(band,window,inset,strategy,blocks_per_read,
+                        max_bytes,rows):
+        yield (read[0],read[1]),read_window(band,read,buffers)
+
+
+
+def _prefetch_worker(filename,band_index,tasks):
+    '''
+    Reads windows from tasks into their buffers until it gets None.
+    Each thread opens its own dataset because GDAL handles must not be
+    used by two threads at once. If the open fails, every task gets
+    that error, so the caller never waits on a read that won't come.
+    '''
+    error=None
+    try:
+        ds=gdal.Open(filename,GA_ReadOnly)
+        if ds is None:
+            raise IOError('Could not open %s' % filename)
+        band=ds.GetRasterBand(band_index)
+    except Exception:
+        error=sys.exc_info()
+    while True:
+        task=tasks.get()
+        if task is None:
+            break
+        window,slot,box=task
+        if error:
+            box.put((None,error))
+            continue
+        try:
+            box.put((read_window(band,window,slot),None))
+        except Exception:
+            box.put((None,sys.exc_info()))
+
+
+
+def prefetch_depth(largest,depth=PREFETCH_DEPTH,memory=PREFETCH_BYTES):
+    '''
+    How many reads can be ahead of the caller when each takes at most
+    largest bytes. There are depth+1 buffers, one for the caller, and
+    they must fit in memory, but there is always at least one read ahead.
+    '''
+    return max(1,min(depth,int(memory//max(largest,1))-1))
+
+
+
+def prefetch(filename,band_index=1,window=None,inset=None,strategy=None,
+             blocks_per_read=1,max_bytes=STRIP_BYTES,rows=None,
+             depth=PREFETCH_DEPTH,threads=1,memory=PREFETCH_BYTES):
+    '''
+    Read a band piece by piece, like iterate(), while a pool of threads
+    reads up to depth pieces ahead into a ring of depth+1 buffers, so
+    GDAL decompresses the next blocks while the caller works on this
+    one. Depth is reduced until the ring fits in memory bytes. The
+    array yielded is reused once the caller asks for the next.
+
+    Yields: ((x,y) of corner in the band, numpy array of values)
+    '''
+    ds=gdal.Open(filename,GA_ReadOnly)
+    band=ds.GetRasterBand(band_index)
+    dtype=band_dtype(band)
+    reads=list(windows(band,window,inset,strategy,blocks_per_read,
+                       max_bytes,rows))
+    band=None
+    ds=None
+    if not reads:
+        return
+    itemsize=np.dtype(dtype).itemsize
+    largest=max([w*h for (x,y,w,h) in reads])*itemsize
+    depth=prefetch_depth(largest,depth,memory)
+    logger.debug('%d reads of up to %d bytes, %d ahead on %d threads' %
+                 (len(reads),largest,depth,threads))
+
+    ring=[buffer_pool(dtype) for idx in range(depth+1)]
+    tasks=Queue.Queue()
+    workers=[threading.Thread(target=_prefetch_worker,
+                              args=(filename,band_index,tasks))
+             for idx in range(threads)]
+    for worker in workers:
+        worker.daemon=True
+        worker.start()
+    try:
+        pending=collections.deque()
+        def submit(idx):
+            if idx<len(reads):
+                box=Queue.Queue(1)
+                tasks.put((reads[idx],ring[idx%len(ring)],box))
+                pending.append(box)
+        for idx in range(depth):
+            submit(idx)
+        for idx,read in enumerate(reads):
+            buf,error=pending.popleft().get()
+            if error:
+                raise error[0],error[1],error[2]
+            yield (read[0],read[1]),buf
+            # The slot the caller just let go of is the one this fills.
+            submit(idx+depth)
+    finally:
+        for worker in workers:
+            tasks.put(None)
+        for worker in workers:
+            worker.join()
+
+
+
+def test_windows():
+    def cover(gen,xoff,yoff,xsize,ysize):
+        seen=np.zeros((yoff+ysize,xoff+xsize),dtype=np.int)
+        for (x,y,w,h) in gen:
+            seen[y:y+h,x:x+w]+=1
+        assert((seen[yoff:,xoff:]==1).all())
+        assert(seen.sum()==xsize*ysize)
+    cover(read_windows(1000,700,(256,64),3),0,0,1000,700)
+    cover(read_windows(500,300,(256,64),1,100,30),100,30,500,300)
+    cover(strip_windows(500,301,50,10,20),10,20,500,301)
+    aligned=list(read_windows(500,300,(256,64),1,100,30))
+    assert(aligned[0]==(100,30,156,34))
+    assert(aligned[1]==(256,30,256,34))
+    assert(choose_strategy((1000,1),1000)=='line')
+    assert(choose_strategy((1000,64),1000)=='strip')
+    assert(choose_strategy((256,256),1000)=='block')
+    assert(strip_height(1000,64,1000*100)==64)
+    assert(strip_height(1000,64,1000*50)==50)
+    assert(prefetch_depth(100,4,1000)==4)
+    assert(prefetch_depth(300,4,1000)==2)
+    assert(prefetch_depth(3000,4,1000)==1)
+
+
+
+def suite():
+    import unittest
+    suite=unittest.TestSuite()
+    suite.addTest(unittest.FunctionTestCase(test_windows))
+    return suite
@@ -13,7 +13,6 @@ import os
 import itertools
 import csv
 import datetime
-import difflib
 import shapefile
 import traceback
 import collections
@@ -81,7 +80,7 @@ def normalize_county(fields):
     for f in fields:
         if f.has_key('error'): # Skip errors.
             yield f
-            next
+            continue
         county=f['county'].strip()
         state=f['state'].strip()
         if not state.isalpha() or not len(state) is 2:
@@ -111,39 +110,24 @@ def fix_stage(fields):
 
 _state_to_fips=statefips.state_fips()
 
-def generate_county_matches():
-    counties=county.county_basics()
-    fips_to_state=state.fips_to_state()
-
-    name_to_id=dict()
-    possibles=list()
-    for id,c in counties.iteritems():
-        for tag in ['NAME10','NAMELSAD10']:
-            full_name='%s,%s' % (c[tag].upper(),
-                                 fips_to_state[int(c['STATEFP10'])].upper())
-            name_to_id[full_name]=id
-            possibles.append(full_name)
-    return name_to_id, possibles
-
-
-
 def guess_county_id(fields):
-    name_to_id, possibles=generate_county_matches()
+    resolver=county.county_resolver()
 
     for f in fields:
         if f.has_key('error'):
             yield f
             next
         else:
-            maybe_name='%s,%s' % (f['county_adj'],f['state_adj'])
-            if name_to_id.has_key(maybe_name):
-                f['fips']=name_to_id[maybe_name]
+            geoid=0
+            if _state_to_fips.has_key(f['state_adj']):
+                geoid=resolver.resolve(_state_to_fips[f['state_adj']],
+                                       f['county_adj'])
+            if geoid:
+                f['fips']=geoid
             else:
-                possibles=difflib.get_close_matches(maybe_name,possibles)
-                logger.warning('Did not find county %s by name %s' %
-                               (maybe_name, str(possibles)))
                 f['error']='name not found'
             yield f
+    resolver.save()
 
 
 
@@ -218,10 +202,222 @@ def remove_west(fields):
 
 
 
-def basic_chain():
+def _column(lines,idx):
+    return np.array([line[idx] for line in lines],dtype=str)
+
+
+
+def _scalar_fallback(stage,cols,rows,names):
+    '''
+    Run one of the generator stages on the rows that the vectorized
+    code could not decide, so that odd values get exactly the same
+    treatment, and error messages, as in the generator chain.
+    '''
+    results=list()
+    for row in rows:
+        f=dict([(name,cols[name][row]) for name in names])
+        results.append((row,list(stage([f]))[0]))
+    return results
+
+
+
+def clean_batch(lines,first_line=0):
+    '''
+    The generator chain, from to_fields through fips_state, applied
+    to a list of csv lines at once. Returns a dictionary of columns:
+    the raw rust_fields as strings, plus
+
+      line         line number in the file
+      error        None, or the error message for the row
+      date_ok      whether date_adj and year_int are set
+      year_int     year as an integer
+      date_adj     date as numpy datetime64[D]
+      stage_ok     whether crop_stage_int and the _adj levels are set
+      crop_stage_int, severity_adj, prevalence_adj
+      normal_ok    whether state_adj and county_adj are set
+      state_adj, county_adj, fips, state_fips
+      fips_ok, state_fips_ok   whether those were assigned
+
+    Errors go into the error column, and later stages skip those rows,
+    just as the generators skip records with an error key.
+    '''
+    count=len(lines)
+    cols=dict()
+    for idx,name in enumerate(rust_fields):
+        cols[name]=_column(lines,idx)
+    cols['line']=np.arange(first_line,first_line+count)
+    error=np.empty(count,dtype=object)
+    cols['error']=error
+
+    # fix_date
+    year=np.char.strip(cols['year'])
+    date=np.char.strip(cols['date'])
+    slash=np.char.find(date,'/')>=0
+    parts=np.char.partition(date,'/')
+    month=parts[:,0]
+    day=np.char.partition(parts[:,2],'/')[:,0]
+    four=~slash & (np.char.str_len(date)==4)
+    if np.any(four):
+        pairs=date[four].astype('S4').view('S2').reshape((-1,2))
+        month=month.astype('S%d' % max(2,month.itemsize))
+        day=day.astype('S%d' % max(2,day.itemsize))
+        month[four]=pairs[:,0]
+        day[four]=pairs[:,1]
+    ok=((slash | four) & np.char.isdigit(year) & np.char.isdigit(month) &
+        np.char.isdigit(day))
+    year_int=np.where(ok,year,'0').astype(np.int64)
+    month_int=np.where(ok,month,'0').astype(np.int64)
+    day_int=np.where(ok,day,'0').astype(np.int64)
+    ok&=(year_int>=datetime.MINYEAR) & (year_int<=datetime.MAXYEAR)
+    ok&=(month_int>=1) & (month_int<=12)
+    month_start=np.where(ok,(year_int-1970)*12+month_int-1,0).astype(
+        'datetime64[M]')
+    month_days=((month_start+1).astype('datetime64[D]')-
+                month_start.astype('datetime64[D]')).astype(np.int64)
+    ok&=(day_int>=1) & (day_int<=month_days)
+    date_adj=month_start.astype('datetime64[D]')+np.where(ok,day_int-1,0)
+    date_adj[~ok]=np.datetime64('NaT')
+    for row,f in _scalar_fallback(fix_date,cols,np.where(~ok)[0],
+                                  ['year','date']):
+        if f.has_key('error'):
+            error[row]=f['error']
+        else:
+            ok[row]=True
+            year_int[row]=f['year']
+            date_adj[row]=np.datetime64(f['date_adj'])
+    cols['date_ok']=ok
+    cols['year_int']=year_int
+    cols['date_adj']=date_adj
+
+    # fix_stage
+    clean=np.equal(error,None)
+    stage=np.char.strip(cols['crop_stage'])
+    stage_ok=clean & np.char.isdigit(stage)
+    stage_int=np.where(stage_ok,stage,'0').astype(np.int64)
+    for name in ['severity','prevalence']:
+        cols['%s_adj' % name]=np.char.upper(np.char.strip(cols[name]))
+    for row,f in _scalar_fallback(fix_stage,cols,
+                                  np.where(clean & ~stage_ok)[0],
+                                  ['crop_stage','severity','prevalence']):
+        if type(f['crop_stage']) is int:
+            stage_ok[row]=True
+            stage_int[row]=f['crop_stage']
+    cols['stage_ok']=stage_ok
+    cols['crop_stage_int']=stage_int
+
+    # normalize_county
+    state_code=np.char.strip(cols['state'])
+    normal=np.char.isalpha(state_code) & (np.char.str_len(state_code)==2)
+    for row in np.where(clean & ~normal)[0]:
+        error[row]='The state is not normal %s' % state_code[row]
+    cols['normal_ok']=clean & normal
+    cols['state_adj']=np.char.upper(state_code)
+    cols['county_adj']=np.char.replace(
+        np.char.upper(np.char.strip(cols['county'])),'.','')
+
+    # guess_county_id
+    clean=np.equal(error,None)
+    fips=np.zeros(count,dtype=np.int64)
+    if np.any(clean):
+        resolver=county.county_resolver()
+        keys=np.char.add(np.char.add(cols['state_adj'][clean],','),
+                         cols['county_adj'][clean])
+        unique_keys,inverse=np.unique(keys,return_inverse=True)
+        geoids=np.zeros(len(unique_keys),dtype=np.int64)
+        for idx,key in enumerate(unique_keys):
+            state_name,county_name=key.split(',',1)
+            if _state_to_fips.has_key(state_name):
+                geoids[idx]=resolver.resolve(_state_to_fips[state_name],
+                                             county_name)
+        fips[clean]=geoids[inverse]
+        resolver.save()
+    for row in np.where(clean & (fips==0))[0]:
+        error[row]='name not found'
+    cols['fips']=fips
+    cols['fips_ok']=fips>0
+
+    # fips_state
+    clean=np.equal(error,None)
+    state_fips=np.zeros(count,dtype=np.int64)
+    state_fips_ok=clean.copy()
+    if np.any(clean):
+        state_to_fips=state.state_to_fips()
+        for name in np.unique(cols['state_adj'][clean]):
+            rows=clean & (cols['state_adj']==name)
+            if state_to_fips.has_key(name):
+                state_fips[rows]=state_to_fips[name]
+            else:
+                state_fips_ok[rows]=False
+                for row in np.where(rows)[0]:
+                    error[row]='Could not find fips state for "%s"' % name
+    cols['state_fips']=state_fips
+    cols['state_fips_ok']=state_fips_ok
+    return cols
+
+
+
+def batch_records(cols):
+    '''
+    The dictionaries that the generator chain would make from the
+    same lines as the columns from clean_batch.
+    '''
+    raw=[cols[name].tolist() for name in rust_fields]
+    c=dict()
+    for name in ['line','error','date_ok','year_int','stage_ok',
+                 'crop_stage_int','severity_adj','prevalence_adj',
+                 'normal_ok','state_adj','county_adj','fips','fips_ok',
+                 'state_fips','state_fips_ok']:
+        c[name]=cols[name].tolist()
+    c['date_adj']=cols['date_adj'].astype(object)
+    for row,values in enumerate(itertools.izip(*raw)):
+        f=dict(zip(rust_fields,values))
+        f['line']=c['line'][row]
+        if c['date_ok'][row]:
+            f['year']=c['year_int'][row]
+            f['date_adj']=c['date_adj'][row]
+        if c['stage_ok'][row]:
+            f['crop_stage']=c['crop_stage_int'][row]
+            f['severity']=c['severity_adj'][row]
+            f['prevalence']=c['prevalence_adj'][row]
+        if c['normal_ok'][row]:
+            f['state_adj']=c['state_adj'][row]
+            f['county_adj']=c['county_adj'][row]
+        if c['fips_ok'][row]:
+            f['fips']=c['fips'][row]
+        if c['state_fips_ok'][row]:
+            f['state_fips']=c['state_fips'][row]
+        if c['error'][row] is not None:
+            f['error']=c['error'][row]
+        yield f
+
+
+
+def batch_chain(lines,batch_size=10000):
+    '''
+    Clean lines in batches with clean_batch and yield the same records
+    as the generator chain.
+    '''
+    first_line=0
+    while True:
+        batch=list(itertools.islice(lines,batch_size))
+        if not batch:
+            break
+        for f in batch_records(clean_batch(batch,first_line)):
+            yield f
+        first_line+=len(batch)
+
+
+
+def basic_chain(batch=False):
+    '''
+    Cleaned records from the cereal rust file. With batch=True, the
+    cleaning is done with numpy arrays, a batch of lines at a time.
+    '''
     obs_file=luconfig.get('cereal_rust')
 
     lines=csv.reader(open(obs_file,'rU'))
+    if batch:
+        return batch_chain(lines)
     fields=to_fields(lines)
     fields=fix_date(fields)
     fields=fix_stage(fields)
@@ -231,33 +427,29 @@ def basic_chain():
     return fields
 
 def get_first_passage():
-    fields=basic_chain()
-    return first_passage(fields)
+    import rust_obs
+    table=rust_obs.load_table().valid()
+    return table.first_passage().records()
 
 
 def get_all_cov():
-    fields=basic_chain()
-    fields=has_severity_and_prevalence(fields)
-    return fields
+    import rust_obs
+    table=rust_obs.load_table().with_severity_and_prevalence()
+    return table.records()
 
 
 def get_first_passage_all_cov():
-    fields=get_all_cov()
-    fields=remove_west(fields)
-    return first_passage(fields)
+    import rust_obs
+    table=rust_obs.load_table().with_severity_and_prevalence()
+    return table.remove_west().first_passage().records()
 
 
 def same_county_multiple_stages():
-    # key = (year,county), value=(date, stage, severity, prevalence)
-    results=collections.defaultdict(list)
-    fields=get_all_cov()
-    for f in fields:
-        key=(f['year'], f['fips'])
-        results[key].append(tuple([f[x] for x in ['date_adj','crop_stage',
-                                                  'severity','prevalence']]))
+    import rust_obs
+    table=rust_obs.load_table().with_severity_and_prevalence()
     counts=collections.defaultdict(int)
-    for k, v in results.iteritems():
-        counts[len(v)]+=1
+    for k, v in table.group_counts(['year','fips']).iteritems():
+        counts[v]+=1
 
     for cnt in sorted(counts):
         print cnt, counts[cnt]
@@ -441,8 +633,60 @@ def plot_severity(tag='severity'):
     plt.show()
     
 
+def test_batch_chain():
+    import county_match
+    def line(year,date,state_code,name,stage,severity='TR',prevalence='TR'):
+        return [year,'c','i',date,state_code,name,'W',stage,'cv',
+                severity,prevalence,'s','e']
+    lines=[line('1990','5/14','ks','Riley',' 5',' tr','lt'),
+           line('1991','0602','OK','Payne.','x','MD','hv'),
+           line('1990','5/20','KS','Nowhere','3'),
+           line('1990','13/40','KS','Riley','3'),
+           line('1990','5/1','K1','Riley','3'),
+           line('1992','2/29','KS','Riley','-1','LT','MD'),
+           line('1993','2/29','KS','Riley','3')]
+    rows=[(20,20161,['Riley','Riley County']),
+          (40,40119,['Payne','Payne County'])]
+    # The county and state lookups read shapefiles, so use small ones.
+    saved=(county.county_resolver,state.state_to_fips)
+    county.county_resolver=lambda: county_match.county_resolver(rows)
+    state.state_to_fips=lambda: {'KS' : 20, 'OK' : 40}
+    try:
+        fields=to_fields(iter(lines))
+        fields=fix_date(fields)
+        fields=fix_stage(fields)
+        fields=normalize_county(fields)
+        fields=guess_county_id(fields)
+        fields=fips_state(fields)
+        expected=list(fields)
+        # Batches of four make the line numbers carry across batches.
+        batched=list(batch_chain(iter(lines),batch_size=4))
+    finally:
+        county.county_resolver,state.state_to_fips=saved
+    assert(len(batched)==len(expected))
+    for got,want in zip(batched,expected):
+        assert(got==want)
+    assert(expected[0]['fips']==20161 and expected[0]['state_fips']==20)
+    assert(expected[1]['fips']==40119 and expected[1]['crop_stage']=='x')
+    assert(expected[2]['error']=='name not found')
+    assert(expected[3]['error'].startswith('Date error'))
+    assert(expected[4]['error'].startswith('The state is not normal'))
+    assert(expected[5]['crop_stage']==-1)
+    assert(expected[6]['error'].startswith('Date error'))
+
+
+
+def suite():
+    import unittest
+    suite=unittest.TestSuite()
+    suite.addTest(unittest.FunctionTestCase(test_batch_chain))
+    return suite
+
+
+
 if __name__ == '__main__':
-    parser=DefaultArgumentParser(description="read observation data")
+    parser=DefaultArgumentParser(description="read observation data",
+                                 suite=suite)
     parser.add_function('fields','show fields in the county dataset')
     parser.add_function('plotstage','plot the crop stage histogram')
     parser.add_function('firstr','write first passage to R with extra '
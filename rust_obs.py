@@ -0,0 +1,492 @@
+'''
+The cereal rust observations, cleaned once and kept on disk as one
+numpy structured array, so that plots don't read and clean the csv
+every time they need it.
+
+The array is made with rolling.clean_batch. It has one row per line
+of the csv, including lines with errors, and these fields:
+
+  line        line number in the csv
+  year        year of the observation
+  date        datetime64[D], NaT when the date couldn't be read
+  state       two-letter state
+  state_fips  fips code of the state
+  fips        geoid of the county, 0 when it wasn't found
+  lat, lon    interior point of the county
+  stage       crop stage, -1 when it isn't a number
+  severity    severity level, such as TR or HV
+  prevalence  prevalence level
+  error       one of the ERROR_ codes below
+
+The file is named for a hash of the csv, of the county override
+table, of the county shapefile's dbf, and of CLEANING_VERSION, so it
+is made again whenever any of those change. Change CLEANING_VERSION
+when cleaning changes.
+'''
+import os
+import csv
+import hashlib
+import tempfile
+import logging
+import numpy as np
+import luconfig
+import memoize
+import county
+import rolling
+
+logger=logging.getLogger('rust_obs')
+
+CLEANING_VERSION=1
+
+ERROR_NONE=0
+ERROR_DATE=1
+ERROR_STATE=2
+ERROR_COUNTY=3
+ERROR_STATE_FIPS=4
+
+
+def content_hash(filenames):
+    '''
+    sha1 of the contents of the files, and of the cleaning version.
+    Files that don't exist count as empty.
+    '''
+    digest=hashlib.sha1('rust_obs %d' % CLEANING_VERSION)
+    for filename in filenames:
+        if filename and os.path.exists(filename):
+            digest.update(open(filename,'rb').read())
+        digest.update('\0')
+    return digest.hexdigest()
+
+
+
+def source_files(obs_file):
+    '''
+    The files that cleaning reads: the csv, the override table, and
+    the dbf of the county shapefile, for county names and locations.
+    '''
+    return [obs_file,county.county_override_file(),county.county_files()[2]]
+
+
+
+def source_stamp(obs_file,directory=None):
+    '''
+    Names and modification times of the source files, which is cheap
+    to check, unlike the hash, so loaded observations are kept by it.
+    '''
+    return (directory,tuple([(f,os.path.getmtime(f)
+                               if f and os.path.exists(f) else None)
+                              for f in source_files(obs_file)]))
+
+
+
+def store_path(obs_file,directory=None):
+    '''
+    Where the cleaned observations for this csv are saved.
+    '''
+    key=content_hash(source_files(obs_file))
+    return os.path.join(directory or memoize.cache_directory(),
+                        'rust_obs-%s.npy' % key)
+
+
+
+def observation_dtype(severity_size=2,prevalence_size=2):
+    '''
+    The fields described at the top of this file, with severity and
+    prevalence strings of the given sizes.
+    '''
+    return [('line',np.int32),('year',np.int16),('date','M8[D]'),
+            ('state','S2'),('state_fips',np.int16),('fips',np.int32),
+            ('lat',np.float64),('lon',np.float64),('stage',np.int16),
+            ('severity','S%d' % severity_size),
+            ('prevalence','S%d' % prevalence_size),
+            ('error',np.int8)]
+
+
+
+def clean_observations(obs_file):
+    '''
+    Clean the csv with rolling.clean_batch and return the array
+    described at the top of this file.
+    '''
+    lines=list(csv.reader(open(obs_file,'rU')))
+    cols=rolling.clean_batch(lines)
+    count=len(lines)
+    width=lambda name: max(1,cols[name].itemsize)
+    dtype=observation_dtype(width('severity_adj'),width('prevalence_adj'))
+    obs=np.zeros(count,dtype=dtype)
+    obs['line']=cols['line']
+    obs['year']=np.where(cols['date_ok'],cols['year_int'],0)
+    obs['date']=cols['date_adj']
+    obs['state']=np.where(cols['normal_ok'],cols['state_adj'],'')
+    obs['state_fips']=cols['state_fips']
+    obs['fips']=cols['fips']
+    obs['stage']=np.where(cols['stage_ok'],cols['crop_stage_int'],-1)
+    obs['severity']=cols['severity_adj']
+    obs['prevalence']=cols['prevalence_adj']
+
+    lat_longs=county.get_lat_long_by_county()
+    for geoid in np.unique(obs['fips'][obs['fips']>0]):
+        lat,lon=lat_longs[geoid]
+        at=obs['fips']==geoid
+        obs['lat'][at]=lat
+        obs['lon'][at]=lon
+
+    error=np.zeros(count,dtype=np.int8)
+    error[~cols['state_fips_ok']]=ERROR_STATE_FIPS
+    error[~cols['fips_ok']]=ERROR_COUNTY
+    error[~cols['normal_ok']]=ERROR_STATE
+    error[~cols['date_ok']]=ERROR_DATE
+    obs['error']=error
+    return obs
+
+
+
+_loaded=dict()
+
+def observations(obs_file=None,directory=None):
+    '''
+    The cleaned observations for the csv, from the cache if it is
+    there and current, otherwise cleaned and saved to the cache.
+    '''
+    if not obs_file:
+        obs_file=luconfig.get('cereal_rust')
+    stamp=source_stamp(obs_file,directory)
+    if stamp in _loaded:
+        return _loaded[stamp]
+    path=store_path(obs_file,directory)
+    if os.path.exists(path):
+        logger.debug('reading observations from %s' % path)
+        _loaded[stamp]=np.load(path)
+        return _loaded[stamp]
+
+    obs=clean_observations(obs_file)
+    # Cleaning can add to the override table, so name the file after.
+    path=store_path(obs_file,directory)
+    directory=os.path.dirname(path)
+    try:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        handle,tmp_path=tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle,'wb') as out:
+            np.save(out,obs)
+        os.rename(tmp_path,path)
+        logger.info('saved %d observations to %s' % (len(obs),path))
+    except (IOError,OSError),e:
+        logger.warning('Could not save observations: %s' % e)
+    _loaded[source_stamp(obs_file,directory)]=obs
+    return obs
+
+
+
+SEVERITY_LEVELS=['TR','LT','MD','HV','VB']
+WEST_STATES=['WA','OR','ID','CA','NV','UT','AZ']
+
+
+class observation_table(object):
+    '''
+    Observations from observations(), with indexes on year, state
+    fips, county fips and day of the year. Methods that choose rows
+    return a new table, with rows in the same order as the csv, so
+    they chain:
+
+      table=load_table().with_severity_and_prevalence().remove_west()
+      for rec in table.first_passage().records(): ...
+    '''
+    indexed=['year','state_fips','fips','day']
+
+    def __init__(self,obs,extra=None):
+        self.obs=obs
+        if extra is None:
+            start=(obs['year']-1970).astype('datetime64[Y]').astype(
+                'datetime64[D]')
+            day=(obs['date']-start).astype(np.int64)
+            day[np.isnat(obs['date'])]=-1
+            extra={'day' : day}
+        self.extra=extra
+        self._index=dict()
+        for name in self.indexed:
+            order=np.argsort(self[name],kind='mergesort')
+            self._index[name]=(order,self[name][order])
+
+
+    def __len__(self):
+        return len(self.obs)
+
+
+    def __getitem__(self,name):
+        if name in self.extra:
+            return self.extra[name]
+        return self.obs[name]
+
+
+    def take(self,rows):
+        extra=dict([(k,v[rows]) for (k,v) in self.extra.iteritems()])
+        return observation_table(self.obs[rows],extra)
+
+
+    def filter(self,mask):
+        return self.take(np.where(mask)[0])
+
+
+    def lookup(self,name,values):
+        '''
+        Rows where the indexed column has any of the values.
+        '''
+        order,ordered=self._index[name]
+        values=np.atleast_1d(values)
+        begin=np.searchsorted(ordered,values,side='left')
+        end=np.searchsorted(ordered,values,side='right')
+        if len(values)==1:
+            return np.sort(order[begin[0]:end[0]])
+        return np.sort(np.concatenate(
+            [order[b:e] for (b,e) in zip(begin,end)]+[order[:0]]))
+
+
+    def where(self,**conditions):
+        '''
+        Rows that match every condition, such as where(year=1990,
+        state_fips=[20,40]), using the indexes.
+        '''
+        rows=None
+        for name,values in conditions.iteritems():
+            found=self.lookup(name,values)
+            if rows is None:
+                rows=found
+            else:
+                rows=np.intersect1d(rows,found,assume_unique=True)
+        if rows is None:
+            return self
+        return self.take(rows)
+
+
+    def valid(self):
+        return self.filter(self['error']==ERROR_NONE)
+
+
+    def located(self):
+        '''
+        Rows whose date and county are known, even if the state
+        isn't in the state shapefile.
+        '''
+        return self.filter((self['fips']>0) & (self['day']>=0))
+
+
+    def remove_west(self,states=WEST_STATES):
+        '''
+        The western US is throwing things off because their weather is
+        quite different. They tend to be much later.
+        '''
+        return self.filter(~np.in1d(self['state'],states))
+
+
+    def with_severity_and_prevalence(self,levels=SEVERITY_LEVELS[:4]):
+        '''
+        Valid rows with a crop stage other than 99 and severity and
+        prevalence in levels, with severity_level and prevalence_level
+        columns added.
+        '''
+        keep=((self['error']==ERROR_NONE) & (self['stage']>=0) &
+              (self['stage']!=99) & np.in1d(self['severity'],levels) &
+              np.in1d(self['prevalence'],levels))
+        table=self.filter(keep)
+        for name in ['severity','prevalence']:
+            level=np.zeros(len(table),dtype=np.int64)
+            for idx,value in enumerate(levels):
+                level[table[name]==value]=idx
+            table.extra['%s_level' % name]=level
+        return table
+
+
+    def first_passage(self):
+        '''
+        The first row of each county in each year.
+        '''
+        key=self['year'].astype(np.int64)*100000+self['fips']
+        unique_keys,first=np.unique(key,return_index=True)
+        return self.take(np.sort(first))
+
+
+    def first_passage_by_year(self):
+        '''
+        year -> day of the year -> list of counties first seen that day,
+        like county.first_passage_by_year.
+        '''
+        first=self.first_passage()
+        by_year=dict()
+        for year,day,fips in zip(first['year'].tolist(),
+                                 first['day'].tolist(),
+                                 first['fips'].tolist()):
+            by_year.setdefault(year,dict()).setdefault(day,list()).append(fips)
+        return by_year
+
+
+    def group_counts(self,names):
+        '''
+        Dictionary from each tuple of values of the named columns to
+        how many rows have it.
+        '''
+        if not len(self):
+            return dict()
+        keys=np.rec.fromarrays([self[name] for name in names],names=names)
+        unique_keys,counts=np.unique(keys,return_counts=True)
+        return dict(zip([tuple(k) for k in unique_keys.tolist()],
+                        counts.tolist()))
+
+
+    def records(self):
+        '''
+        A dictionary for each row, with the keys of rolling's records
+        that these columns cover.
+        '''
+        dates=self['date'].astype(object)
+        stages=self['stage'].tolist()
+        columns=dict([(name,self[name].tolist()) for name in
+                      ['line','year','state','state_fips','fips',
+                       'severity','prevalence']])
+        levels=[name for name in ['severity_level','prevalence_level']
+                if name in self.extra]
+        for name in levels:
+            columns[name]=self[name].tolist()
+        for idx in range(len(self)):
+            rec={'line' : columns['line'][idx],
+                 'year' : columns['year'][idx],
+                 'date_adj' : dates[idx],
+                 'state_adj' : columns['state'][idx],
+                 'state_fips' : columns['state_fips'][idx],
+                 'fips' : columns['fips'][idx],
+                 'crop_stage' : stages[idx] if stages[idx]>=0 else None,
+                 'severity' : columns['severity'][idx],
+                 'prevalence' : columns['prevalence'][idx]}
+            for name in levels:
+                rec[name]=columns[name][idx]
+            yield rec
+
+
+
+def load_table(obs_file=None):
+    return observation_table(observations(obs_file))
+
+
+
+def test_store():
+    import shutil
+    import county_match
+    import state
+    directory=tempfile.mkdtemp()
+    obs_file=os.path.join(directory,'rust.csv')
+    dbf=os.path.join(directory,'counties.dbf')
+    with open(obs_file,'wb') as out:
+        for (date,name) in [('5/14','Riley'),('5/20','Nowhere')]:
+            csv.writer(out).writerow(['1990','c','i',date,'KS',name,'W','5',
+                                      'cv','TR','LT','s','e'])
+    open(dbf,'wb').write('first')
+    # Small stand-ins for what cleaning reads from the shapefiles.
+    saved=(county.county_resolver,county.county_override_file,
+           county.county_files,county.get_lat_long_by_county,
+           state.state_to_fips)
+    county.county_resolver=lambda: county_match.county_resolver(
+        [(20,20161,['Riley','Riley County'])])
+    county.county_override_file=lambda: None
+    county.county_files=lambda: ['','',dbf]
+    county.get_lat_long_by_county=lambda: {20161 : (39.3,-96.7)}
+    state.state_to_fips=lambda: {'KS' : 20}
+    try:
+        _loaded.clear()
+        obs=observations(obs_file,directory)
+        assert(obs['fips'].tolist()==[20161,0])
+        assert(obs['error'].tolist()==[ERROR_NONE,ERROR_COUNTY])
+        assert(obs['lat'][0]==39.3 and obs['lon'][0]==-96.7)
+        assert(observations(obs_file,directory) is obs)
+        stored=lambda: sorted([name for name in os.listdir(directory)
+                               if name.startswith('rust_obs-')])
+        assert(len(stored())==1)
+
+        # A new process reads the saved file instead of cleaning.
+        _loaded.clear()
+        assert(observations(obs_file,directory).tolist()==obs.tolist())
+        assert(len(stored())==1)
+
+        # Changing the county shapefile makes a new file.
+        first=stored()
+        open(dbf,'wb').write('second')
+        later=os.path.getmtime(dbf)+10
+        os.utime(dbf,(later,later))
+        assert(observations(obs_file,directory) is not obs)
+        assert(len(stored())==2 and first[0] in stored())
+    finally:
+        (county.county_resolver,county.county_override_file,
+         county.county_files,county.get_lat_long_by_county,
+         state.state_to_fips)=saved
+        _loaded.clear()
+        shutil.rmtree(directory)
+
+
+
+def test_table():
+    import datetime
+    import collections
+    # Records as the generator chain in rolling makes them.
+    rows=[(1990,(5,14),'KS',20161,5,'TR','LT',None),
+          (1990,(5,10),'KS',20161,7,'MD','HV',None),
+          (1990,(5,20),'KS',20149,99,'TR','TR',None),
+          (1990,(6,1),'OK',40119,3,'VB','TR',None),
+          (1991,(4,2),'KS',20161,4,'HV','HV',None),
+          (1991,(4,2),'WA',53001,5,'LT','LT',None),
+          (1990,None,'KS',0,3,'TR','TR',ERROR_DATE),
+          (1990,(5,25),'KS',0,3,'TR','TR',ERROR_COUNTY),
+          (1991,(5,1),'ZZ',40119,3,'TR','TR',ERROR_STATE_FIPS),
+          (1991,(4,30),'KS',20149,None,'TR','TR',None)]
+    state_fips={'KS' : 20, 'OK' : 40, 'WA' : 53}
+    records=list()
+    obs=np.zeros(len(rows),dtype=observation_dtype())
+    for idx,(year,day,state,fips,stage,severity,prevalence,error) in \
+            enumerate(rows):
+        rec={'line' : idx, 'year' : year, 'state_adj' : state,
+             'fips' : fips, 'state_fips' : state_fips.get(state,0),
+             'crop_stage' : stage, 'severity' : severity,
+             'prevalence' : prevalence}
+        if day:
+            rec['date_adj']=datetime.date(year,day[0],day[1])
+        if error:
+            rec['error']='error %d' % error
+        records.append(rec)
+        obs[idx]=(idx,year,rec.get('date_adj','NaT'),state,
+                  rec['state_fips'],fips,0,0,-1 if stage is None else stage,
+                  severity,prevalence,error or ERROR_NONE)
+    table=observation_table(obs)
+    copies=lambda: [dict(r) for r in records]
+
+    fp=rolling.first_passage(iter(copies()))
+    expected=county.first_passage_by_year(
+        [(r['date_adj'],None,r['fips']) for r in fp])
+    assert(table.valid().first_passage_by_year()==expected)
+    located=[(r['date_adj'],None,r['fips']) for r in records
+             if r['fips']>0 and 'date_adj' in r]
+    assert(table.located().first_passage_by_year()==
+           county.first_passage_by_year(located))
+
+    covered=list(rolling.has_severity_and_prevalence(iter(copies())))
+    with_levels=table.with_severity_and_prevalence()
+    assert(with_levels['line'].tolist()==[r['line'] for r in covered])
+    for names in [['year','fips'],['severity_level','prevalence_level']]:
+        counts=collections.defaultdict(int)
+        for r in covered:
+            counts[tuple([r[name] for name in names])]+=1
+        assert(with_levels.group_counts(names)==dict(counts))
+    east=rolling.first_passage(rolling.remove_west(iter(covered)))
+    assert(with_levels.remove_west().first_passage()['line'].tolist()==
+           [r['line'] for r in east])
+
+    assert(table.where(year=1990,state_fips=[20,40])['line'].tolist()==
+           [r['line'] for r in records
+            if r['year']==1990 and r['state_fips'] in (20,40)])
+    assert(len(table.where(fips=99999))==0)
+
+
+
+def suite():
+    import unittest
+    suite=unittest.TestSuite()
+    suite.addTest(unittest.FunctionTestCase(test_store))
+    suite.addTest(unittest.FunctionTestCase(test_table))
+    return suite
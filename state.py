@@ -12,7 +12,7 @@ import logging
 import ogr # gdal/ogr
 from default_parser import DefaultArgumentParser
 import luconfig
-from memoize import memoized
+from memoize import memoized, memoized_with
 
 
 logger=logging.getLogger('state')
@@ -212,7 +212,15 @@ def retrieve_states(url):
 
     
 
-@memoized
+def state_files():
+    '''
+    The parts of the state shapefile that state_basics reads.
+    '''
+    base=os.path.splitext(luconfig.get('state'))[0]
+    return ['%s.shp' % base, '%s.shx' % base, '%s.dbf' % base]
+
+
+@memoized_with(depends=state_files)
 def state_basics():
     '''
     The shapefile has simple information, plus geometry. This returns
@@ -40,7 +40,17 @@ CDLS="${TMPDIR}/${CDLSDIR}/${CDLSNAME}"
 COUNTY="${TMPDIR}/${COUNTYDIR}/${COUNTYNAME}"
 NDVI="${TMPDIR}/${NDVIDIR}/${NDVINAME}"
 
+# The journal lives in the source directory so the next job resumes.
+python county_server.py --serve --journal county_journal.csv &
+server=$!
+sleep 5
+
 for t in {1..8}
 do
     ./fly.sh "${CDLS}" "${COUNTY}" "${NDVI}" "${script_start}" "${NEAR_END}"&
+    workers="${workers} $!"
 done
+
+wait ${workers}
+python county_client.py --stats
+kill ${server}
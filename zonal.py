@@ -0,0 +1,429 @@
+'''
+This finds how much of each CDL cover code lies in each GIMMS NDVI
+cell of each county. It writes the same tab-delimited stream as
+triple --point, which gimms.read_code_stream and gimms.build read:
+
+  geoid  ndvi_x  ndvi_y  cover  square_meters
+
+Lines come sorted by geoid, not in the layer order triple uses.
+The triple program intersects polygons for every CDL pixel in every
+NDVI cell, which is why it needed a cluster queue. This version works
+through the CDL in tiles. For each tile, it rasterizes the counties
+onto the CDL grid in one GDAL call, maps every CDL pixel center to
+its GIMMS cell with an affine transform fit to that tile, packs
+(county, ndvi cell, cover) into one integer, and counts pixels with
+np.bincount. A pixel belongs to a county when its center is inside
+the county, which is what triple --point does.
+
+  python zonal.py --cdls 2011_30m_cdls.img --ndvi sample.tif \
+      --counties tl_2010_us_county10.shp --out counties.txt
+'''
+import sys
+import time
+import logging
+import numpy as np
+import gdal
+import ogr
+import osr
+from gdalconst import GA_ReadOnly
+from default_parser import DefaultArgumentParser
+import luconfig
+from gimms import GIMMS_PROJ4
+
+
+logger=logging.getLogger('zonal')
+
+
+# Alaska, American Samoa, Guam, Hawaii, Puerto Rico, Virgin Islands
+# are outside of the CDL, as in triple.cpp.
+FIPS_NOT_CONTINENTAL_US=['02','60','66','15','72','78']
+
+# Number of cover codes in a byte CDL.
+COVER_CNT=256
+
+
+def inverse_geotransform(gt):
+    '''
+    Invert a GDAL geotransform, so that it takes projected coordinates
+    to pixel and line. This is the inverse used in triple.cpp.
+    '''
+    inv_det=1.0/(gt[1]*gt[5]-gt[2]*gt[4])
+    return [inv_det*(gt[2]*gt[3]-gt[5]*gt[0]), inv_det*gt[5], -inv_det*gt[2],
+            inv_det*(gt[4]*gt[0]-gt[1]*gt[3]), -inv_det*gt[4], inv_det*gt[1]]
+
+
+
+def tile_geotransform(gt,xoff,yoff):
+    '''
+    The geotransform of a window of a raster starting at (xoff,yoff).
+    '''
+    return [gt[0]+xoff*gt[1]+yoff*gt[2], gt[1], gt[2],
+            gt[3]+xoff*gt[4]+yoff*gt[5], gt[4], gt[5]]
+
+
+
+def counties_in_srs(counties_file,srs_wkt,feature=None):
+    '''
+    Copy the continental US counties into an in-memory layer in the
+    CDL's projection, so that they are transformed once, not once
+    per tile. The layer has a single integer field, GEOID.
+
+    Returns: (data source, layer). Keep the data source alive
+             as long as you use the layer.
+    '''
+    source=ogr.Open(counties_file)
+    if source is None:
+        raise IOError('Could not open county shapefile %s' % counties_file)
+    layer=source.GetLayer(0)
+    where=['STATEFP10 NOT IN (%s)' %
+           ','.join(["'%s'" % x for x in FIPS_NOT_CONTINENTAL_US])]
+    if feature:
+        where.append("GEOID10 = '%05d'" % feature)
+    layer.SetAttributeFilter(' AND '.join(where))
+
+    target=osr.SpatialReference()
+    target.ImportFromWkt(srs_wkt)
+    transform=osr.CoordinateTransformation(layer.GetSpatialRef(),target)
+
+    memory=ogr.GetDriverByName('Memory').CreateDataSource('counties')
+    out_layer=memory.CreateLayer('counties',target,ogr.wkbMultiPolygon)
+    out_layer.CreateField(ogr.FieldDefn('GEOID',ogr.OFTInteger))
+    defn=out_layer.GetLayerDefn()
+
+    feature_cnt=0
+    in_feature=layer.GetNextFeature()
+    while in_feature:
+        geometry=in_feature.GetGeometryRef().Clone()
+        geometry.Transform(transform)
+        out_feature=ogr.Feature(defn)
+        out_feature.SetGeometry(geometry)
+        out_feature.SetField('GEOID',int(in_feature.GetField('GEOID10')))
+        out_layer.CreateFeature(out_feature)
+        feature_cnt+=1
+        in_feature=layer.GetNextFeature()
+    logger.info('projected %d counties' % feature_cnt)
+    return memory,out_layer
+
+
+
+class cell_transform(object):
+    '''
+    Maps CDL pixel/line to GIMMS pixel/line. The two Albers
+    projections differ, so this isn't affine over the whole country,
+    but it is very nearly affine over one tile, so fit() finds the
+    best affine map for a tile from a grid of exactly transformed points.
+    '''
+    def __init__(self,cdl_ds,ndvi_ds,samples=5):
+        self._cdl_gt=cdl_ds.GetGeoTransform()
+        self._ndvi_inv=inverse_geotransform(ndvi_ds.GetGeoTransform())
+        cdl_srs=osr.SpatialReference()
+        cdl_srs.ImportFromWkt(cdl_ds.GetProjection())
+        # The spatial reference info inside the GIMMS files is incomplete.
+        gimms_srs=osr.SpatialReference()
+        gimms_srs.ImportFromProj4(GIMMS_PROJ4)
+        self._transform=osr.CoordinateTransformation(cdl_srs,gimms_srs)
+        self._samples=samples
+        self.max_residual=0
+
+    def fit(self,xoff,yoff,xsize,ysize):
+        '''
+        Returns coefficients c such that the GIMMS pixel coordinate of
+        tile pixel (col,row) is c[0]+c[1]*col+c[2]*row, for x in c[:,0]
+        and y in c[:,1]. Coordinates are continuous, so floor them.
+        '''
+        cols,rows=np.meshgrid(np.linspace(0,xsize,self._samples),
+                              np.linspace(0,ysize,self._samples))
+        cols=cols.flatten()
+        rows=rows.flatten()
+        g=self._cdl_gt
+        px=g[0]+(xoff+cols)*g[1]+(yoff+rows)*g[2]
+        py=g[3]+(xoff+cols)*g[4]+(yoff+rows)*g[5]
+        points=self._transform.TransformPoints(zip(px,py))
+        gx=np.array([p[0] for p in points])
+        gy=np.array([p[1] for p in points])
+        n=self._ndvi_inv
+        pixel=np.column_stack([n[0]+gx*n[1]+gy*n[2], n[3]+gx*n[4]+gy*n[5]])
+
+        design=np.column_stack([np.ones(len(cols)),cols,rows])
+        coeffs=np.linalg.lstsq(design,pixel)[0]
+        residual=np.max(np.abs(np.dot(design,coeffs)-pixel))
+        self.max_residual=max(self.max_residual,residual)
+        return coeffs
+
+
+
+def pack_keys(geoid,ndvi_x,ndvi_y,cover,ndvi_size):
+    '''
+    Make one int64 key per pixel that sorts by geoid, then line,
+    then pixel of the NDVI cell, then cover. Sorted keys keep the
+    lines of each county, and the covers of each cell, together,
+    which is all gimms.build needs. triple writes counties in the
+    order of the shapefile layer instead, so its output has the same
+    lines with the counties in a different order.
+    '''
+    key=geoid.astype(np.int64)*ndvi_size[1]+ndvi_y
+    key=key*ndvi_size[0]+ndvi_x
+    return key*COVER_CNT+cover
+
+
+
+def unpack_keys(keys,ndvi_size):
+    '''
+    Inverse of pack_keys. Returns (geoid, ndvi_x, ndvi_y, cover).
+    '''
+    cover=keys%COVER_CNT
+    rest=keys//COVER_CNT
+    ndvi_x=rest%ndvi_size[0]
+    rest//=ndvi_size[0]
+    ndvi_y=rest%ndvi_size[1]
+    geoid=rest//ndvi_size[1]
+    return geoid,ndvi_x,ndvi_y,cover
+
+
+
+def tile_counts(geoids,codes,coeffs,ndvi_size):
+    '''
+    Count CDL pixels by (county, NDVI cell, cover) for one tile.
+    geoids is the rasterized county layer, with 0 outside counties.
+    codes is the CDL tile.
+
+    Returns: (packed keys, pixel counts) for nonzero counts.
+    '''
+    rows,cols=np.nonzero(geoids)
+    if len(rows) is 0:
+        return np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64)
+    # Pixel centers are at half-pixels.
+    ndvi_x=np.floor(coeffs[0,0]+coeffs[1,0]*(cols+0.5)+
+                    coeffs[2,0]*(rows+0.5)).astype(np.int64)
+    ndvi_y=np.floor(coeffs[0,1]+coeffs[1,1]*(cols+0.5)+
+                    coeffs[2,1]*(rows+0.5)).astype(np.int64)
+    inside=((ndvi_x>=0) & (ndvi_x<ndvi_size[0]) &
+            (ndvi_y>=0) & (ndvi_y<ndvi_size[1]))
+    if not np.all(inside):
+        logger.warning('%d pixels fall outside the NDVI grid' %
+                       np.sum(~inside))
+        rows=rows[inside]
+        cols=cols[inside]
+        ndvi_x=ndvi_x[inside]
+        ndvi_y=ndvi_y[inside]
+
+    # Pack against the small range present in this tile so that
+    # bincount needs only a short array.
+    tile_geoids,county_idx=np.unique(geoids[rows,cols],return_inverse=True)
+    x0=ndvi_x.min()
+    y0=ndvi_y.min()
+    xcnt=ndvi_x.max()-x0+1
+    ycnt=ndvi_y.max()-y0+1
+    local=(county_idx*ycnt+(ndvi_y-y0))*xcnt+(ndvi_x-x0)
+    local=local*COVER_CNT+codes[rows,cols]
+    counts=np.bincount(local,minlength=len(tile_geoids)*ycnt*xcnt*COVER_CNT)
+    present=np.nonzero(counts)[0]
+
+    cover=present%COVER_CNT
+    rest=present//COVER_CNT
+    local_x=rest%xcnt
+    rest//=xcnt
+    local_y=rest%ycnt
+    county=rest//ycnt
+    keys=pack_keys(tile_geoids[county],local_x+x0,local_y+y0,cover,ndvi_size)
+    return keys,counts[present]
+
+
+
+def reduce_keys(keys,counts):
+    '''
+    Sum counts that share a key. Returns sorted unique keys and sums.
+    '''
+    unique,inverse=np.unique(keys,return_inverse=True)
+    return unique,np.bincount(inverse,weights=counts).astype(np.int64)
+
+
+
+class key_accumulator(object):
+    '''
+    Collects (keys, counts) from tiles and sums duplicates
+    whenever enough entries pile up, which bounds memory.
+    '''
+    def __init__(self,compact_at=10000000):
+        self._keys=[np.zeros(0,dtype=np.int64)]
+        self._counts=[np.zeros(0,dtype=np.int64)]
+        self._size=0
+        self._compact_at=compact_at
+
+    def add(self,keys,counts):
+        self._keys.append(keys)
+        self._counts.append(counts)
+        self._size+=len(keys)
+        if self._size>self._compact_at:
+            self._compact()
+
+    def _compact(self):
+        keys,counts=reduce_keys(np.concatenate(self._keys),
+                                np.concatenate(self._counts))
+        self._keys=[keys]
+        self._counts=[counts]
+        self._size=len(keys)
+
+    def result(self):
+        self._compact()
+        return self._keys[0],self._counts[0]
+
+
+
+def zonal_counts(cdls,counties,ndvi,feature=None,tile=4096):
+    '''
+    Count CDL pixels by county, NDVI cell, and cover for the whole CDL,
+    or for just one county if feature is a geoid.
+
+    Returns: (sorted packed keys, pixel counts, NDVI size, pixel area)
+    '''
+    cdl_ds=gdal.Open(cdls,GA_ReadOnly)
+    ndvi_ds=gdal.Open(ndvi,GA_ReadOnly)
+    ndvi_size=(ndvi_ds.RasterXSize,ndvi_ds.RasterYSize)
+    cdl_band=cdl_ds.GetRasterBand(1)
+    cdl_gt=cdl_ds.GetGeoTransform()
+    pixel_area=abs(cdl_gt[1]*cdl_gt[5]-cdl_gt[2]*cdl_gt[4])
+
+    memory,layer=counties_in_srs(counties,cdl_ds.GetProjection(),feature)
+    to_cell=cell_transform(cdl_ds,ndvi_ds)
+
+    block=cdl_band.GetBlockSize()
+    # Keep tiles on the block grid so each block is decompressed once.
+    tile=max(block[0],tile-tile%block[0])
+    logger.info('CDL %d by %d in tiles of %d' %
+                (cdl_ds.RasterXSize,cdl_ds.RasterYSize,tile))
+
+    mem_driver=gdal.GetDriverByName('MEM')
+    rasters=dict()
+    codes=dict()
+    totals=key_accumulator()
+    start=time.time()
+    for yoff in range(0,cdl_ds.RasterYSize,tile):
+        for xoff in range(0,cdl_ds.RasterXSize,tile):
+            xsize=min(tile,cdl_ds.RasterXSize-xoff)
+            ysize=min(tile,cdl_ds.RasterYSize-yoff)
+            tile_gt=tile_geotransform(cdl_gt,xoff,yoff)
+            corners=[(tile_gt[0]+x*tile_gt[1]+y*tile_gt[2],
+                      tile_gt[3]+x*tile_gt[4]+y*tile_gt[5])
+                     for (x,y) in [(0,0),(xsize,0),(0,ysize),(xsize,ysize)]]
+            layer.SetSpatialFilterRect(min([c[0] for c in corners]),
+                                       min([c[1] for c in corners]),
+                                       max([c[0] for c in corners]),
+                                       max([c[1] for c in corners]))
+            if layer.GetFeatureCount()==0:
+                continue
+
+            if (xsize,ysize) not in rasters:
+                raster=mem_driver.Create('',xsize,ysize,1,gdal.GDT_Int32)
+                raster.SetProjection(cdl_ds.GetProjection())
+                rasters[(xsize,ysize)]=raster
+                codes[(xsize,ysize)]=np.zeros((ysize,xsize),dtype=np.uint8)
+            raster=rasters[(xsize,ysize)]
+            raster.SetGeoTransform(tile_gt)
+            raster.GetRasterBand(1).Fill(0)
+            gdal.RasterizeLayer(raster,[1],layer,options=['ATTRIBUTE=GEOID'])
+            geoids=raster.GetRasterBand(1).ReadAsArray()
+            if not np.any(geoids):
+                continue
+
+            code_buf=codes[(xsize,ysize)]
+            cdl_band.ReadAsArray(xoff,yoff,xsize,ysize,xsize,ysize,code_buf)
+            coeffs=to_cell.fit(xoff,yoff,xsize,ysize)
+            totals.add(*tile_counts(geoids,code_buf,coeffs,ndvi_size))
+        logger.debug('through line %d of %d in %d s' %
+                     (yoff+tile,cdl_ds.RasterYSize,time.time()-start))
+
+    layer.SetSpatialFilter(None)
+    logger.info('largest error of tile affine maps %g NDVI pixels' %
+                to_cell.max_residual)
+    if to_cell.max_residual>0.01:
+        logger.warning('Affine maps are off by %g NDVI pixels. Use a '
+                       'smaller --tile.' % to_cell.max_residual)
+    keys,counts=totals.result()
+    return keys,counts,ndvi_size,pixel_area
+
+
+
+def write_code_stream(out,keys,counts,ndvi_size,pixel_area):
+    '''
+    Write tab-delimited geoid, x, y, cover code, square meters,
+    formatted the way triple formats it.
+    '''
+    geoid,ndvi_x,ndvi_y,cover=unpack_keys(keys,ndvi_size)
+    area=counts*pixel_area
+    for idx in xrange(len(keys)):
+        out.write('%d\t%d\t%d\t%d\t%g\n' % (geoid[idx],ndvi_x[idx],
+                                            ndvi_y[idx],cover[idx],area[idx]))
+
+
+
+def test_keys():
+    ndvi_size=(1280,1024)
+    geoid=np.array([56045,1001,1001])
+    x=np.array([1279,0,3])
+    y=np.array([1023,0,2])
+    cover=np.array([255,0,24])
+    keys=pack_keys(geoid,x,y,cover,ndvi_size)
+    for a,b in zip(unpack_keys(keys,ndvi_size),[geoid,x,y,cover]):
+        assert(np.all(a==b))
+    assert(np.argsort(keys).tolist()==[1,2,0])
+
+
+
+def test_tile_counts():
+    geoids=np.array([[0,5,5],[7,7,5]],dtype=np.int32)
+    codes=np.array([[1,24,24],[24,3,24]],dtype=np.uint8)
+    # Every CDL pixel falls in NDVI cell (10,20).
+    coeffs=np.array([[10.0,20.0],[0.0,0.0],[0.0,0.0]])
+    keys,counts=tile_counts(geoids,codes,coeffs,(1280,1024))
+    keys,counts=reduce_keys(np.concatenate([keys,keys]),
+                            np.concatenate([counts,counts]))
+    geoid,x,y,cover=unpack_keys(keys,(1280,1024))
+    assert(geoid.tolist()==[5,7,7])
+    assert(cover.tolist()==[24,3,24])
+    assert(counts.tolist()==[6,2,2])
+    assert(np.all(x==10) and np.all(y==20))
+
+
+
+def suite():
+    import unittest
+    suite=unittest.TestSuite()
+    suite.addTest(unittest.FunctionTestCase(test_keys))
+    suite.addTest(unittest.FunctionTestCase(test_tile_counts))
+    return suite
+
+
+
+if __name__ == '__main__':
+    parser=DefaultArgumentParser(description='area of each cover code in '
+                                 'each NDVI cell of each county', suite=suite)
+    parser.add_argument('--cdls',dest='cdls',type=str,
+                        help='raster of usage codes')
+    parser.add_argument('--counties',dest='counties',type=str,
+                        help='shapefile of counties')
+    parser.add_argument('--ndvi',dest='ndvi',type=str,
+                        help='raster of greening')
+    parser.add_argument('--feature',dest='feature',type=int,default=0,
+                        help='process only the county with this geoid')
+    parser.add_argument('--tile',dest='tile',type=int,default=4096,
+                        help='width of square tiles of the CDL to process')
+    parser.add_argument('--out',dest='out',type=str,
+                        help='file to write, instead of stdout')
+    args=parser.parse_args()
+
+    if not args.ndvi:
+        logger.error('Use --ndvi to specify a GIMMS file for its grid.')
+        parser.print_help()
+        sys.exit(1)
+    cdls=args.cdls or luconfig.get('cdls')
+    counties=args.counties or luconfig.get('county')
+
+    keys,counts,ndvi_size,pixel_area=zonal_counts(cdls,counties,args.ndvi,
+                                                  args.feature,args.tile)
+    out=sys.stdout
+    if args.out:
+        out=open(args.out,'w')
+    write_code_stream(out,keys,counts,ndvi_size,pixel_area)
+    if args.out:
+        out.close()